@@ -2,25 +2,45 @@
 Food Rescue App - Main Application
 Connects food companies with volunteers to reduce food waste
 """
-from flask import Flask, render_template, redirect, url_for, request, flash, jsonify
+from flask import Flask, Blueprint, Response, abort, current_app, render_template, redirect, url_for, request, flash, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
+import csv
+import heapq
+import io
 import os
-from math import radians, cos, sin, asin, sqrt
 
-from config import Config
-from models import db, User, Donation
+import click
+
+from config import config
+from models import db, User, Donation, URGENCY_ORDER, add_missing_columns, create_indexes, upgrade_donation_ids
 from forms import RegisterForm, LoginForm, DonationForm
+from search import init_search_index, match_filter, search_donations, search_facets
+from routing import init_read_routing, read_only
+from sharding import init_sharding
+from ratelimit import init_rate_limits
+from profiling import init_profiling, profile_command
+from readmodel import current_read_model, init_change_log
+from ranking import FeedRanker, bounding_box, haversine_km
+from outbox import events_command, record_bulk_events
+from geocoder import geocode_address, geocode_command
+from archive import archive_command, donation_history
+from idempotency import idempotent, new_key, purge_idempotency_keys_command
+from sync import change_heads, delta_sync, full_sync
+from jobs import init_jobs, jobs_command
+from notifications import notify_command, notify_later
+from pagecache import cached_page
+from photos import init_photos, request_thumbnail, serve_photo, store_photo, thumbnail_url
+from writebehind import init_user_writes, write_user
+
+DONATION_CATEGORIES = [value for value, _ in DonationForm.CATEGORIES if value]
 
-app = Flask(__name__)
-app.config.from_object(Config)
-db.init_app(app)
+main = Blueprint('main', __name__)
 
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'warning'
 
@@ -29,33 +49,178 @@ def load_user(user_id):
     """Load user by ID for Flask-Login"""
     return User.query.get(int(user_id))
 
-# Initialize database
-with app.app_context():
-    os.makedirs(os.path.join(app.root_path, 'database'), exist_ok=True)
+def create_app(config_name=None):
+    """
+    Application factory.
+    Touches no database so that importing and preloading the app stay cheap;
+    create the schema once with `flask --app app init-db`.
+    """
+    config_name = config_name or os.environ.get('FLASK_CONFIG', 'default')
+    
+    app = Flask(__name__)
+    app.config.from_object(config[config_name])
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(main)
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(events_command)
+    app.cli.add_command(geocode_command)
+    app.cli.add_command(archive_command)
+    app.cli.add_command(profile_command)
+    app.cli.add_command(purge_idempotency_keys_command)
+    app.cli.add_command(jobs_command)
+    app.cli.add_command(notify_command)
+    init_profiling(app)
+    init_rate_limits(app)
+    init_jobs(app)
+    init_photos(app)
+    init_user_writes(app)
+    
+    routing = init_read_routing(app, db)
+    shards = init_sharding(app, db)
+    
+    # With preload-then-fork servers (gunicorn --preload) the master builds the
+    # app once; each child must open its own SQLite connections.
+    with app.app_context():
+        engines = list(db.engines.values())
+    
+    def dispose_engines():
+        for engine in engines:
+            engine.dispose(close=False)
+        routing.dispose()
+        shards.dispose()
+    
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=dispose_engines)
+    
+    return app
+
+def init_db():
+    """Create the database directory, tables, indexes and search index, on every shard"""
+    os.makedirs(os.path.join(current_app.root_path, 'database'), exist_ok=True)
     db.create_all()
+    add_missing_columns()
+    upgrade_donation_ids()
+    create_indexes()
+    init_search_index()
+    init_change_log()
+    for engine in current_app.extensions['shards'].init_schema():
+        add_missing_columns(engine)
+        init_search_index(engine)
+        init_change_log(engine)
+
+@click.command('init-db')
+def init_db_command():
+    """Create or upgrade the database schema"""
+    init_db()
+    click.echo('Database initialized.')
 
 def calculate_distance(lat1, lon1, lat2, lon2):
     """
     Calculate distance between two points using Haversine formula
     Returns distance in kilometers
     """
-    if None in (lat1, lon1, lat2, lon2):
-        return None
+    return haversine_km(lat1, lon1, lat2, lon2)
+
+def donation_filters():
+    """Read the urgency and category filters from the query string, ignoring unknown values"""
+    urgency = request.args.get('urgency')
+    category = request.args.get('category')
+    if urgency not in URGENCY_ORDER:
+        urgency = None
+    if category not in DONATION_CATEGORIES:
+        category = None
+    return urgency, category
+
+# Columns each dashboard section renders
+AVAILABLE_CARD_COLUMNS = (
+    Donation.id, Donation.item_name, Donation.description, Donation.category,
+    Donation.expiry_date, Donation.quantity, Donation.latitude, Donation.longitude,
+    Donation.created_at, Donation.company_id, Donation.photo
+)
+CLAIM_CARD_COLUMNS = (
+    Donation.id, Donation.item_name, Donation.expiry_date, Donation.quantity,
+    Donation.status, Donation.created_at, Donation.company_id, Donation.photo
+)
+COMPANY_TABLE_COLUMNS = (
+    Donation.id, Donation.item_name, Donation.description, Donation.category,
+    Donation.quantity, Donation.expiry_date, Donation.status, Donation.created_at
+)
+
+class DonationCard:
+    """Dashboard view of a donation row, with its company's name and distance"""
     
-    # Convert to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    __slots__ = ('_row', 'company_name', 'distance')
     
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
+    def __init__(self, row, company_name=None):
+        self._row = row
+        self.company_name = company_name
+        self.distance = None
     
-    # Radius of earth in kilometers
-    r = 6371
-    return c * r
+    def __getattr__(self, name):
+        return getattr(self._row, name)
+
+# Donation ids per IN query, well under SQLite's bound parameter limit
+ID_CHUNK = 5000
+
+def donation_cards(query, columns, ids=None):
+    """
+    Fetch only the given columns as plain rows, skipping ORM object
+    hydration, and attach company names with one extra IN query. Rows
+    cannot lazy-load, so the statement count does not grow with the cards.
+    With ids, fetches just those donations, in chunks.
+    """
+    if ids is None:
+        rows = query.with_entities(*columns).all()
+    else:
+        rows = []
+        for start in range(0, len(ids), ID_CHUNK):
+            rows.extend(query.filter(Donation.id.in_(ids[start:start + ID_CHUNK])).with_entities(*columns))
+    return company_cards(rows)
+
+def company_cards(rows):
+    """Wrap donation rows as DonationCards with their company names, in one query"""
+    names = User.display_names({row.company_id for row in rows})
+    return [DonationCard(row, names.get(row.company_id)) for row in rows]
 
-@app.route('/')
+def filter_donations(query, urgency, category):
+    """Apply urgency and category filters as indexable SQL predicates"""
+    if urgency:
+        query = query.filter(Donation.urgency_filter(urgency))
+    if category:
+        query = query.filter(Donation.category == category)
+    return query
+
+def priority_feed(query, lat=None, lng=None, today=None):
+    """
+    SQL fallback of AvailableDonations.ranked: the FEED_SIZE cards of query
+    with the highest priority score, best first
+    """
+    config = current_app.config
+    ranker = FeedRanker.from_config(config, today or datetime.now().date())
+    limit = config['FEED_SIZE']
+    located = lat is not None and lng is not None
+    box = bounding_box(lat, lng, config['FEED_RADIUS_KM']) if located and config['FEED_RADIUS_KM'] else None
+    
+    rows = []
+    if box is not None:
+        min_lat, max_lat, min_lng, max_lng = box
+        rows = query.filter(
+            Donation.latitude.between(min_lat, max_lat),
+            Donation.longitude.between(min_lng, max_lng)
+        ).order_by(Donation.id).with_entities(*AVAILABLE_CARD_COLUMNS).all()
+    if len(rows) < limit:
+        rows = query.order_by(Donation.id).with_entities(*AVAILABLE_CARD_COLUMNS).all()
+    
+    score = ranker.scorer(lat, lng)
+    best = heapq.nlargest(limit, rows, key=lambda row: score(
+        row.latitude, row.longitude, row.expiry_date.toordinal(), row.quantity
+    ))
+    return company_cards(best)
+
+@main.route('/')
+@cached_page
+@read_only
 def index():
     """Home page"""
     stats = {
@@ -66,11 +231,11 @@ def index():
     }
     return render_template('index.html', stats=stats)
 
-@app.route('/register', methods=['GET', 'POST'])
+@main.route('/register', methods=['GET', 'POST'])
 def register():
     """User registration"""
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     form = RegisterForm()
     if form.validate_on_submit():
@@ -78,7 +243,7 @@ def register():
         existing_user = User.query.filter_by(email=form.email.data).first()
         if existing_user:
             flash('Email already registered. Please login instead.', 'danger')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         
         hashed_pw = generate_password_hash(form.password.data, method='pbkdf2:sha256')
         user = User(
@@ -89,34 +254,39 @@ def register():
             registration_number=form.registration_number.data if form.role.data == 'company' else None,
             email=form.email.data.lower(),
             phone=form.phone.data,
+            address=form.address.data or None,
             password_hash=hashed_pw
         )
+        location = geocode_address(user.address)
+        if location:
+            user.latitude, user.longitude = location
         
         try:
             db.session.add(user)
             db.session.commit()
             flash('Account created successfully! Please log in.', 'success')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         except Exception as e:
             db.session.rollback()
             flash('An error occurred. Please try again.', 'danger')
-            app.logger.error(f"Registration error: {str(e)}")
+            current_app.logger.error(f"Registration error: {str(e)}")
     
     return render_template('register.html', form=form)
 
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/login', methods=['GET', 'POST'])
 def login():
     """User login"""
     if current_user.is_authenticated:
         if current_user.role == 'company':
-            return redirect(url_for('dashboard_company'))
-        return redirect(url_for('dashboard_volunteer'))
+            return redirect(url_for('main.dashboard_company'))
+        return redirect(url_for('main.dashboard_volunteer'))
     
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data.lower()).first()
         if user and check_password_hash(user.password_hash, form.password.data):
             login_user(user, remember=form.remember_me.data)
+            user.update_last_login()
             flash(f'Welcome back, {user.name}!', 'success')
             
             # Redirect to next page or dashboard
@@ -125,33 +295,32 @@ def login():
                 return redirect(next_page)
             
             if user.role == 'company':
-                return redirect(url_for('dashboard_company'))
-            return redirect(url_for('dashboard_volunteer'))
+                return redirect(url_for('main.dashboard_company'))
+            return redirect(url_for('main.dashboard_volunteer'))
         
         flash('Invalid email or password.', 'danger')
     
     return render_template('login.html', form=form)
 
-@app.route('/logout')
+@main.route('/logout')
 @login_required
 def logout():
     """User logout"""
     logout_user()
     flash('You have been logged out.', 'info')
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
-@app.route('/dashboard/company')
+@main.route('/dashboard/company')
+@read_only
 @login_required
 def dashboard_company():
     """Company dashboard - view and manage donations"""
     if current_user.role != 'company':
         flash('Access denied. Companies only.', 'danger')
-        return redirect(url_for('dashboard_volunteer'))
+        return redirect(url_for('main.dashboard_volunteer'))
     
-    # Get company's donations with statistics
-    donations = Donation.query.filter_by(company_id=current_user.id).order_by(
-        Donation.created_at.desc()
-    ).all()
+    # Get company's donations, live and archived, with statistics
+    donations = donation_history(COMPANY_TABLE_COLUMNS, company_id=current_user.id)
     
     stats = {
         'total': len(donations),
@@ -162,21 +331,106 @@ def dashboard_company():
     
     return render_template('dashboard_company.html', donations=donations, stats=stats)
 
-@app.route('/dashboard/volunteer')
+EXPORT_COLUMNS = (
+    Donation.id, Donation.item_name, Donation.category, Donation.quantity,
+    Donation.expiry_date, Donation.status, Donation.created_at,
+    Donation.claimed_at, Donation.completed_at
+)
+
+@main.route('/dashboard/company/export.csv')
+@read_only
+@login_required
+def export_donations():
+    """Download the company's full donation history, archived donations included"""
+    if current_user.role != 'company':
+        flash('Access denied. Companies only.', 'danger')
+        return redirect(url_for('main.dashboard_volunteer'))
+    
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow([column.key for column in EXPORT_COLUMNS])
+    writer.writerows(donation_history(EXPORT_COLUMNS, company_id=current_user.id))
+    return Response(output.getvalue(), mimetype='text/csv', headers={
+        'Content-Disposition': 'attachment; filename=donations.csv'
+    })
+
+@main.route('/dashboard/volunteer')
+@read_only
 @login_required
 def dashboard_volunteer():
     """Volunteer dashboard - view available donations with distance"""
     if current_user.role != 'volunteer':
         flash('Access denied. Volunteers only.', 'danger')
-        return redirect(url_for('dashboard_company'))
-    
-    # Get available donations
-    donations = Donation.query.filter_by(status='available').order_by(
-        Donation.created_at.desc()
-    ).all()
+        return redirect(url_for('main.dashboard_company'))
+    
+    search_query = request.args.get('q', '').strip()
+    urgency, category = donation_filters()
+    # Search results keep their relevance order; otherwise the priority feed,
+    # or every donation nearest first with ?sort=distance
+    if search_query:
+        sort = 'relevance'
+    else:
+        sort = 'distance' if request.args.get('sort') == 'distance' else 'priority'
+    has_location = bool(current_user.latitude and current_user.longitude)
+    lat = current_user.latitude if has_location else None
+    lng = current_user.longitude if has_location else None
+    read_model = None if search_query else current_read_model()
+    today = datetime.now().date()
+    
+    facets = None
+    if search_query:
+        # Full-text search already ranks by relevance and distance, and
+        # filters before it keeps the best SEARCH_MAX_RESULTS
+        hits = search_donations(
+            search_query,
+            category=category,
+            urgency=urgency,
+            today=today,
+            lat=current_user.latitude,
+            lng=current_user.longitude,
+            distance_scale_km=current_app.config['SEARCH_DISTANCE_SCALE_KM'],
+            limit=current_app.config['SEARCH_MAX_RESULTS']
+        )
+        order = {donation_id: i for i, (donation_id, _) in enumerate(hits)}
+        base_query = Donation.query.filter(Donation.id.in_(order))
+        # Counted over every match, not just the results shown
+        facets = Donation.facet_counts(
+            Donation.query.filter(match_filter(search_query)), urgency, category, today
+        )
+    else:
+        base_query = Donation.query.filter_by(status='available')
+    
+    if read_model is not None:
+        # Filtered and ranked in memory; SQL only fetches the cards
+        if sort == 'priority':
+            ids = read_model.ranked(
+                FeedRanker.from_config(current_app.config, today),
+                lat=lat,
+                lng=lng,
+                limit=current_app.config['FEED_SIZE'],
+                radius_km=current_app.config['FEED_RADIUS_KM'],
+                urgency=urgency,
+                category=category,
+                today=today
+            )
+        else:
+            ids = read_model.query(lat=lat, lng=lng, urgency=urgency, category=category, today=today)
+        facets = read_model.facet_counts(urgency, category, today)
+        donations = donation_cards(Donation.query, AVAILABLE_CARD_COLUMNS, ids=ids)
+        order = {donation_id: i for i, donation_id in enumerate(ids)}
+    else:
+        if facets is None:
+            facets = Donation.facet_counts(base_query, urgency, category)
+        filtered = filter_donations(base_query, urgency, category)
+        if sort == 'priority':
+            donations = priority_feed(filtered, lat, lng, today)
+        else:
+            donations = donation_cards(filtered.order_by(Donation.created_at.desc()), AVAILABLE_CARD_COLUMNS)
+    if search_query or read_model is not None:
+        donations.sort(key=lambda d: order[d.id])
     
     # Calculate distances if volunteer has location
-    if current_user.latitude and current_user.longitude:
+    if has_location:
         for donation in donations:
             if donation.latitude and donation.longitude:
                 donation.distance = calculate_distance(
@@ -185,32 +439,40 @@ def dashboard_volunteer():
                     donation.latitude,
                     donation.longitude
                 )
-        # Sort by distance
-        donations = sorted(donations, key=lambda x: x.distance if hasattr(x, 'distance') and x.distance else float('inf'))
+        # Sort by distance (the feed and search results keep their ranking)
+        if sort == 'distance' and read_model is None:
+            donations = sorted(donations, key=lambda x: x.distance if x.distance else float('inf'))
     
     # Get volunteer's claimed donations
-    my_claims = Donation.query.filter_by(
-        volunteer_id=current_user.id
-    ).order_by(Donation.created_at.desc()).all()
+    my_claims = company_cards(donation_history(CLAIM_CARD_COLUMNS, volunteer_id=current_user.id))
     
     return render_template('dashboard_volunteer.html', 
                           donations=donations, 
-                          my_claims=my_claims)
+                          my_claims=my_claims,
+                          search_query=search_query,
+                          facets=facets,
+                          urgency=urgency,
+                          category=category,
+                          sort=sort)
 
-@app.route('/donation/add', methods=['GET', 'POST'])
+@main.route('/donation/add', methods=['GET', 'POST'])
 @login_required
+@idempotent
 def add_donation():
     """Add a new donation (companies only)"""
     if current_user.role != 'company':
         flash('Only companies can add donations.', 'danger')
-        return redirect(url_for('dashboard_volunteer'))
+        return redirect(url_for('main.dashboard_volunteer'))
     
     # Check if company has set location
     if not current_user.latitude or not current_user.longitude:
         flash('Please set your location first to add donations.', 'warning')
     
     form = DonationForm()
-    if form.validate_on_submit():
+    submitted = form.validate_on_submit()
+    # A fresh key for the next submit: this one may already have an answer stored
+    form.idempotency_key.data = new_key()
+    if submitted:
         # Validate expiry date is in the future
         if form.expiry_date.data < datetime.now().date():
             flash('Expiry date must be in the future.', 'danger')
@@ -228,19 +490,24 @@ def add_donation():
         )
         
         try:
+            if form.photo.data:
+                donation.photo = store_photo(form.photo.data)
+                request_thumbnail(donation.photo)
             db.session.add(donation)
+            notify_later()
             db.session.commit()
             flash('Donation added successfully!', 'success')
-            return redirect(url_for('dashboard_company'))
+            return redirect(url_for('main.dashboard_company'))
         except Exception as e:
             db.session.rollback()
             flash('An error occurred. Please try again.', 'danger')
-            app.logger.error(f"Add donation error: {str(e)}")
+            current_app.logger.error(f"Add donation error: {str(e)}")
     
     return render_template('add_donation.html', form=form)
 
-@app.route('/donation/<int:donation_id>/claim', methods=['POST'])
+@main.route('/donation/<int:donation_id>/claim', methods=['POST'])
 @login_required
+@idempotent
 def claim_donation(donation_id):
     """Claim a donation (volunteers only)"""
     if current_user.role != 'volunteer':
@@ -256,16 +523,18 @@ def claim_donation(donation_id):
     donation.claimed_at = datetime.utcnow()
     
     try:
+        notify_later()
         db.session.commit()
         flash('Donation claimed successfully! Please pick it up before expiry.', 'success')
         return jsonify({'success': True, 'message': 'Donation claimed!'})
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Claim donation error: {str(e)}")
+        current_app.logger.error(f"Claim donation error: {str(e)}")
         return jsonify({'error': 'An error occurred'}), 500
 
-@app.route('/donation/<int:donation_id>/complete', methods=['POST'])
+@main.route('/donation/<int:donation_id>/complete', methods=['POST'])
 @login_required
+@idempotent
 def complete_donation(donation_id):
     """Mark donation as completed"""
     donation = Donation.query.get_or_404(donation_id)
@@ -281,15 +550,16 @@ def complete_donation(donation_id):
     donation.completed_at = datetime.utcnow()
     
     try:
+        notify_later()
         db.session.commit()
         flash('Donation marked as completed!', 'success')
         return jsonify({'success': True})
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Complete donation error: {str(e)}")
+        current_app.logger.error(f"Complete donation error: {str(e)}")
         return jsonify({'error': 'An error occurred'}), 500
 
-@app.route('/donation/<int:donation_id>/delete', methods=['POST'])
+@main.route('/donation/<int:donation_id>/delete', methods=['POST'])
 @login_required
 def delete_donation(donation_id):
     """Delete a donation (company only, only if not claimed)"""
@@ -308,46 +578,326 @@ def delete_donation(donation_id):
         return jsonify({'success': True})
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Delete donation error: {str(e)}")
+        current_app.logger.error(f"Delete donation error: {str(e)}")
+        return jsonify({'error': 'An error occurred'}), 500
+
+BATCH_ACTIONS = ('claim', 'complete', 'delete')
+
+def apply_donation_batch(action, donation_ids, user):
+    """
+    Apply a claim/complete/delete action to many donations at once.
+    Uses one SELECT and one set-based UPDATE/DELETE, with the same
+    permission rules as the single-item routes.
+    Returns a dict of donation id -> (http status, error or None).
+    Commits nothing; the caller owns the transaction, which also holds
+    the outbox events of the changed donations.
+    """
+    results = {}
+    rows = db.session.query(
+        Donation.id, Donation.status, Donation.company_id, Donation.volunteer_id
+    ).filter(Donation.id.in_(donation_ids)).all()
+    found = {row.id: row for row in rows}
+    
+    eligible = []
+    for donation_id in donation_ids:
+        row = found.get(donation_id)
+        if row is None:
+            results[donation_id] = (404, 'Donation not found')
+        elif action == 'claim':
+            if user.role != 'volunteer':
+                results[donation_id] = (403, 'Only volunteers can claim donations')
+            elif row.status != 'available':
+                results[donation_id] = (400, 'This donation is no longer available')
+            else:
+                eligible.append(donation_id)
+        elif action == 'complete':
+            if user.role == 'volunteer' and row.volunteer_id != user.id:
+                results[donation_id] = (403, 'Unauthorized')
+            elif user.role == 'company' and row.company_id != user.id:
+                results[donation_id] = (403, 'Unauthorized')
+            else:
+                eligible.append(donation_id)
+        else:
+            if user.role != 'company' or row.company_id != user.id:
+                results[donation_id] = (403, 'Unauthorized')
+            elif row.status == 'claimed':
+                results[donation_id] = (400, 'Cannot delete claimed donation')
+            else:
+                eligible.append(donation_id)
+    
+    if not eligible:
+        return results
+    
+    query = Donation.query.filter(Donation.id.in_(eligible))
+    now = datetime.utcnow()
+    if action == 'claim':
+        # Guard on status so a concurrent claim cannot be overwritten
+        query = query.filter(Donation.status == 'available')
+        updated = query.update({
+            'status': 'claimed',
+            'volunteer_id': user.id,
+            'claimed_at': now
+        }, synchronize_session=False)
+        record_bulk_events('claimed', Donation.id.in_(eligible), Donation.volunteer_id == user.id,
+                           Donation.claimed_at == now, actor_id=user.id)
+        if updated != len(eligible):
+            won = {row.id for row in db.session.query(Donation.id).filter(
+                Donation.id.in_(eligible),
+                Donation.volunteer_id == user.id,
+                Donation.claimed_at == now
+            )}
+            for donation_id in eligible:
+                if donation_id not in won:
+                    results[donation_id] = (400, 'This donation is no longer available')
+    elif action == 'complete':
+        query.update({
+            'status': 'completed',
+            'completed_at': now
+        }, synchronize_session=False)
+        record_bulk_events('completed', Donation.id.in_(eligible), actor_id=user.id)
+    else:
+        record_bulk_events('deleted', Donation.id.in_(eligible), actor_id=user.id)
+        query.delete(synchronize_session=False)
+    
+    for donation_id in eligible:
+        results.setdefault(donation_id, (200, None))
+    return results
+
+@main.route('/donations/batch', methods=['POST'])
+@login_required
+def batch_donations():
+    """Claim, complete or delete several donations in one transaction"""
+    data = request.get_json(silent=True)
+    
+    if not data or data.get('action') not in BATCH_ACTIONS or not isinstance(data.get('ids'), list):
+        return jsonify({'error': 'Invalid data'}), 400
+    
+    try:
+        # Keep the client's order but drop duplicates
+        donation_ids = list(dict.fromkeys(int(i) for i in data['ids']))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid data'}), 400
+    
+    if not donation_ids:
+        return jsonify({'error': 'No donations selected'}), 400
+    if len(donation_ids) > current_app.config['BATCH_MAX_IDS']:
+        return jsonify({'error': f"At most {current_app.config['BATCH_MAX_IDS']} donations per batch"}), 400
+    
+    try:
+        outcomes = apply_donation_batch(data['action'], donation_ids, current_user)
+        notify_later()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Batch donation error: {str(e)}")
         return jsonify({'error': 'An error occurred'}), 500
+    
+    results = []
+    succeeded = 0
+    for donation_id in donation_ids:
+        status, error = outcomes[donation_id]
+        if error is None:
+            succeeded += 1
+            results.append({'id': donation_id, 'success': True, 'status': status})
+        else:
+            results.append({'id': donation_id, 'success': False, 'status': status, 'error': error})
+    
+    if succeeded:
+        flash(f'{succeeded} donation(s) updated successfully.', 'success')
+    
+    return jsonify({
+        'success': succeeded == len(donation_ids),
+        'processed': succeeded,
+        'results': results
+    })
+
+@main.route('/donations/available')
+@read_only
+@login_required
+def available_donations():
+    """Available donations filtered by urgency and category, with facet counts (JSON)"""
+    urgency, category = donation_filters()
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['ITEMS_PER_PAGE']
+    
+    offset = (max(page, 1) - 1) * per_page
+    read_model = current_read_model()
+    
+    if read_model is not None:
+        ids = read_model.query(urgency=urgency, category=category, order='expiry',
+                               limit=per_page, offset=offset)
+        found = {d.id: d for d in Donation.query.filter(Donation.id.in_(ids))}
+        # Skip rows deleted since the model last synced
+        donations = [found[donation_id] for donation_id in ids if donation_id in found]
+        facets = read_model.facet_counts(urgency, category)
+    else:
+        base_query = Donation.query.filter_by(status='available')
+        donations = filter_donations(base_query, urgency, category).order_by(
+            Donation.expiry_date, Donation.id
+        ).limit(per_page).offset(offset).all()
+        facets = Donation.facet_counts(base_query, urgency, category)
+    
+    return jsonify({
+        'page': page,
+        'filters': {'urgency': urgency, 'category': category},
+        'results': [{
+            'id': d.id,
+            'item_name': d.item_name,
+            'category': d.category,
+            'quantity': d.quantity,
+            'expiry_date': d.expiry_date.isoformat(),
+            'urgency': d.urgency_level,
+            'latitude': d.latitude,
+            'longitude': d.longitude
+        } for d in donations],
+        'facets': facets
+    })
 
-@app.route('/user/location', methods=['POST'])
+@main.route('/donations/sync')
+@read_only
+@login_required
+def sync_donations():
+    """
+    Changes to the volunteer view since the version a client last saw (JSON).
+    Without ?since=, or when that version is too old, the response holds
+    everything and full is true. Clients add or replace the rows in
+    available and claims, drop the ids in removed_available and
+    removed_claims from those lists, and send version next time.
+    """
+    if current_user.role != 'volunteer':
+        return jsonify({'error': 'Volunteers only'}), 403
+    
+    since = request.args.get('since')
+    if not since:
+        return jsonify(full_sync(current_user.id, change_heads()))
+    payload = delta_sync(current_user.id, since)
+    if payload is None:
+        return jsonify({'error': 'Invalid version'}), 400
+    return jsonify(payload)
+
+@main.route('/photos/<any(original, thumb):kind>/<name>')
+def photo(kind, name):
+    """
+    A donation photo or its thumbnail. Names are content hashes, so responses
+    are immutable and unguessable names need no login (they can sit in a CDN).
+    """
+    response = serve_photo(kind, name)
+    if response is None:
+        abort(404)
+    return response
+
+@main.route('/donations/search')
+@read_only
+@login_required
+def search():
+    """Ranked full-text search over available donations (JSON)"""
+    search_query = request.args.get('q', '').strip()
+    if not search_query:
+        return jsonify({'error': 'Missing search query'}), 400
+    
+    category = request.args.get('category') or None
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        lat = request.args.get('lat', type=float, default=current_user.latitude)
+        lng = request.args.get('lng', type=float, default=current_user.longitude)
+        radius = request.args.get('radius', type=float)
+    except ValueError:
+        return jsonify({'error': 'Invalid data'}), 400
+    
+    per_page = current_app.config['ITEMS_PER_PAGE']
+    hits = search_donations(
+        search_query,
+        category=category,
+        lat=lat,
+        lng=lng,
+        radius_km=radius,
+        distance_scale_km=current_app.config['SEARCH_DISTANCE_SCALE_KM'],
+        limit=per_page,
+        offset=(page - 1) * per_page
+    )
+    
+    donations = {d.id: d for d in Donation.query.filter(
+        Donation.id.in_([donation_id for donation_id, _ in hits])
+    )}
+    results = []
+    for donation_id, score in hits:
+        donation = donations[donation_id]
+        # The radius was applied in SQL, before the page was cut
+        distance = calculate_distance(lat, lng, donation.latitude, donation.longitude)
+        results.append({
+            'id': donation.id,
+            'item_name': donation.item_name,
+            'description': donation.description,
+            'category': donation.category,
+            'quantity': donation.quantity,
+            'expiry_date': donation.expiry_date.isoformat(),
+            'distance': round(distance, 2) if distance is not None else None,
+            'score': score
+        })
+    
+    return jsonify({
+        'query': search_query,
+        'page': page,
+        'results': results,
+        'facets': {
+            'category': search_facets(
+                search_query,
+                category=category,
+                lat=lat,
+                lng=lng,
+                radius_km=radius
+            )
+        }
+    })
+
+@main.route('/user/location', methods=['POST'])
 @login_required
 def set_location():
-    """Save user's location"""
+    """Save user's location, from browser coordinates or a typed address"""
     data = request.get_json()
     
-    if not data or 'lat' not in data or 'lng' not in data:
+    if not data or not data.get('address') and ('lat' not in data or 'lng' not in data):
         return jsonify({'error': 'Invalid data'}), 400
     
+    location = None
+    if data.get('address'):
+        location = geocode_address(str(data['address']))
+        if location is None:
+            return jsonify({'error': 'Address not found. Try adding the postcode.'}), 400
+    
     try:
-        current_user.latitude = float(data['lat'])
-        current_user.longitude = float(data['lng'])
-        db.session.commit()
+        # Coalesced with this user's other updates (see writebehind.py)
+        if location:
+            write_user(current_user, address=str(data['address']).strip()[:255],
+                       latitude=location[0], longitude=location[1])
+        else:
+            write_user(current_user, latitude=float(data['lat']), longitude=float(data['lng']))
         return jsonify({'success': True, 'message': 'Location saved!'})
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Set location error: {str(e)}")
+        current_app.logger.error(f"Set location error: {str(e)}")
         return jsonify({'error': 'Failed to save location'}), 500
 
-@app.route('/about')
+@main.route('/about')
+@cached_page
+@read_only
 def about():
     """About page"""
     return render_template('about.html')
 
-@app.errorhandler(404)
+@main.app_errorhandler(404)
 def not_found_error(error):
     """Handle 404 errors"""
     return render_template('404.html'), 404
 
-@app.errorhandler(500)
+@main.app_errorhandler(500)
 def internal_error(error):
     """Handle 500 errors"""
     db.session.rollback()
     return render_template('500.html'), 500
 
 # Context processors
-@app.context_processor
+@main.app_context_processor
 def utility_processor():
     """Add utility functions to templates"""
     def format_date(date):
@@ -355,13 +905,20 @@ def utility_processor():
             return date.strftime('%Y-%m-%d')
         return ''
     
+    # Computed once per render instead of once per card
+    today = datetime.now().date()
+    
     def days_until_expiry(expiry_date):
         if expiry_date:
-            delta = expiry_date - datetime.now().date()
+            delta = expiry_date - today
             return delta.days
         return None
     
-    return dict(format_date=format_date, days_until_expiry=days_until_expiry)
+    return dict(format_date=format_date, days_until_expiry=days_until_expiry,
+                thumbnail_url=thumbnail_url)
 
 if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        init_db()
     app.run(debug=True)
\ No newline at end of file
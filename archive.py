@@ -0,0 +1,143 @@
+"""
+Hot/cold archival for Food Rescue App
+Completed and expired donations older than ARCHIVE_AFTER_DAYS move from the
+donation table to donation_archive (on the same shard), so the live table
+and its indexes only hold donations still in play. Each batch is copied and
+deleted in its own short transaction, so writers are never blocked for long.
+History views read both tables through donation_history().
+"""
+import time
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from models import db, ArchivedDonation, Donation
+from sharding import shard_ids
+
+ARCHIVE_STATUSES = ('completed', 'expired')
+
+
+def donation_history(columns, **filters):
+    """
+    Rows of live and archived donations matching filters (as for
+    filter_by), newest first. columns are Donation columns and must
+    include id and created_at.
+    """
+    live = sa.select(*columns).filter_by(**filters)
+    archived = sa.select(*(getattr(ArchivedDonation, column.key) for column in columns)).filter_by(**filters)
+    statement = sa.union_all(live, archived).order_by(sa.desc('created_at'), sa.desc('id'))
+
+    shards = shard_ids()
+    rows = []
+    for shard in shards:
+        rows.extend(db.session.execute(statement, bind_arguments={'shard_id': shard}))
+    if len(shards) > 1:
+        rows.sort(key=lambda row: (row.created_at is not None, row.created_at, row.id), reverse=True)
+    return rows
+
+
+def archive_donations(older_than_days=None, batch_size=None, pause=0.0):
+    """
+    Move finished donations created more than older_than_days ago to the
+    archive, checking batch_size rows per transaction and sleeping pause
+    seconds between batches. Safe to interrupt and re-run.
+    Returns {shard: donations archived}.
+    """
+    config = current_app.config
+    older_than_days = config.get('ARCHIVE_AFTER_DAYS', 30) if older_than_days is None else older_than_days
+    batch_size = batch_size or config.get('ARCHIVE_BATCH_SIZE', 500)
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+
+    live, archive = Donation.__table__, ArchivedDonation.__table__
+    finished = [live.c.status.in_(ARCHIVE_STATUSES), live.c.created_at < cutoff]
+    names = [column.name for column in live.columns]
+
+    moved = {}
+    for shard, engine in current_app.extensions['shards'].engines.items():
+        moved[shard] = 0
+        last_id = 0
+        while True:
+            with engine.begin() as conn:
+                # Walk the primary key in windows: every batch costs the same
+                # however large the table, where filtering on status would
+                # re-sort all finished rows each time
+                rows = conn.execute(
+                    sa.select(live.c.id, live.c.status, live.c.created_at)
+                    .where(live.c.id > last_id)
+                    .order_by(live.c.id).limit(batch_size)
+                ).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                ids = [row.id for row in rows if row.status in ARCHIVE_STATUSES
+                       and row.created_at is not None and row.created_at < cutoff]
+                if not ids:
+                    continue
+                # Criteria are checked again inside the write, against rows changed since the SELECT
+                batch = [live.c.id.in_(ids), *finished]
+                conn.execute(archive.insert().from_select(
+                    names + ['archived_at'],
+                    sa.select(*live.columns, sa.literal(datetime.utcnow(), sa.DateTime)).where(*batch)
+                ))
+                moved[shard] += conn.execute(live.delete().where(*batch)).rowcount
+            if pause:
+                time.sleep(pause)
+    return moved
+
+
+def table_bytes(conn, table):
+    """Bytes in a table and its indexes, or None without SQLite's dbstat"""
+    try:
+        return conn.execute(text(
+            "SELECT SUM(pgsize) FROM dbstat WHERE name = :table OR name IN "
+            "(SELECT name FROM sqlite_schema WHERE type = 'index' AND tbl_name = :table)"
+        ), {'table': table}).scalar()
+    except sa.exc.OperationalError:
+        return None
+
+
+def archive_status():
+    """{shard: (live rows, live bytes, archived rows, archive bytes)}"""
+    status = {}
+    for shard, engine in current_app.extensions['shards'].engines.items():
+        with engine.connect() as conn:
+            status[shard] = tuple(
+                value
+                for table in (Donation.__table__, ArchivedDonation.__table__)
+                for value in (
+                    conn.execute(sa.select(sa.func.count()).select_from(table)).scalar(),
+                    table_bytes(conn, table.name),
+                )
+            )
+    return status
+
+
+@click.group('archive')
+def archive_command():
+    """Move finished donations out of the live table"""
+
+
+@archive_command.command('run')
+@click.option('--older-than-days', type=int, help='Defaults to ARCHIVE_AFTER_DAYS')
+@click.option('--batch-size', type=int, help='Defaults to ARCHIVE_BATCH_SIZE')
+@click.option('--pause', default=0.05, show_default=True, help='Seconds to wait between batches')
+@with_appcontext
+def archive_run(older_than_days, batch_size, pause):
+    """Archive completed and expired donations"""
+    for shard, total in archive_donations(older_than_days, batch_size, pause).items():
+        click.echo(f'{shard:<20} {total:>10} donations archived')
+
+
+@archive_command.command('status')
+@with_appcontext
+def archive_show_status():
+    """Show live and archived donation counts and sizes per shard"""
+    def size(value):
+        return f'{value / 1e6:8.1f} MB' if value is not None else '       ? MB'
+
+    for shard, (live, live_bytes, archived, archive_bytes) in archive_status().items():
+        click.echo(f'{shard:<20} live {live:>10} {size(live_bytes)}   archived {archived:>10} {size(archive_bytes)}')
@@ -0,0 +1,1027 @@
+"""
+Benchmark Script - Measure hot paths against a throwaway database
+Usage: python benchmark.py <scenario> [options]
+Never touches database/foodapp.db.
+"""
+import argparse
+import io
+import os
+import smtplib
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+# Point the app at a scratch database before it is imported
+_tmpdir = tempfile.mkdtemp(prefix='foodapp-bench-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'bench.db')
+# Scenarios hammer write endpoints far beyond any real client's rate
+os.environ.setdefault('RATE_LIMIT_STORAGE', 'off')
+os.environ['PROFILE_DIR'] = os.path.join(_tmpdir, 'profiles')
+# Idle job workers poll the database, which would show up in statement counts
+os.environ.setdefault('JOB_WORKERS', '0')
+os.environ['UPLOAD_FOLDER'] = os.path.join(_tmpdir, 'uploads')
+
+from app import create_app, init_db, calculate_distance, filter_donations
+from models import db
+from models import User, Donation, Notification
+from search import search_donations, search_facets
+from ratelimit import TokenBuckets
+from readmodel import current_read_model
+from geocoder import Geocoder, backfill_locations, normalize
+from archive import archive_donations, table_bytes
+from ranking import FeedRanker
+from profiling import merge_profiles, write_settings
+from jobs import JobRunner, enqueue, job, queue_depth
+from notifications import SMTPPool, build_digests, collect_notifications, send_due_digests
+from photos import make_thumbnail, photo_path, thumbnail_pool
+from writebehind import init_user_writes
+from flask import Request
+from werkzeug.test import EnvironBuilder
+from sqlalchemy import event
+
+app = create_app()
+
+
+def create_user(role, email):
+    """Insert a user without paying for password hashing"""
+    with app.app_context():
+        user = User(
+            role=role,
+            name='Bench',
+            surname='User',
+            company_name='Bench Foods' if role == 'company' else None,
+            email=email,
+            password_hash='!',
+            latitude=48.8566,
+            longitude=2.3522
+        )
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def create_donations(company_id, count, **fields):
+    """Insert donations for a company and return their ids"""
+    expiry = datetime.now().date() + timedelta(days=5)
+    with app.app_context():
+        donations = [
+            Donation(
+                item_name=f'Item {i}',
+                category='bakery',
+                expiry_date=expiry,
+                quantity=10,
+                company_id=company_id,
+                latitude=48.8566,
+                longitude=2.3522,
+                **fields
+            )
+            for i in range(count)
+        ]
+        db.session.add_all(donations)
+        db.session.commit()
+        return [d.id for d in donations]
+
+
+def logged_in_client(user_id):
+    """Return a test client with a Flask-Login session for the user"""
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+    return client
+
+
+def report(label, count, elapsed):
+    print(f"  {label:<28} {elapsed * 1000:9.1f} ms total  "
+          f"{elapsed * 1e6 / count:9.1f} us/item  {count / elapsed:9.0f} items/s")
+
+
+def bench_batch(args):
+    """Per-item /donation/<id>/<action> calls vs one /donations/batch call"""
+    with app.app_context():
+        init_db()
+    company_id = create_user('company', 'bench-company@example.com')
+    volunteer_id = create_user('volunteer', 'bench-volunteer@example.com')
+    company = logged_in_client(company_id)
+    volunteer = logged_in_client(volunteer_id)
+
+    print(f"Batch vs per-item, {args.n} donations x {args.rounds} rounds")
+    for action, client in (('claim', volunteer), ('complete', volunteer), ('delete', company)):
+        fields = {'status': 'claimed', 'volunteer_id': volunteer_id} if action == 'complete' else {}
+        per_item = batched = 0.0
+        for _ in range(args.rounds):
+            ids = create_donations(company_id, args.n, **fields)
+            start = time.perf_counter()
+            for donation_id in ids:
+                client.post(f'/donation/{donation_id}/{action}')
+            per_item += time.perf_counter() - start
+
+            ids = create_donations(company_id, args.n, **fields)
+            start = time.perf_counter()
+            response = client.post('/donations/batch', json={'action': action, 'ids': ids})
+            batched += time.perf_counter() - start
+            assert response.get_json()['processed'] == len(ids), response.get_json()
+        total = args.n * args.rounds
+        report(f'{action} per-item', total, per_item)
+        report(f'{action} batch', total, batched)
+        print(f"  {action} speedup: {per_item / batched:.1f}x")
+
+
+WORDS = ['bread', 'baguette', 'croissant', 'yoghurt', 'milk', 'cheese', 'apple',
+         'banana', 'tomato', 'carrot', 'chicken', 'salmon', 'rice', 'pasta',
+         'soup', 'juice', 'crisps', 'pizza', 'salad', 'cake']
+CATEGORIES = ['bakery', 'dairy', 'fruits', 'vegetables', 'meat', 'seafood',
+              'grains', 'canned', 'frozen', 'beverages', 'snacks', 'other']
+
+
+def insert_history(company_id, count, available_ratio=0.02):
+    """Bulk insert mostly historical donations with a small available set"""
+    import random
+    rng = random.Random(42)
+    today = datetime.now().date()
+    table = Donation.__table__
+    with app.app_context():
+        for start in range(0, count, 10000):
+            db.session.execute(table.insert(), [
+                {
+                    'item_name': f'{rng.choice(WORDS)} {rng.choice(WORDS)}',
+                    'description': ' '.join(rng.choices(WORDS, k=4)),
+                    'category': rng.choice(CATEGORIES),
+                    'expiry_date': today + timedelta(days=rng.randint(-300, 10)),
+                    'quantity': rng.randint(1, 50),
+                    'status': 'available' if rng.random() < available_ratio else 'completed',
+                    'latitude': 48.8566 + rng.uniform(-0.2, 0.2),
+                    'longitude': 2.3522 + rng.uniform(-0.3, 0.3),
+                    'created_at': datetime.utcnow(),
+                    'company_id': company_id
+                }
+                for _ in range(min(10000, count - start))
+            ])
+        db.session.commit()
+
+
+def bench_search(args):
+    """Full-text search latency over a large donation history"""
+    with app.app_context():
+        init_db()
+    company_id = create_user('company', 'bench-company@example.com')
+    start = time.perf_counter()
+    insert_history(company_id, args.n)
+    print(f"Inserted {args.n} donations (FTS triggers on) in {time.perf_counter() - start:.1f}s")
+
+    with app.app_context():
+        for label, kwargs in (
+            ('text only', {}),
+            ('text + distance', {'lat': 48.86, 'lng': 2.35}),
+            ('text + radius 5km', {'lat': 48.86, 'lng': 2.35, 'radius_km': 5}),
+            ('text + category', {'category': 'bakery'}),
+        ):
+            queries = args.rounds * len(WORDS)
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                for word in WORDS:
+                    search_donations(word, **kwargs)
+            report(f'search {label}', queries, time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for word in WORDS:
+                search_facets(word)
+        report('facets', args.rounds * len(WORDS), time.perf_counter() - start)
+
+
+STARTUP_PROBE = """
+import os, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+with application.app_context():
+    app.init_db()
+initialized = time.perf_counter()
+application.test_client().get('/about')
+served = time.perf_counter()
+
+# Preload-then-fork: a child forked from this process starts with everything loaded
+read_fd, write_fd = os.pipe()
+forked = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    application.test_client().get('/about')
+    os.write(write_fd, str(time.perf_counter() - forked).encode())
+    os._exit(0)
+os.waitpid(pid, 0)
+child = float(os.read(read_fd, 64))
+print(imported - start, created - imported, initialized - created, served - start, child)
+"""
+
+
+def bench_startup(args):
+    """Cold import, app factory and schema setup cost in fresh interpreters"""
+    samples = []
+    for _ in range(args.rounds):
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_PROBE],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=os.environ, capture_output=True, text=True, check=True
+        ).stdout
+        samples.append([float(value) for value in output.split()])
+
+    print(f"Worker startup, median of {args.rounds} fresh interpreters")
+    for i, label in enumerate(('import app', 'create_app()', 'init_db()',
+                               'cold worker to 1st response', 'forked worker to 1st response')):
+        print(f"  {label:<30} {statistics.median(s[i] for s in samples) * 1000:9.1f} ms")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+def bench_mixed(args):
+    """Concurrent dashboard reads and claim writes under each read routing mode"""
+    if args.routing is None:
+        # Routing is configured from the environment, so run each mode in its own process
+        for mode in ('off', 'readonly', 'snapshot'):
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), 'mixed', '-n', str(args.n),
+                 '--rounds', str(args.rounds), '--routing', mode],
+                env=dict(os.environ, DATABASE_READ_ROUTING=mode), check=True
+            )
+        return
+
+    with app.app_context():
+        init_db()
+    company_id = create_user('company', 'bench-company@example.com')
+    insert_history(company_id, args.n, available_ratio=0.5)
+    volunteer_ids = [create_user('volunteer', f'bench-volunteer{i}@example.com') for i in range(8)]
+    with app.app_context():
+        claimable = [d.id for d in Donation.query.with_entities(Donation.id).filter_by(status='available')]
+
+    readers, writers, duration = 6, 2, float(args.rounds)
+    latencies = {'read': [], 'write': []}
+    errors = {'read': 0, 'write': 0}
+    stop = time.perf_counter() + duration
+    lock = threading.Lock()
+
+    def reader(user_id):
+        client = logged_in_client(user_id)
+        page = 0
+        while time.perf_counter() < stop:
+            page = page % 20 + 1
+            start = time.perf_counter()
+            response = client.get(f'/donations/available?page={page}')
+            with lock:
+                latencies['read'].append(time.perf_counter() - start)
+                errors['read'] += response.status_code >= 500
+
+    def writer(user_id, ids):
+        client = logged_in_client(user_id)
+        for donation_id in ids:
+            if time.perf_counter() >= stop:
+                break
+            start = time.perf_counter()
+            response = client.post(f'/donation/{donation_id}/claim')
+            with lock:
+                latencies['write'].append(time.perf_counter() - start)
+                errors['write'] += response.status_code >= 500
+
+    threads = [threading.Thread(target=reader, args=(volunteer_ids[i],)) for i in range(readers)]
+    threads += [threading.Thread(target=writer, args=(volunteer_ids[readers + i], claimable[i::writers]))
+                for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(f"Mixed load, routing={args.routing}: {readers} readers + {writers} writers for {duration:.0f}s "
+          f"over {args.n} donations")
+    for kind in ('read', 'write'):
+        values = latencies[kind]
+        print(f"  {kind + 's':<8} {len(values) / duration:8.0f} ops/s  "
+              f"p50 {percentile(values, 0.5) * 1000:7.1f} ms  p95 {percentile(values, 0.95) * 1000:7.1f} ms  "
+              f"errors {errors[kind]}")
+
+
+def bench_ratelimit(args):
+    """Cost of a token-bucket check, and of a request rejected with 429"""
+    if os.environ['RATE_LIMIT_STORAGE'] == 'off':
+        # Limits are configured from the environment, so rerun with them on
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), 'ratelimit', '-n', str(args.n),
+             '--rounds', str(args.rounds)],
+            env=dict(os.environ, RATE_LIMIT_STORAGE='shared'), check=True
+        )
+        return
+    
+    print(f"Rate limiting, {args.n} checks x {args.rounds} rounds")
+    calls = args.n * args.rounds
+    for label, shared in (('memory', False), ('shared', True)):
+        buckets = TokenBuckets(65536, shared=shared)
+        start = time.perf_counter()
+        for i in range(calls):
+            buckets.take(f'main.claim_donation|user:{i % 1000}', 30, 0.5)
+        report(f'take() {label}', calls, time.perf_counter() - start)
+    
+    with app.app_context():
+        init_db()
+    user_id = create_user('volunteer', 'bench-volunteer@example.com')
+    client = logged_in_client(user_id)
+    timings = {}
+    for i in range(calls):
+        start = time.perf_counter()
+        response = client.post('/user/location', json={'lat': 48.85, 'lng': 2.35})
+        timings.setdefault(response.status_code, []).append(time.perf_counter() - start)
+    for status, values in sorted(timings.items()):
+        report(f'POST /user/location -> {status}', len(values), sum(values))
+    start = time.perf_counter()
+    for _ in range(calls):
+        client.get('/about')
+    report('GET /about (unlimited)', calls, time.perf_counter() - start)
+
+
+def bench_readmodel(args):
+    """Available donations from the in-memory read model against SQL + ORM objects"""
+    with app.app_context():
+        init_db()
+    company_id = create_user('company', 'bench-company@example.com')
+    insert_history(company_id, args.n * 100, available_ratio=0.25)
+    lat, lng = 48.85, 2.35
+    filters = [(None, None), ('high', None), (None, 'bakery'), ('medium', 'dairy')]
+    
+    with app.test_request_context():
+        tracemalloc.start()
+        donations = Donation.query.filter_by(status='available').all()
+        orm_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        count = len(donations)
+        del donations
+        db.session.expunge_all()
+        
+        start = time.perf_counter()
+        model = current_read_model()
+        build = time.perf_counter() - start
+        print(f"Read model, {count} available of {args.n * 100} donations "
+              f"(built in {build * 1000:.0f} ms)")
+        print(f"  ORM objects {orm_bytes / count:8.0f} bytes/donation")
+        print(f"  read model  {model.memory_bytes() / len(model):8.0f} bytes/donation")
+        
+        calls = args.rounds * len(filters)
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for urgency, category in filters:
+                rows = filter_donations(Donation.query.filter_by(status='available'), urgency, category) \
+                    .order_by(Donation.created_at.desc()) \
+                    .with_entities(Donation.id, Donation.latitude, Donation.longitude).all()
+                rows.sort(key=lambda r: calculate_distance(lat, lng, r.latitude, r.longitude) or float('inf'))
+                Donation.facet_counts(Donation.query.filter_by(status='available'), urgency, category)
+        report('SQL nearest + facets', calls, time.perf_counter() - start)
+        
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for urgency, category in filters:
+                model.query(lat, lng, urgency, category)
+                model.facet_counts(urgency, category)
+        report('model nearest + facets', calls, time.perf_counter() - start)
+        
+        start = time.perf_counter()
+        for _ in range(calls):
+            model.query(urgency='high', order='expiry', limit=12, offset=24)
+        report('model expiry page', calls, time.perf_counter() - start)
+        
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for urgency, category in filters:
+                model.query(lat, lng, urgency, category)
+        report('model nearest, all', calls, time.perf_counter() - start)
+        
+        ranker = FeedRanker.from_config(app.config, datetime.now().date())
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for urgency, category in filters:
+                model.ranked(ranker, lat, lng, limit=app.config['FEED_SIZE'],
+                             radius_km=app.config['FEED_RADIUS_KM'], urgency=urgency, category=category)
+        report(f"model feed, top {app.config['FEED_SIZE']}", calls, time.perf_counter() - start)
+        
+        volunteer = logged_in_client(create_user('volunteer', 'bench-volunteer@example.com'))
+        for url in ('/dashboard/volunteer?sort=distance', '/dashboard/volunteer'):
+            volunteer.get(url)
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                volunteer.get(url)
+            report(url, args.rounds, time.perf_counter() - start)
+        
+        ids = [row.id for row in Donation.query.with_entities(Donation.id).limit(args.n)]
+        Donation.query.filter(Donation.id.in_(ids)).update({'status': 'claimed'}, synchronize_session=False)
+        db.session.commit()
+        start = time.perf_counter()
+        model.sync()
+        report(f'sync after {len(ids)} writes', len(ids), time.perf_counter() - start)
+
+
+def write_gazetteer(path, count):
+    """Synthetic GeoNames postal code file: French-style codes with place names"""
+    import random
+    rng = random.Random(42)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(count):
+            place = f'{rng.choice(WORDS).title()}-sur-{rng.choice(WORDS).title()} {i % 5000}'
+            f.write(f'FR\t{10000 + i:05d}\t{place}\tRegion\t11\t\t\t\t\t'
+                    f'{rng.uniform(42, 51):.4f}\t{rng.uniform(-4, 8):.4f}\t5\n')
+
+
+def bench_geocode(args):
+    """Gazetteer index size and address lookups, cached and uncached"""
+    path = os.path.join(_tmpdir, 'gazetteer.txt')
+    write_gazetteer(path, args.n * 500)
+    
+    start = time.perf_counter()
+    geocoder = Geocoder.load(path)
+    load = time.perf_counter() - start
+    
+    # The same entries as a plain {key: (lat, lng)} dict, for comparison
+    tracemalloc.start()
+    as_dict = {geocoder.postcodes.key(i): (float(geocoder.postcodes.lats[i]), float(geocoder.postcodes.lngs[i]))
+               for i in range(len(geocoder.postcodes))}
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"Geocoder, {len(geocoder)} keys (loaded in {load * 1000:.0f} ms)")
+    print(f"  prefix index {geocoder.postcodes.memory_bytes() / len(geocoder.postcodes):6.1f} bytes/postcode")
+    print(f"  dict         {dict_bytes / len(as_dict):6.1f} bytes/postcode")
+    del as_dict
+    
+    import random
+    rng = random.Random(7)
+    keys = [geocoder.postcodes.key(rng.randrange(len(geocoder.postcodes))) for _ in range(args.n * 10)]
+    places = [geocoder.places.key(rng.randrange(len(geocoder.places))) for _ in range(args.n * 10)]
+    addresses = (
+        [f'{i} rue {rng.choice(WORDS)}, {key} France' for i, key in enumerate(keys)]
+        + [f'{i} avenue {rng.choice(WORDS)}, {place.title()}' for i, place in enumerate(places)]
+    )
+    start = time.perf_counter()
+    found = sum(geocoder.resolve(normalize(address)) is not None for address in addresses)
+    report(f'uncached ({found} found)', len(addresses), time.perf_counter() - start)
+    for address in addresses:
+        geocoder.geocode(address)
+    start = time.perf_counter()
+    for address in addresses:
+        geocoder.geocode(address)
+    report('cached', len(addresses), time.perf_counter() - start)
+    
+    app.config['GEOCODER_GAZETTEER'] = path
+    with app.app_context():
+        init_db()
+        db.session.execute(User.__table__.insert(), [
+            {'role': 'company', 'name': 'Bench', 'email': f'geo{i}@example.com',
+             'password_hash': 'x', 'address': address}
+            for i, address in enumerate(addresses)
+        ])
+        db.session.commit()
+        app.extensions['geocoder'] = geocoder
+        start = time.perf_counter()
+        updated, missing = backfill_locations()
+        report(f'backfill ({updated} located)', len(addresses), time.perf_counter() - start)
+
+
+def bench_archive(args):
+    """Live table size and page latency before and after archiving history"""
+    with app.app_context():
+        init_db()
+    history_id = create_user('company', 'bench-history@example.com')
+    company_id = create_user('company', 'bench-company@example.com')
+    volunteer_id = create_user('volunteer', 'bench-volunteer@example.com')
+    insert_history(history_id, args.n * 1000)
+    create_donations(company_id, 20)
+    create_donations(company_id, 10, status='claimed', volunteer_id=volunteer_id)
+    
+    pages = [
+        ('/dashboard/company', logged_in_client(company_id), True),
+        ('/dashboard/volunteer', logged_in_client(volunteer_id), True),
+        ('/donations/available', logged_in_client(volunteer_id), False),
+        ('/', app.test_client(), True),
+    ]
+    
+    def measure(label):
+        with app.app_context(), db.engine.connect() as conn:
+            size = table_bytes(conn, 'donation')
+            rows = conn.execute(db.select(db.func.count()).select_from(Donation.__table__)).scalar()
+        print(f"{label}: donation table {rows} rows, {size / 1e6:.1f} MB with indexes")
+        for url, client, read_model in pages:
+            app.config['AVAILABLE_READ_MODEL'] = read_model
+            client.get(url)
+            timings = []
+            for _ in range(args.rounds * 5):
+                start = time.perf_counter()
+                client.get(url)
+                timings.append(time.perf_counter() - start)
+            suffix = '' if read_model else ' (SQL)'
+            print(f"  {url + suffix:<30} median {statistics.median(timings) * 1000:7.2f} ms")
+        app.config['AVAILABLE_READ_MODEL'] = True
+    
+    measure('Before')
+    with app.app_context():
+        start = time.perf_counter()
+        moved = sum(archive_donations(older_than_days=0).values())
+        elapsed = time.perf_counter() - start
+    report('archive', moved, elapsed)
+    measure('After')
+
+
+def bench_profile(args):
+    """Request cost with profiling off, sampling and cProfile, then the merged output"""
+    with app.app_context():
+        init_db()
+    company_id = create_user('company', 'bench-company@example.com')
+    volunteer_id = create_user('volunteer', 'bench-volunteer@example.com')
+    create_donations(company_id, args.n)
+    client = logged_in_client(volunteer_id)
+    profiler = app.extensions['profiler']
+    url, endpoint = '/dashboard/volunteer', 'main.dashboard_volunteer'
+    client.get(url)
+    
+    print(f"{url} with {args.n} donations, {args.rounds * 20} requests per mode")
+    medians = {}
+    # A rate the dice never pick measures the cost of rolling them
+    for session, (label, endpoints, sample_rate, mode) in enumerate((
+            ('off', [], 0.0, 'sampling'),
+            ('sampled, not picked', [], 1e-12, 'sampling'),
+            ('sampling', [endpoint], 0.0, 'sampling'),
+            ('cprofile', [endpoint], 0.0, 'cprofile'))):
+        write_settings(profiler, {'endpoints': endpoints, 'sample_rate': sample_rate,
+                                  'mode': mode, 'session': session})
+        with app.app_context():
+            profiler.refresh()
+        timings = []
+        for _ in range(args.rounds * 20):
+            start = time.perf_counter()
+            client.get(url)
+            timings.append(time.perf_counter() - start)
+        medians[label] = statistics.median(timings)
+        overhead = (medians[label] / medians['off'] - 1) * 100
+        print(f"  {label:<22} median {medians[label] * 1000:7.2f} ms  ({overhead:+5.1f}%)")
+        if label == 'sampling':
+            with app.app_context():
+                profiler.flush()
+                totals = merge_profiles(profiler)[endpoint]
+            print(f"    {totals['requests']} requests, {totals['samples']} stack samples, "
+                  f"{totals['statements'] / totals['requests']:.1f} statements per request")
+            print(f"    {totals['files'][0]}")
+    
+    # What every request pays while profiling is off
+    write_settings(profiler, {'endpoints': [], 'sample_rate': 0.0, 'mode': 'sampling', 'session': None})
+    with app.app_context():
+        profiler.refresh()
+    count = args.rounds * 100000
+    start = time.perf_counter()
+    for _ in range(count):
+        profiler.wants(endpoint)
+    report('check, profiling off', count, time.perf_counter() - start)
+
+
+def bench_sync(args):
+    """Delta sync payloads and latency against full reloads, as the table grows"""
+    with app.app_context():
+        init_db()
+    company_id = create_user('company', 'bench-company@example.com')
+    volunteer_id = create_user('volunteer', 'bench-volunteer@example.com')
+    other_id = create_user('volunteer', 'bench-other@example.com')
+    volunteer, other = logged_in_client(volunteer_id), logged_in_client(other_id)
+    
+    def timed(url, **params):
+        volunteer.get(url, query_string=params)
+        timings = []
+        for _ in range(args.rounds * 10):
+            start = time.perf_counter()
+            response = volunteer.get(url, query_string=params)
+            timings.append(time.perf_counter() - start)
+        return len(response.get_data()), statistics.median(timings) * 1000
+    
+    created = 0
+    for total in (args.n * 10, args.n * 100):
+        create_donations(company_id, total - created)
+        create_donations(company_id, total // 50, status='claimed', volunteer_id=volunteer_id)
+        created = total
+        print(f"{total} available donations, {total // 50} claims per step")
+        version = volunteer.get('/donations/sync').get_json()['version']
+        for label, url, params in (('dashboard page', '/dashboard/volunteer', {}),
+                                   ('full sync', '/donations/sync', {}),
+                                   ('unchanged', '/donations/sync', {'since': version})):
+            size, median = timed(url, **params)
+            print(f"  {label:<28} {size / 1000:9.1f} kB  median {median:7.2f} ms")
+        
+        # Someone else claims a few donations and a company adds a few more
+        ids = [d['id'] for d in volunteer.get('/donations/sync').get_json()['available'][:10]]
+        for donation_id in ids:
+            other.post(f'/donation/{donation_id}/claim')
+        create_donations(company_id, 10)
+        created += 10
+        size, median = timed('/donations/sync', since=version)
+        print(f"  {'20 changes':<28} {size / 1000:9.1f} kB  median {median:7.2f} ms")
+
+
+BENCH_SIDE_EFFECT_SECONDS = 0.02
+
+
+@job('bench.side_effect', queue='bench')
+def bench_side_effect(donation_id):
+    """Stands in for a notification or cache call made after a write"""
+    time.sleep(BENCH_SIDE_EFFECT_SECONDS)
+
+
+def bench_jobs(args):
+    """Write latency with a side effect run inline vs enqueued, then job throughput and latency"""
+    with app.app_context():
+        init_db()
+    company_id = create_user('company', 'bench-company@example.com')
+    expiry = datetime.now().date() + timedelta(days=5)
+    
+    def write(side_effect):
+        with app.app_context():
+            donation = Donation(item_name='Bench', category='bakery', expiry_date=expiry,
+                                quantity=1, company_id=company_id)
+            db.session.add(donation)
+            db.session.flush()
+            side_effect(donation.id)
+            db.session.commit()
+    
+    count = args.n
+    print(f"{count} writes, each with a {BENCH_SIDE_EFFECT_SECONDS * 1000:.0f} ms side effect")
+    start = time.perf_counter()
+    for _ in range(count):
+        write(lambda donation_id: bench_side_effect(donation_id))
+    report('inline', count, time.perf_counter() - start)
+    
+    for workers in (1, 4):
+        runner = JobRunner(app, queues=['bench'], workers=workers)
+        app.extensions['jobs'] = runner
+        start = time.perf_counter()
+        for _ in range(count):
+            write(lambda donation_id: enqueue('bench.side_effect', donation_id=donation_id))
+        report(f'enqueued, {workers} workers', count, time.perf_counter() - start)
+        while True:
+            with app.app_context():
+                depth = queue_depth()
+            if not depth:
+                break
+            time.sleep(0.05)
+        drained = time.perf_counter() - start
+        runner.drain()
+        stats = runner.metrics.snapshot()['bench.side_effect']
+        print(f"    all done after {drained * 1000:.0f} ms ({count / drained:.0f} jobs/s), "
+              f"wait p50/p95 {stats['wait_ms'][0]}/{stats['wait_ms'][1]} ms")
+
+
+class StandInSMTPHandler(socketserver.BaseRequestHandler):
+    """
+    Just enough SMTP to accept mail, advertising PIPELINING. Every read
+    waits server.latency first, like a network round trip.
+    """
+    
+    def handle(self):
+        server = self.server
+        send = self.request.sendall
+        send(b'220 bench ESMTP\r\n')
+        buffer, in_data = b'', False
+        while True:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                return
+            buffer += chunk
+            time.sleep(server.latency)
+            replies = []
+            while True:
+                if in_data:
+                    end = buffer.find(b'\r\n.\r\n')
+                    if end < 0:
+                        break
+                    buffer, in_data = buffer[end + 5:], False
+                    with server.lock:
+                        server.messages += 1
+                    replies.append(b'250 OK')
+                    continue
+                line, found, buffer_rest = buffer.partition(b'\r\n')
+                if not found:
+                    break
+                buffer = buffer_rest
+                verb = line[:4].upper()
+                if verb == b'EHLO':
+                    replies.append(b'250-bench\r\n250-PIPELINING\r\n250 8BITMIME')
+                elif verb == b'DATA':
+                    in_data = True
+                    replies.append(b'354 End data with <CR><LF>.<CR><LF>')
+                elif verb == b'QUIT':
+                    send(b'221 Bye\r\n')
+                    return
+                else:
+                    replies.append(b'250 OK')
+            if replies:
+                send(b''.join(reply + b'\r\n' for reply in replies))
+
+
+def start_smtp_server(latency):
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StandInSMTPHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.messages = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_mail(args):
+    """Notification digests sent to a stand-in SMTP server: per-message connections vs pooled and pipelined"""
+    with app.app_context():
+        init_db()
+    latency = args.latency_ms / 1000
+    server = start_smtp_server(latency)
+    host, port = server.server_address
+    app.config.update(MAIL_SERVER=host, MAIL_PORT=port, MAIL_USE_TLS=False, MAIL_USERNAME=None,
+                      NOTIFY_DIGEST_MINUTES=0, NOTIFY_BATCH_SIZE=1000)
+    
+    company_id = create_user('company', 'bench-company@example.com')
+    for i in range(args.n):
+        create_user('volunteer', f'bench-volunteer{i}@example.com')
+    create_donations(company_id, 5)
+    
+    with app.app_context():
+        collected = collect_notifications()
+        rows = db.session.execute(db.select(
+            Notification.user_id, Notification.donation_id, Notification.kind, Notification.created_at
+        )).all()
+        messages = list(build_digests(rows).values())
+    print(f"{collected} notifications for {args.n} volunteers coalesced into {len(messages)} digests, "
+          f"{args.latency_ms} ms SMTP round trip")
+    
+    start = time.perf_counter()
+    for message in messages:
+        with smtplib.SMTP(host, port) as connection:
+            connection.send_message(message)
+    report('connection per message', len(messages), time.perf_counter() - start)
+    
+    with app.app_context():
+        pool = SMTPPool(app)
+    for label, pipelining in (('pooled', False), ('pooled, pipelined', True)):
+        pool.pipelining = pipelining
+        start = time.perf_counter()
+        failed = pool.send_many(messages)
+        report(label, len(messages), time.perf_counter() - start)
+        assert not failed, failed
+    pool.close()
+    
+    # The whole pipeline: claim, build and send every due digest
+    with app.app_context():
+        start = time.perf_counter()
+        sent, failed, _ = send_due_digests()
+        report('send_due_digests', sent, time.perf_counter() - start)
+    print(f"  stand-in server received {server.messages} messages")
+    server.shutdown()
+
+
+class BufferedRequest(Request):
+    """Request that keeps uploaded files in memory, for comparison with photos.UploadRequest"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
+def bench_photos(args):
+    """Photo uploads: request time and peak memory, streamed vs buffered, and thumbnail throughput"""
+    with app.app_context():
+        init_db()
+    app.config['WTF_CSRF_ENABLED'] = False
+    company = logged_in_client(create_user('company', 'bench-company@example.com'))
+    expiry = (datetime.now().date() + timedelta(days=5)).isoformat()
+
+    for megabytes in (1, 8):
+        # The body is read from a file, so the client itself holds none of it in memory
+        photo = b'\xff\xd8\xff\xe0' + os.urandom(megabytes * 1024 * 1024)
+        fields = {'item_name': 'Bench bread', 'category': 'bakery', 'expiry_date': expiry, 'quantity': '3'}
+        environ = EnvironBuilder(method='POST', data={**fields, 'photo': (io.BytesIO(photo), 'photo.jpg')}).get_environ()
+        body_path = os.path.join(_tmpdir, 'upload.body')
+        with open(body_path, 'wb') as f:
+            f.write(environ['wsgi.input'].read())
+        headers = {'Content-Type': environ['CONTENT_TYPE'], 'Content-Length': str(os.path.getsize(body_path))}
+        del photo
+        print(f"{megabytes} MB photo")
+
+        for label, request_class in (('buffered', BufferedRequest), ('streamed', app.request_class)):
+            app.request_class, default = request_class, app.request_class
+            timings, peaks = [], []
+            for _ in range(args.rounds):
+                with open(body_path, 'rb') as stream:
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    response = company.post('/donation/add', input_stream=stream, headers=headers)
+                    timings.append(time.perf_counter() - start)
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                    tracemalloc.stop()
+                assert response.status_code == 302, response.status_code
+            app.request_class = default
+            print(f"  {label:<28} median {statistics.median(timings) * 1000:7.1f} ms  "
+                  f"peak {max(peaks) / 1e6:6.1f} MB allocated")
+
+    with app.app_context():
+        stored = len(set(db.session.execute(db.select(Donation.photo)).scalars()))
+        photos = db.session.query(Donation).filter(Donation.photo.isnot(None)).count()
+    print(f"  {photos} donations with photos share {stored} stored files")
+
+    try:
+        from PIL import Image
+    except ImportError:
+        print("Pillow is not installed: thumbnails skipped")
+        return
+    with app.app_context():
+        sources = []
+        for i in range(args.n // 10 or 1):
+            path = photo_path('original', f'{i:064x}.jpg')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Image.effect_noise((2400, 1800), 40 + i % 20).convert('RGB').save(path, 'JPEG', quality=90)
+            sources.append(path)
+        px, quality = app.config['PHOTO_THUMBNAIL_PX'], app.config['PHOTO_THUMBNAIL_QUALITY']
+
+        start = time.perf_counter()
+        for i, source in enumerate(sources):
+            make_thumbnail(source, os.path.join(_tmpdir, f'serial{i}.jpg'), px, quality)
+        report('thumbnails, in process', len(sources), time.perf_counter() - start)
+
+        pool = thumbnail_pool()
+        pool.submit(os.getpid).result()  # Start the worker processes outside the timing
+        start = time.perf_counter()
+        futures = [pool.submit(make_thumbnail, source, os.path.join(_tmpdir, f'pooled{i}.jpg'), px, quality)
+                   for i, source in enumerate(sources)]
+        for future in futures:
+            future.result()
+        report(f"thumbnails, {app.config['PHOTO_THUMBNAIL_PROCESSES']} processes", len(sources),
+               time.perf_counter() - start)
+
+
+def bench_pages(args):
+    """Anonymous home and about page throughput with the page cache off and on"""
+    with app.app_context():
+        init_db()
+    company_id = create_user('company', 'bench-company@example.com')
+    insert_history(company_id, args.n * 100)
+    anonymous = app.test_client()
+    requests = args.rounds * 100
+    print(f"{args.n * 100} donations, {requests} anonymous requests per page")
+
+    for label, size in (('uncached', 0), ('cached', app.config['PAGE_CACHE_SIZE'] or 64)):
+        app.config['PAGE_CACHE_SIZE'] = size
+        app.extensions.pop('page_cache', None)
+        for url in ('/', '/about'):
+            anonymous.get(url)
+            _, statements = count_statements(anonymous, url)
+            start = time.perf_counter()
+            for _ in range(requests):
+                response = anonymous.get(url)
+            assert response.status_code == 200, response.status_code
+            report(f'{label} {url} ({statements} SQL)', requests, time.perf_counter() - start)
+
+    etag = anonymous.get('/').headers['ETag']
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = anonymous.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 304, response.status_code
+    report('revalidated / (304)', requests, time.perf_counter() - start)
+
+    # A write anywhere bumps the data version: the next request renders again
+    create_donations(company_id, 1)
+    print(f"  after a write: {count_statements(anonymous, '/')[1]} SQL, "
+          f"then {count_statements(anonymous, '/')[1]} SQL")
+
+
+# Per moving volunteer: far above a real browser, to make contention visible
+LOCATION_UPDATES_PER_SECOND = 25
+
+
+def bench_location(args):
+    """Location updates from moving volunteers alongside claims: commits each vs written behind"""
+    with app.app_context():
+        init_db()
+    company_id = create_user('company', 'bench-company@example.com')
+    movers = [create_user('volunteer', f'bench-mover{i}@example.com') for i in range(8)]
+    claimer = create_user('volunteer', 'bench-claimer@example.com')
+    duration = float(args.rounds)
+    commits = []
+    with app.app_context():
+        engine = db.engine
+    def count_commit(conn):
+        commits.append(1)
+    event.listen(engine, 'commit', count_commit)
+    print(f"{len(movers)} volunteers saving their location {LOCATION_UPDATES_PER_SECOND} times/s, "
+          f"1 claiming nonstop, {duration:.0f}s each")
+
+    for label, interval in (('commit each', 0), ('written behind', app.config['USER_WRITE_BEHIND_SECONDS'] or 2)):
+        previous = app.extensions.pop('user_writes', None)
+        if previous is not None:
+            previous.close()
+        app.config['USER_WRITE_BEHIND_SECONDS'] = interval
+        writes = init_user_writes(app)
+        ids = create_donations(company_id, 5000)
+        latencies = {'location': [], 'claim': []}
+        errors = {'location': 0, 'claim': 0}
+        lock = threading.Lock()
+        stop = time.perf_counter() + duration
+
+        def timed(kind, client, url, **kwargs):
+            start = time.perf_counter()
+            response = client.post(url, **kwargs)
+            with lock:
+                latencies[kind].append(time.perf_counter() - start)
+                errors[kind] += response.status_code >= 500
+
+        def mover(user_id):
+            client = logged_in_client(user_id)
+            step = 0
+            while time.perf_counter() < stop:
+                step += 1
+                timed('location', client, '/user/location', json={'lat': 48.85 + step * 1e-5, 'lng': 2.35})
+                time.sleep(1 / LOCATION_UPDATES_PER_SECOND)
+
+        def claim():
+            client = logged_in_client(claimer)
+            for donation_id in ids:
+                if time.perf_counter() >= stop:
+                    break
+                timed('claim', client, f'/donation/{donation_id}/claim')
+
+        threads = [threading.Thread(target=mover, args=(user_id,)) for user_id in movers]
+        threads.append(threading.Thread(target=claim))
+        commits.clear()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if writes is not None:
+            writes.close()
+        transactions = len(commits)
+
+        flushed = f" ({writes.flushes} flushes of {writes.users_written} user rows)" if writes else ''
+        print(f"  {label}: {transactions / duration:6.0f} write transactions/s{flushed}")
+        for kind, values in latencies.items():
+            print(f"    {kind:<10} {len(values) / duration:7.0f} req/s  p50 {percentile(values, 0.5) * 1000:6.1f} ms  "
+                  f"p95 {percentile(values, 0.95) * 1000:6.1f} ms  errors {errors[kind]}")
+        with app.app_context():
+            stored = db.session.get(User, movers[0]).latitude
+        print(f"    stored latitude after the run: {stored:.5f}")
+    event.remove(engine, 'commit', count_commit)
+
+
+def count_statements(client, url):
+    """Render a page and return (status code, SQL statements executed)"""
+    statements = []
+    
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(url)
+    finally:
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', record)
+    return response.status_code, len(statements)
+
+
+SCENARIOS = {
+    'archive': bench_archive,
+    'batch': bench_batch,
+    'geocode': bench_geocode,
+    'jobs': bench_jobs,
+    'location': bench_location,
+    'mail': bench_mail,
+    'mixed': bench_mixed,
+    'pages': bench_pages,
+    'photos': bench_photos,
+    'profile': bench_profile,
+    'ratelimit': bench_ratelimit,
+    'readmodel': bench_readmodel,
+    'search': bench_search,
+    'startup': bench_startup,
+    'sync': bench_sync,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Food Rescue App benchmarks')
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('-n', type=int, default=200, help='items per round')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--routing', choices=('off', 'readonly', 'snapshot'),
+                        help='mixed: run a single read routing mode')
+    parser.add_argument('--latency-ms', type=float, default=1.0, help='mail: SMTP server round trip')
+    args = parser.parse_args(argv)
+    SCENARIOS[args.scenario](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
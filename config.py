@@ -17,28 +17,161 @@ class Config:
         'sqlite:///' + os.path.join(BASE_DIR, 'database', 'foodapp.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Read/write routing for read-only views: 'off', 'readonly' (read-only
+    # pool on the same file) or 'snapshot' (periodically copied replica file)
+    DATABASE_READ_ROUTING = os.environ.get('DATABASE_READ_ROUTING', 'off')
+    READ_REPLICA_PATH = os.environ.get('READ_REPLICA_PATH')
+    READ_REPLICA_REFRESH_SECONDS = 5
+    READ_POOL_SIZE = 10
+    
+    # Geographic sharding of donations, e.g. DONATION_SHARDS="lyon=sqlite:////srv/lyon.db".
+    # Empty keeps every donation in the main database. Regions map geohash
+    # prefixes to shards and only seed the shard_region table: afterwards move
+    # regions with `flask shards move`.
+    DONATION_SHARDS = dict(
+        item.split('=', 1) for item in os.environ.get('DONATION_SHARDS', '').split(',') if item
+    )
+    DONATION_SHARD_REGIONS = dict(
+        item.split('=', 1) for item in os.environ.get('DONATION_SHARD_REGIONS', '').split(',') if item
+    )
+    SHARD_REGION_REFRESH_SECONDS = 5
+    
+    # Token-bucket rate limits on writes (GET requests are never limited):
+    # endpoint -> [(key, 'count/period')] where key is 'ip' or 'user'
+    # ('user' falls back to the IP for anonymous clients).
+    # Storage: 'shared' (one budget for workers forked from a preloaded app),
+    # 'memory' (per worker process) or 'off'
+    RATE_LIMITS = {
+        'main.login': [('ip', '10/minute')],
+        'main.register': [('ip', '5/minute')],
+        'main.claim_donation': [('user', '30/minute'), ('ip', '120/minute')],
+        'main.batch_donations': [('user', '20/minute'), ('ip', '60/minute')],
+        'main.set_location': [('user', '10/minute')],
+    }
+    RATE_LIMIT_STORAGE = os.environ.get('RATE_LIMIT_STORAGE', 'shared')
+    RATE_LIMIT_SLOTS = 65536
+    
     # Session configuration
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
     SESSION_COOKIE_SECURE = os.environ.get('FLASK_ENV') == 'production'
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
     
-    # File upload configuration (for future features)
+    # File uploads: donation photos (see photos.py) are streamed to disk
+    # under UPLOAD_FOLDER and stored by content hash. Thumbnails of at most
+    # PHOTO_THUMBNAIL_PX a side are made by PHOTO_THUMBNAIL_PROCESSES worker
+    # processes; both sizes are cached by clients for PHOTO_MAX_AGE seconds.
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
-    UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(BASE_DIR, 'uploads')
+    PHOTO_THUMBNAIL_PX = 480
+    PHOTO_THUMBNAIL_QUALITY = 80
+    PHOTO_THUMBNAIL_PROCESSES = int(os.environ.get('PHOTO_THUMBNAIL_PROCESSES', 2))
+    PHOTO_THUMBNAIL_TIMEOUT = 60
+    PHOTO_MAX_AGE = 365 * 24 * 3600
     
-    # Email configuration (for future notifications)
+    # Email configuration for notification digests; none are sent without
+    # MAIL_SERVER. Up to MAIL_POOL_SIZE SMTP connections are kept open and
+    # reused, each for at most MAIL_POOL_IDLE_SECONDS between messages.
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT', 587))
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS', 'true').lower() in ['true', 'on', '1']
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER', 'Food Rescue <noreply@foodrescue.example.com>')
+    MAIL_TIMEOUT = 10
+    MAIL_POOL_SIZE = 2
+    MAIL_POOL_IDLE_SECONDS = 60
+    
+    # Notification digests (see notifications.py): changes are collected per
+    # recipient and sent as one email once the oldest has waited
+    # NOTIFY_DIGEST_MINUTES. Volunteers hear of new donations within
+    # NOTIFY_RADIUS_KM of them; NOTIFY_BATCH_SIZE digests are built at a time.
+    NOTIFY_DIGEST_MINUTES = float(os.environ.get('NOTIFY_DIGEST_MINUTES', 30))
+    NOTIFY_RADIUS_KM = 10.0
+    NOTIFY_BATCH_SIZE = 200
+    
+    # Offline geocoding of typed addresses (see geocoder.py): a GeoNames
+    # postal code file or a postcode,place,latitude,longitude CSV
+    GEOCODER_GAZETTEER = os.environ.get('GEOCODER_GAZETTEER')
+    GEOCODER_COUNTRIES = [code for code in os.environ.get('GEOCODER_COUNTRIES', '').split(',') if code]
+    GEOCODER_CACHE_SIZE = 10000
     
     # Map API configuration
     MAPBOX_ACCESS_TOKEN = os.environ.get('MAPBOX_ACCESS_TOKEN')
     
     # Pagination
     ITEMS_PER_PAGE = 12
+    
+    # Maximum donation ids accepted by one batch request
+    BATCH_MAX_IDS = 500
+    
+    # Serve the available donation lists from an in-memory read model
+    # instead of SQL (see readmodel.py)
+    AVAILABLE_READ_MODEL = os.environ.get('AVAILABLE_READ_MODEL', 'true').lower() in ['true', 'on', '1']
+    
+    # Volunteer priority feed (see ranking.py): score weights, distance (km) at
+    # which closeness halves, quantity at which size halves, donations shown,
+    # and the radius they are picked from when enough are that close
+    FEED_WEIGHTS = {'distance': 0.5, 'urgency': 0.35, 'quantity': 0.15}
+    FEED_DISTANCE_SCALE_KM = 5.0
+    FEED_QUANTITY_SCALE = 20
+    FEED_SIZE = 60
+    FEED_RADIUS_KM = 25.0
+    
+    # Idempotency keys on claim, complete and add (see idempotency.py): how
+    # long a first response is replayed to retries, and how long a request
+    # that never answered keeps its key reserved
+    IDEMPOTENCY_TTL_HOURS = 24
+    IDEMPOTENCY_LOCK_SECONDS = 60
+    
+    # Background jobs (see jobs.py): worker threads per web process (0 leaves
+    # jobs to `flask jobs work`), queues they run, attempts before a job is
+    # dead-lettered, retry backoff, seconds before a job whose worker vanished
+    # runs again, idle poll interval and seconds to drain on shutdown
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+    JOB_QUEUES = ['default']
+    JOB_MAX_ATTEMPTS = 5
+    JOB_BACKOFF_SECONDS = 2
+    JOB_BACKOFF_MAX_SECONDS = 600
+    JOB_LEASE_SECONDS = 300
+    JOB_POLL_SECONDS = 1.0
+    JOB_DRAIN_SECONDS = 10
+    
+    # Donation event outbox (see outbox.py): events handed to a consumer per
+    # batch, and age after which `flask events compact` may delete them
+    EVENT_BATCH_SIZE = 500
+    EVENT_RETENTION_DAYS = 7
+    
+    # Archival of completed and expired donations (`flask archive run`):
+    # minimum age in days, and rows moved per transaction
+    ARCHIVE_AFTER_DAYS = 30
+    ARCHIVE_BATCH_SIZE = 500
+    
+    # Request profiling (see profiling.py): endpoints always profiled, fraction
+    # of other requests profiled, 'sampling' (collapsed stacks for flame
+    # graphs) or 'cprofile'. `flask profile on|off` overrides these at runtime.
+    # Results go to PROFILE_DIR (default: instance/profiles).
+    PROFILE_ENDPOINTS = [name for name in os.environ.get('PROFILE_ENDPOINTS', '').split(',') if name]
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sampling')
+    PROFILE_DIR = os.environ.get('PROFILE_DIR')
+    PROFILE_INTERVAL = 0.005
+    PROFILE_REFRESH_SECONDS = 5
+    
+    # Location and last-login updates are kept in memory and written in one
+    # batched transaction this many seconds after the first (see
+    # writebehind.py); 0 commits each one as it comes
+    USER_WRITE_BEHIND_SECONDS = float(os.environ.get('USER_WRITE_BEHIND_SECONDS', 2))
+    
+    # Full-page cache for anonymous visitors (see pagecache.py): pages kept
+    # in memory per process (0 turns it off), and seconds browsers and proxies
+    # may reuse a page before revalidating its ETag (0: always revalidate)
+    PAGE_CACHE_SIZE = 64
+    PAGE_CACHE_MAX_AGE = int(os.environ.get('PAGE_CACHE_MAX_AGE', 0))
+    
+    # Search: distance (km) at which a text match's score is halved
+    SEARCH_DISTANCE_SCALE_KM = 5.0
+    SEARCH_MAX_RESULTS = 100
 
 class DevelopmentConfig(Config):
     """Development configuration"""
@@ -55,6 +188,10 @@ class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     WTF_CSRF_ENABLED = False
+    RATE_LIMIT_STORAGE = 'off'
+    # Worker threads would open their own, empty in-memory database
+    JOB_WORKERS = 0
+    USER_WRITE_BEHIND_SECONDS = 0
 
 # Configuration dictionary
 config = {
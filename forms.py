@@ -2,6 +2,7 @@
 Forms for Food Rescue App
 """
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField
 from wtforms import (
     StringField, 
     PasswordField, 
@@ -10,7 +11,8 @@ from wtforms import (
     IntegerField, 
     DateField,
     TextAreaField,
-    BooleanField
+    BooleanField,
+    HiddenField
 )
 from wtforms.validators import (
     DataRequired, 
@@ -23,6 +25,9 @@ from wtforms.validators import (
 )
 from datetime import datetime
 
+from idempotency import new_key
+from photos import sniff_image_type
+
 class RegisterForm(FlaskForm):
     """Registration form for new users"""
     
@@ -64,6 +69,12 @@ class RegisterForm(FlaskForm):
         validators=[Optional(), Length(max=50)]
     )
     
+    # Used to locate the account when the browser cannot share its position
+    address = StringField(
+        'Address',
+        validators=[Optional(), Length(max=255)]
+    )
+    
     # Password
     password = PasswordField(
         'Password',
@@ -167,12 +178,25 @@ class DonationForm(FlaskForm):
         render_kw={'placeholder': 'Number of items'}
     )
     
+    photo = FileField(
+        'Photo',
+        render_kw={'accept': 'image/jpeg,image/png,image/gif,image/webp'}
+    )
+    
+    # Submitting the same rendered form twice adds one donation (see idempotency.py)
+    idempotency_key = HiddenField(default=new_key)
+    
     submit = SubmitField('Add Donation')
     
     def validate_expiry_date(self, field):
         """Validate that expiry date is in the future"""
         if field.data < datetime.now().date():
             raise ValidationError('Expiry date must be in the future')
+    
+    def validate_photo(self, field):
+        """Validate that the photo, if any, is an image we can store"""
+        if field.data and sniff_image_type(field.data.stream) is None:
+            raise ValidationError('Photos must be JPEG, PNG, GIF or WebP images')
 
 
 class UpdateProfileForm(FlaskForm):
@@ -0,0 +1,286 @@
+"""
+Offline geocoding for Food Rescue App
+Resolves User.address to coordinates from a local gazetteer file, so
+companies without GPS still get a location. No network access is needed.
+
+Supported files (GEOCODER_GAZETTEER):
+- GeoNames postal codes (*.txt, tab separated, e.g. FR.txt or
+  allCountries.txt from download.geonames.org/export/zip/)
+- CSV with a header row: postcode, place, latitude, longitude
+  (either postcode or place may be empty)
+
+Postcodes and place names go into two sorted prefix indexes; an address
+resolves to its postcode if it has one, else to the longest place name in
+it, else to the centroid of the postcodes starting with a partial code.
+"""
+import csv
+import os
+import re
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import accumulate
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models import db, User
+
+# Longest place name, in words, looked for in an address
+MAX_PLACE_WORDS = 4
+
+# Postcodes averaged when an address only has a partial code ('SW1A', '750')
+PREFIX_MATCH_LIMIT = 1000
+
+# GeoNames postal code columns
+GEONAMES_COUNTRY, GEONAMES_POSTCODE, GEONAMES_PLACE = 0, 1, 2
+GEONAMES_LATITUDE, GEONAMES_LONGITUDE = 9, 10
+
+_load_lock = threading.Lock()
+
+
+def normalize(text):
+    """Lowercase, strip accents and punctuation: 'Saint-Étienne ' -> 'saint etienne'"""
+    text = text or ''
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+    return re.sub(r'[\W_]+', ' ', text.casefold()).strip()
+
+
+class PrefixIndex:
+    """
+    Sorted keys packed into one string with parallel coordinate arrays.
+    Exact and prefix lookups bisect the offsets; with only a handful of
+    Python objects, forked workers keep sharing the pages.
+    """
+
+    def __init__(self, entries):
+        keys = sorted(entries)
+        self._text = ''.join(keys)
+        self._offsets = array('I', accumulate(map(len, keys), initial=0))
+        # float32 keeps about a metre of precision, plenty for a centroid
+        self.lats = array('f', (entries[key][0] for key in keys))
+        self.lngs = array('f', (entries[key][1] for key in keys))
+
+    def __len__(self):
+        return len(self.lats)
+
+    def memory_bytes(self):
+        """Bytes held by the packed keys and arrays"""
+        return (len(self._text.encode('utf-8'))
+                + sum(column.itemsize * len(column) for column in (self._offsets, self.lats, self.lngs)))
+
+    def key(self, i):
+        return self._text[self._offsets[i]:self._offsets[i + 1]]
+
+    def _position(self, key):
+        return bisect_left(range(len(self)), key, key=self.key)
+
+    def find(self, key):
+        """Coordinates of an exact key, or None"""
+        i = self._position(key)
+        if i < len(self) and self.key(i) == key:
+            return self.lats[i], self.lngs[i]
+        return None
+
+    def centroid(self, prefix, limit=PREFIX_MATCH_LIMIT):
+        """Average coordinates of up to limit keys starting with prefix, or None"""
+        lat = lng = 0.0
+        count = 0
+        i = self._position(prefix)
+        while i < len(self) and count < limit and self.key(i).startswith(prefix):
+            lat += self.lats[i]
+            lng += self.lngs[i]
+            count += 1
+            i += 1
+        return (lat / count, lng / count) if count else None
+
+
+def read_gazetteer(path, countries=None):
+    """Yield (postcode, place, lat, lng) rows from a GeoNames or CSV file"""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield row.get('postcode'), row.get('place'), float(row['latitude']), float(row['longitude'])
+            return
+        for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+            if len(row) <= GEONAMES_LONGITUDE or not row[GEONAMES_LATITUDE]:
+                continue
+            if countries and row[GEONAMES_COUNTRY] not in countries:
+                continue
+            yield (row[GEONAMES_POSTCODE], row[GEONAMES_PLACE],
+                   float(row[GEONAMES_LATITUDE]), float(row[GEONAMES_LONGITUDE]))
+
+
+def _centroids(totals):
+    return {key: (lat / count, lng / count) for key, (lat, lng, count) in totals.items()}
+
+
+class Geocoder:
+    """Gazetteer lookups with a bounded LRU cache of resolved addresses"""
+
+    def __init__(self, postcodes, places, cache_size=10000):
+        self.postcodes = PrefixIndex(postcodes)
+        self.places = PrefixIndex(places)
+        self._cached = lru_cache(maxsize=cache_size)(self.resolve)
+
+    @classmethod
+    def load(cls, path, countries=None, cache_size=10000):
+        """Build the indexes; keys listed more than once resolve to their centroid"""
+        postcodes, places = {}, {}
+        for postcode, place, lat, lng in read_gazetteer(path, countries):
+            for totals, key in ((postcodes, normalize(postcode)), (places, normalize(place))):
+                if key:
+                    total = totals.get(key)
+                    totals[key] = (total[0] + lat, total[1] + lng, total[2] + 1) if total else (lat, lng, 1)
+        return cls(_centroids(postcodes), _centroids(places), cache_size)
+
+    def __len__(self):
+        return len(self.postcodes) + len(self.places)
+
+    def memory_bytes(self):
+        return self.postcodes.memory_bytes() + self.places.memory_bytes()
+
+    def cache_info(self):
+        return self._cached.cache_info()
+
+    def geocode(self, address):
+        """(lat, lng) for an address, or None if nothing in it is known"""
+        key = normalize(address)
+        return self._cached(key) if key else None
+
+    def geocode_many(self, addresses):
+        """
+        Bulk mode for backfills: resolves each distinct address once and
+        bypasses the LRU cache so it does not evict the addresses users
+        are typing right now. Returns {address: (lat, lng) or None}.
+        """
+        resolved = {}
+        by_key = {}
+        for address in addresses:
+            key = normalize(address)
+            if key not in by_key:
+                by_key[key] = self.resolve(key) if key else None
+            resolved[address] = by_key[key]
+        return resolved
+
+    def resolve(self, key):
+        """Uncached lookup of a normalized address, matching from its end"""
+        words = key.split()
+        # Postcodes, including two-word ones such as 'sw1a 1aa'
+        for size in (2, 1):
+            for start in range(len(words) - size, -1, -1):
+                candidate = ' '.join(words[start:start + size])
+                if any(char.isdigit() for char in candidate):
+                    found = self.postcodes.find(candidate)
+                    if found:
+                        return _rounded(found)
+        # Longest place name, later words first ('12 rue de lyon paris' is in Paris)
+        for size in range(min(MAX_PLACE_WORDS, len(words)), 0, -1):
+            for start in range(len(words) - size, -1, -1):
+                found = self.places.find(' '.join(words[start:start + size]))
+                if found:
+                    return _rounded(found)
+        # Partial postcode
+        for word in reversed(words):
+            if len(word) >= 2 and any(char.isdigit() for char in word):
+                found = self.postcodes.centroid(word)
+                if found:
+                    return _rounded(found)
+        return None
+
+
+def _rounded(coordinates):
+    return round(coordinates[0], 5), round(coordinates[1], 5)
+
+
+def current_geocoder():
+    """
+    The app's geocoder, loading the gazetteer on first use.
+    None when GEOCODER_GAZETTEER is unset or missing; addresses are then
+    saved without coordinates.
+    """
+    app = current_app._get_current_object()
+    geocoder = app.extensions.get('geocoder')
+    if geocoder is None:
+        with _load_lock:
+            geocoder = app.extensions.get('geocoder')
+            if geocoder is None:
+                path = app.config.get('GEOCODER_GAZETTEER')
+                if path and os.path.exists(path):
+                    geocoder = Geocoder.load(path, app.config.get('GEOCODER_COUNTRIES'),
+                                             app.config.get('GEOCODER_CACHE_SIZE', 10000))
+                else:
+                    if path:
+                        app.logger.warning(f"Gazetteer not found: {path}")
+                    geocoder = False
+                app.extensions['geocoder'] = geocoder
+    return geocoder or None
+
+
+def geocode_address(address):
+    """(lat, lng) for an address, or None if it cannot be resolved offline"""
+    geocoder = current_geocoder()
+    return geocoder.geocode(address) if geocoder is not None and address else None
+
+
+def backfill_locations(overwrite=False, batch_size=1000):
+    """
+    Geocode the addresses of users without coordinates (or of every user
+    with an address when overwrite is set).
+    Returns (users updated, users whose address was not found).
+    """
+    geocoder = current_geocoder()
+    if geocoder is None:
+        raise RuntimeError('Set GEOCODER_GAZETTEER to a gazetteer file first.')
+
+    query = sa.select(User.id, User.address).where(User.address.isnot(None), User.address != '')
+    if not overwrite:
+        query = query.where(sa.or_(User.latitude.is_(None), User.longitude.is_(None)))
+    rows = db.session.execute(query).all()
+    resolved = geocoder.geocode_many(row.address for row in rows)
+
+    updates = [
+        {'user_id': row.id, 'lat': resolved[row.address][0], 'lng': resolved[row.address][1]}
+        for row in rows if resolved[row.address]
+    ]
+    table = User.__table__
+    statement = table.update().where(table.c.id == sa.bindparam('user_id')).values(
+        latitude=sa.bindparam('lat'), longitude=sa.bindparam('lng')
+    )
+    for start in range(0, len(updates), batch_size):
+        db.session.execute(statement, updates[start:start + batch_size])
+        db.session.commit()
+    return len(updates), len(rows) - len(updates)
+
+
+@click.group('geocode')
+def geocode_command():
+    """Resolve user addresses with the offline gazetteer"""
+
+
+@geocode_command.command('backfill')
+@click.option('--overwrite', is_flag=True, help='Also re-geocode users that already have coordinates')
+@click.option('--batch-size', default=1000, show_default=True)
+@with_appcontext
+def geocode_backfill(overwrite, batch_size):
+    """Set coordinates from the address of existing users"""
+    try:
+        updated, missing = backfill_locations(overwrite, batch_size)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Located {updated} users; {missing} addresses not found.')
+
+
+@geocode_command.command('lookup')
+@click.argument('address')
+@with_appcontext
+def geocode_lookup(address):
+    """Print the coordinates the gazetteer gives ADDRESS"""
+    coordinates = geocode_address(address)
+    click.echo(f'{coordinates[0]}, {coordinates[1]}' if coordinates else 'Not found.')
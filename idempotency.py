@@ -0,0 +1,191 @@
+"""
+Idempotency keys for Food Rescue App
+Clients retrying a write send the same Idempotency-Key header (forms send an
+idempotency_key field). The first response is stored in idempotency_key for
+IDEMPOTENCY_TTL_HOURS; retries get it back without running the view, so a
+claim that succeeded is not answered with "no longer available" and a
+double-submitted form adds one donation.
+
+- keys are scoped per user and bound to the request they first came with:
+  reusing one for a different request is rejected with 422
+- a retry arriving while the first request still runs gets 409
+- 5xx responses and exceptions are not stored, so those requests can be retried
+"""
+import hashlib
+import uuid
+from datetime import datetime, timedelta
+from functools import wraps
+
+import click
+from flask import current_app, jsonify, request
+from flask.cli import with_appcontext
+from flask_login import current_user
+from sqlalchemy.exc import IntegrityError
+
+from models import db, IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+FORM_FIELD = 'idempotency_key'
+MAX_KEY_LENGTH = 255
+
+FORM_MIMETYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
+
+def new_key():
+    """A fresh key for a form to submit"""
+    return uuid.uuid4().hex
+
+
+def request_fingerprint():
+    """Hash of what makes a request the same request"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (request.method, request.path, request.query_string.decode()):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    if request.mimetype in FORM_MIMETYPES:
+        # Parsing the form consumed the body, so hash the fields instead
+        for name, value in sorted(request.form.items(multi=True)):
+            digest.update(f'{name}={value}'.encode())
+            digest.update(b'\0')
+        # Uploads streamed by photos.UploadRequest were hashed on the way in
+        for name, upload in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+            content = getattr(upload.stream, 'hexdigest', None)
+            digest.update(f'{name}={upload.filename}:{content() if content else ""}'.encode())
+            digest.update(b'\0')
+    else:
+        digest.update(request.get_data(cache=True))
+    return digest.digest()
+
+
+def in_progress():
+    response = jsonify({'error': 'A request with this key is still being processed'})
+    response.headers['Retry-After'] = '1'
+    return response, 409
+
+
+def reserve_key(user_id, key, fingerprint):
+    """
+    Reserve key for the current request.
+    Returns (stored record to replay, None), (None, error response) or
+    (None, None) when the view should run.
+    """
+    config = current_app.config
+    now = datetime.utcnow()
+    record = IdempotencyKey.query.filter_by(user_id=user_id, key=key).first()
+    if record is not None:
+        expired = record.created_at < now - timedelta(hours=config.get('IDEMPOTENCY_TTL_HOURS', 24))
+        # A first request that died without answering must not hold its key forever
+        abandoned = (record.status_code is None and
+                     record.created_at < now - timedelta(seconds=config.get('IDEMPOTENCY_LOCK_SECONDS', 60)))
+        if not expired and not abandoned:
+            if record.fingerprint != fingerprint:
+                return None, (jsonify({'error': f'{HEADER} was already used for a different request'}), 422)
+            if record.status_code is None:
+                return None, in_progress()
+            return record, None
+        # Take the stale row over in place, clearing the stored response. Matching
+        # on created_at lets only one of several concurrent retries win it.
+        taken = IdempotencyKey.query.filter_by(
+            user_id=user_id, key=key, created_at=record.created_at
+        ).update({
+            'fingerprint': fingerprint,
+            'created_at': now,
+            'status_code': None,
+            'mimetype': None,
+            'location': None,
+            'body': None,
+        })
+        db.session.commit()
+        return (None, None) if taken else (None, in_progress())
+
+    db.session.add(IdempotencyKey(user_id=user_id, key=key, fingerprint=fingerprint, created_at=now))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent retry reserved it first
+        db.session.rollback()
+        return None, in_progress()
+    return None, None
+
+
+def store_response(user_id, key, response):
+    try:
+        IdempotencyKey.query.filter_by(user_id=user_id, key=key).update({
+            'status_code': response.status_code,
+            'mimetype': response.mimetype,
+            'location': response.headers.get('Location'),
+            'body': response.get_data(),
+        })
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Idempotency store error: {str(e)}")
+
+
+def release_key(user_id, key):
+    try:
+        IdempotencyKey.query.filter_by(user_id=user_id, key=key).delete()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Idempotency release error: {str(e)}")
+
+
+def replay(record):
+    # Status, body and redirect target only: cookies in particular are not replayed
+    response = current_app.response_class(record.body, status=record.status_code, mimetype=record.mimetype)
+    if record.location:
+        response.headers['Location'] = record.location
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Answer retries of a write view from its stored first response.
+    Requests without a key run as usual. Use inside @login_required.
+    """
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        key = request.headers.get(HEADER) or request.form.get(FORM_FIELD)
+        if not key or request.method in ('GET', 'HEAD', 'OPTIONS') or not current_user.is_authenticated:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({'error': f'{HEADER} is longer than {MAX_KEY_LENGTH} characters'}), 400
+
+        user_id = current_user.id
+        record, error = reserve_key(user_id, key, request_fingerprint())
+        if error is not None:
+            return error
+        if record is not None:
+            return replay(record)
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except Exception:
+            release_key(user_id, key)
+            raise
+        if response.status_code >= 500:
+            release_key(user_id, key)
+        else:
+            store_response(user_id, key, response)
+        return response
+    return decorated_view
+
+
+def purge_idempotency_keys(ttl_hours=None):
+    """Delete stored responses older than the TTL; returns how many"""
+    if ttl_hours is None:
+        ttl_hours = current_app.config.get('IDEMPOTENCY_TTL_HOURS', 24)
+    cutoff = datetime.utcnow() - timedelta(hours=ttl_hours)
+    deleted = IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete()
+    db.session.commit()
+    return deleted
+
+
+@click.command('purge-idempotency-keys')
+@click.option('--ttl-hours', type=int, help='Defaults to IDEMPOTENCY_TTL_HOURS')
+@with_appcontext
+def purge_idempotency_keys_command(ttl_hours):
+    """Delete expired idempotency keys"""
+    click.echo(f'{purge_idempotency_keys(ttl_hours)} idempotency keys deleted.')
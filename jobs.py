@@ -0,0 +1,369 @@
+"""
+Background jobs for Food Rescue App
+Side effects that need not hold up a response (notifications, cache
+invalidation, analytics) are enqueued with enqueue() inside the request's
+transaction and run by a bounded pool of worker threads once it commits.
+The queue is the job table, so jobs survive restarts.
+
+- a failed job is retried with exponential backoff, and after
+  JOB_MAX_ATTEMPTS it stays in the queue as 'dead' until `flask jobs retry`
+- delivery is at least once: a job whose worker died is run again after
+  JOB_LEASE_SECONDS, so jobs should be idempotent
+- web processes run the JOB_QUEUES queues; heavy queues run in
+  `flask jobs work --queue <name>` instead
+- on shutdown workers drain due jobs for up to JOB_DRAIN_SECONDS
+"""
+import atexit
+import os
+import random
+import signal
+import socket
+import statistics
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+from sqlalchemy import event
+
+from models import db, Job
+from routing import RoutingSession
+
+TASKS = {}
+
+# Recent timings kept per job name for the latency percentiles
+LATENCY_SAMPLES = 1000
+
+
+class Task:
+    def __init__(self, name, func, queue, max_attempts):
+        self.name = name
+        self.func = func
+        self.queue = queue
+        self.max_attempts = max_attempts
+
+
+def job(name, queue='default', max_attempts=None):
+    """Register a function as a job: job('name')(func), run as func(**payload)"""
+    def register(func):
+        TASKS[name] = Task(name, func, queue, max_attempts)
+        return func
+    return register
+
+
+def enqueue(name, delay=0, **payload):
+    """
+    Add a job to the current transaction: it is only queued if that commits,
+    and the workers are woken when it does. payload must be JSON-serializable.
+    """
+    task = TASKS.get(name)
+    if task is None:
+        raise ValueError(f'Unknown job: {name}')
+    now = datetime.utcnow()
+    db.session.add(Job(
+        name=name,
+        queue=task.queue,
+        payload=payload,
+        max_attempts=task.max_attempts or current_app.config['JOB_MAX_ATTEMPTS'],
+        run_at=now + timedelta(seconds=delay),
+        created_at=now
+    ))
+    db.session.info['jobs_enqueued'] = db.session.info.get('jobs_enqueued', 0) + 1
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def wake_workers(session):
+    count = session.info.pop('jobs_enqueued', 0)
+    if count and has_app_context():
+        runner = current_app.extensions.get('jobs')
+        if runner is not None:
+            runner.wake(count)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_jobs(session):
+    session.info.pop('jobs_enqueued', None)
+
+
+def backoff_seconds(config, attempts):
+    """Delay before the next attempt: doubles each time, with jitter so retries spread out"""
+    delay = min(config['JOB_BACKOFF_SECONDS'] * 2 ** (attempts - 1), config['JOB_BACKOFF_MAX_SECONDS'])
+    return delay * random.uniform(0.5, 1.0)
+
+
+class JobMetrics:
+    """Counts and recent wait/run times per job name, for this process"""
+
+    def __init__(self):
+        self.succeeded = {}
+        self.failed = {}
+        self.dead = {}
+        self.waits = {}  # seconds from enqueue (or retry time) to start
+        self.runs = {}   # seconds running
+        self._lock = threading.Lock()
+
+    def record(self, name, outcome, wait, run):
+        with self._lock:
+            counts = getattr(self, outcome)
+            counts[name] = counts.get(name, 0) + 1
+            self.waits.setdefault(name, deque(maxlen=LATENCY_SAMPLES)).append(wait)
+            self.runs.setdefault(name, deque(maxlen=LATENCY_SAMPLES)).append(run)
+
+    def snapshot(self):
+        """{job name: {succeeded, failed, dead, wait_ms and run_ms as (p50, p95)}}"""
+        def percentiles(samples):
+            ordered = sorted(samples)
+            return (round(statistics.median(ordered) * 1000, 1),
+                    round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1000, 1))
+
+        with self._lock:
+            return {
+                name: {
+                    'succeeded': self.succeeded.get(name, 0),
+                    'failed': self.failed.get(name, 0),
+                    'dead': self.dead.get(name, 0),
+                    'wait_ms': percentiles(self.waits[name]),
+                    'run_ms': percentiles(self.runs[name]),
+                }
+                for name in self.waits
+            }
+
+
+class JobRunner:
+    """Bounded pool of worker threads taking jobs of some queues from the job table"""
+
+    def __init__(self, app, queues=None, workers=None):
+        self.app = app
+        config = app.config
+        self.queues = list(queues if queues is not None else config['JOB_QUEUES'])
+        self.workers = config['JOB_WORKERS'] if workers is None else workers
+        self.lease = timedelta(seconds=config['JOB_LEASE_SECONDS'])
+        self.poll_seconds = config['JOB_POLL_SECONDS']
+        self.metrics = JobMetrics()
+        self._wake = threading.Condition()
+        self._threads = []
+        self._pid = None
+        self._deadline = None  # set when draining
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    @property
+    def worker_id(self):
+        return f'{socket.gethostname()}-{os.getpid()}'
+
+    def start(self):
+        """Start the threads once per process (a forked child starts its own)"""
+        if self._pid == os.getpid() or not self.workers or not self.queues:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._deadline = None
+            self._threads = [
+                threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def wake(self, count=1):
+        """Start the workers if needed and wake up to count idle ones"""
+        self.start()
+        with self._wake:
+            self._wake.notify(count)
+
+    def drain(self, timeout=None):
+        """
+        Stop after the jobs due now, waiting up to timeout seconds
+        (JOB_DRAIN_SECONDS). Jobs still running by then are retried by
+        another worker once their lease expires.
+        """
+        if self._pid != os.getpid():
+            return
+        timeout = self.app.config['JOB_DRAIN_SECONDS'] if timeout is None else timeout
+        self._deadline = time.monotonic() + timeout
+        with self._wake:
+            self._wake.notify_all()
+        for thread in self._threads:
+            thread.join(max(self._deadline - time.monotonic(), 0))
+        self._pid = None
+
+    @property
+    def idle(self):
+        """True when every worker is waiting for work"""
+        return self._idle == len(self._threads)
+
+    def _run(self):
+        last_sweep = 0.0
+        while True:
+            draining = self._deadline is not None
+            if draining and time.monotonic() >= self._deadline:
+                return
+            with self.app.app_context():
+                if time.monotonic() - last_sweep > self.lease.total_seconds() / 2:
+                    last_sweep = time.monotonic()
+                    self.requeue_stale()
+                claimed = self.claim()
+                if claimed is not None:
+                    self.execute(*claimed)
+                    continue
+            if draining:
+                return
+            with self._wake:
+                self._idle += 1
+                self._wake.wait(self.poll_seconds)
+                self._idle -= 1
+
+    def claim(self):
+        """Mark the next due job running for this worker; (job id, name, payload, waited since) or None"""
+        now = datetime.utcnow()
+        due = (sa.select(Job.id, Job.name, Job.payload, Job.run_at)
+               .where(Job.queue.in_(self.queues), Job.status == 'queued', Job.run_at <= now)
+               .order_by(Job.run_at, Job.id).limit(5))
+        with db.engine.begin() as conn:
+            # Another worker may take a candidate between the SELECT and the UPDATE
+            for row in conn.execute(due).all():
+                won = conn.execute(
+                    sa.update(Job).where(Job.id == row.id, Job.status == 'queued')
+                    .values(status='running', attempts=Job.attempts + 1,
+                            locked_by=self.worker_id, locked_at=now)
+                ).rowcount
+                if won:
+                    return row.id, row.name, row.payload, row.run_at
+        return None
+
+    def execute(self, job_id, name, payload, run_at):
+        task = TASKS.get(name)
+        started = time.perf_counter()
+        wait = max((datetime.utcnow() - run_at).total_seconds(), 0.0)
+        try:
+            if task is None:
+                raise LookupError(f'Unknown job: {name}')
+            task.func(**(payload or {}))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Job {name} #{job_id} error: {str(e)}")
+            outcome = self.fail(job_id, f'{type(e).__name__}: {e}')
+        else:
+            outcome = 'succeeded'
+            with db.engine.begin() as conn:
+                conn.execute(sa.delete(Job).where(Job.id == job_id, Job.locked_by == self.worker_id))
+        finally:
+            db.session.remove()
+        self.metrics.record(name, outcome, wait, time.perf_counter() - started)
+
+    def fail(self, job_id, error):
+        """Schedule a retry, or dead-letter the job when it is out of attempts"""
+        with db.engine.begin() as conn:
+            attempts, max_attempts = conn.execute(
+                sa.select(Job.attempts, Job.max_attempts).where(Job.id == job_id)
+            ).one()
+            if attempts >= max_attempts:
+                values, outcome = {'status': 'dead'}, 'dead'
+            else:
+                retry_at = datetime.utcnow() + timedelta(seconds=backoff_seconds(current_app.config, attempts))
+                values, outcome = {'status': 'queued', 'run_at': retry_at}, 'failed'
+            conn.execute(sa.update(Job).where(Job.id == job_id).values(
+                last_error=error, locked_by=None, locked_at=None, **values
+            ))
+        return outcome
+
+    def requeue_stale(self):
+        """Queue again jobs whose worker stopped without finishing them"""
+        with db.engine.begin() as conn:
+            return conn.execute(
+                sa.update(Job).where(Job.status == 'running', Job.locked_at < datetime.utcnow() - self.lease)
+                .values(status='queued', locked_by=None, locked_at=None)
+            ).rowcount
+
+
+def init_jobs(app):
+    """Set up the web process's job runner; its threads start with the first request"""
+    runner = JobRunner(app)
+    app.extensions['jobs'] = runner
+    atexit.register(runner.drain)
+
+    @app.before_request
+    def start_job_workers():
+        runner.start()
+
+    return runner
+
+
+def queue_depth():
+    """{(queue, status): (jobs, oldest created_at)}"""
+    rows = db.session.execute(
+        sa.select(Job.queue, Job.status, sa.func.count(), sa.func.min(Job.created_at))
+        .group_by(Job.queue, Job.status)
+    )
+    return {(queue, status): (count, oldest) for queue, status, count, oldest in rows}
+
+
+def retry_dead(job_ids=None):
+    """Queue dead jobs (all, or the given ids) again with fresh attempts; returns how many"""
+    query = Job.query.filter_by(status='dead')
+    if job_ids:
+        query = query.filter(Job.id.in_(job_ids))
+    retried = query.update({'status': 'queued', 'attempts': 0, 'run_at': datetime.utcnow()},
+                           synchronize_session=False)
+    db.session.commit()
+    return retried
+
+
+@click.group('jobs')
+def jobs_command():
+    """Run and inspect background jobs"""
+
+
+@jobs_command.command('work')
+@click.option('--queue', 'queues', multiple=True, help='Queue to run (repeatable); defaults to JOB_QUEUES')
+@click.option('--workers', type=int, default=4, show_default=True, help='Worker threads')
+@click.option('--burst', is_flag=True, help='Exit once no job is due')
+@with_appcontext
+def jobs_work(queues, workers, burst):
+    """Run jobs outside the web processes until interrupted"""
+    app = current_app._get_current_object()
+    runner = JobRunner(app, queues or None, workers)
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+
+    click.echo(f"Running queues {', '.join(runner.queues)} with {workers} workers")
+    runner.start()
+    while not stop.wait(1):
+        if burst and runner.idle:
+            break
+    click.echo('Draining...')
+    runner.drain()
+    for name, stats in sorted(runner.metrics.snapshot().items()):
+        click.echo(f"  {name:<30} {stats['succeeded']:>7} ok {stats['failed']:>5} failed {stats['dead']:>5} dead  "
+                   f"wait p50/p95 {stats['wait_ms'][0]}/{stats['wait_ms'][1]} ms  "
+                   f"run p50/p95 {stats['run_ms'][0]}/{stats['run_ms'][1]} ms")
+
+
+@jobs_command.command('status')
+@with_appcontext
+def jobs_status():
+    """Show queue depth per queue and status, and how long the oldest job has waited"""
+    now = datetime.utcnow()
+    depth = queue_depth()
+    if not depth:
+        click.echo('No jobs queued.')
+    for (queue, status), (count, oldest) in sorted(depth.items()):
+        click.echo(f'{queue:<20} {status:<10} {count:>8} jobs, oldest {(now - oldest).total_seconds():8.1f} s')
+    for job_row in Job.query.filter_by(status='dead').order_by(Job.id.desc()).limit(10):
+        click.echo(f'  dead #{job_row.id} {job_row.name} after {job_row.attempts} attempts: {job_row.last_error}')
+
+
+@jobs_command.command('retry')
+@click.argument('job_ids', nargs=-1, type=int)
+@with_appcontext
+def jobs_retry(job_ids):
+    """Queue dead jobs again (all of them without ids)"""
+    click.echo(f'{retry_dead(list(job_ids))} jobs queued again.')
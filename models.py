@@ -1,11 +1,88 @@
 """
 Database models for Food Rescue App
 """
+import sqlalchemy as sa
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from datetime import datetime
+from datetime import datetime, timedelta
 
-db = SQLAlchemy()
+from routing import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Urgency buckets as (level, last day) counted in days until expiry,
+# checked in order; anything beyond the last bucket is 'low'
+URGENCY_LEVELS = [
+    ('expired', 0),
+    ('critical', 1),
+    ('high', 3),
+    ('medium', 7),
+]
+URGENCY_ORDER = [level for level, _ in URGENCY_LEVELS] + ['low']
+
+
+def create_indexes():
+    """Create indexes added to models after their tables already existed"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def add_missing_columns(engine=None):
+    """Add nullable columns added to models after their tables already existed"""
+    engine = engine or db.engine
+    inspector = sa.inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            with engine.begin() as conn:
+                conn.execute(sa.text(
+                    f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} '
+                    f'{column.type.compile(engine.dialect)}'
+                ))
+
+def upgrade_donation_ids(engine=None):
+    """
+    Make donation ids AUTOINCREMENT on a table created before they were, and
+    start the sequence above every archived id, so no id is handed out twice.
+    Run before creating indexes and triggers: rebuilding the table drops them.
+    """
+    engine = engine or db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+    table = Donation.__table__
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        schema = conn.execute(sa.text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'donation'"
+        )).scalar()
+        if schema is None:
+            return
+        if 'AUTOINCREMENT' not in schema.upper():
+            # SQLite cannot change a primary key in place: copy into a new table
+            metadata = sa.MetaData()
+            User.__table__.to_metadata(metadata)
+            staging = table.to_metadata(metadata, name='donation_upgrade')
+            names = ', '.join(quote(column.name) for column in table.columns)
+            conn.execute(sa.text('DROP TABLE IF EXISTS donation_upgrade'))
+            conn.execute(sa.schema.CreateTable(staging))
+            conn.execute(sa.text(f'INSERT INTO donation_upgrade ({names}) SELECT {names} FROM donation'))
+            conn.execute(sa.text('DROP TABLE donation'))
+            conn.execute(sa.text('ALTER TABLE donation_upgrade RENAME TO donation'))
+
+        highest = max(
+            conn.execute(sa.select(sa.func.max(model_table.c.id))).scalar() or 0
+            for model_table in (table, ArchivedDonation.__table__)
+        )
+        if not conn.execute(sa.text(
+                "UPDATE sqlite_sequence SET seq = MAX(seq, :highest) WHERE name = 'donation'"
+        ), {'highest': highest}).rowcount:
+            conn.execute(sa.text("INSERT INTO sqlite_sequence (name, seq) VALUES ('donation', :highest)"),
+                         {'highest': highest})
 
 class User(db.Model, UserMixin):
     """User model for both companies and volunteers"""
@@ -63,16 +140,33 @@ class User(db.Model, UserMixin):
             return self.company_name or self.name
         return f"{self.name} {self.surname}" if self.surname else self.name
     
+    @classmethod
+    def display_names(cls, user_ids):
+        """Return {user id: display name} for the given ids in one query"""
+        if not user_ids:
+            return {}
+        users = cls.query.filter(cls.id.in_(user_ids)).options(
+            db.load_only(cls.role, cls.name, cls.surname, cls.company_name)
+        )
+        return {user.id: user.display_name for user in users}
+    
     def update_last_login(self):
-        """Update last login timestamp"""
-        self.last_login = datetime.utcnow()
-        db.session.commit()
+        """Update last login timestamp (written behind, see writebehind.py)"""
+        from writebehind import write_user
+        write_user(self, last_login=datetime.utcnow())
 
 
 class Donation(db.Model):
     """Donation model for food items"""
     
     __tablename__ = 'donation'
+    __table_args__ = (
+        # Serves urgency filters on the available list as index range scans
+        db.Index('ix_donation_status_expiry', 'status', 'expiry_date'),
+        db.Index('ix_donation_status_category', 'status', 'category'),
+        # AUTOINCREMENT: ids of archived donations are never handed out again
+        {'sqlite_autoincrement': True},
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     
@@ -93,6 +187,9 @@ class Donation(db.Model):
     latitude = db.Column(db.Float)
     longitude = db.Column(db.Float)
     
+    # Photo: content-addressed file name under UPLOAD_FOLDER (see photos.py)
+    photo = db.Column(db.String(80))
+    
     # Timestamps
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     claimed_at = db.Column(db.DateTime)
@@ -129,18 +226,238 @@ class Donation(db.Model):
     def urgency_level(self):
         """Return urgency level based on days until expiry"""
         days = self.days_until_expiry
-        if days <= 0:
-            return 'expired'
-        elif days <= 1:
-            return 'critical'
-        elif days <= 3:
-            return 'high'
-        elif days <= 7:
-            return 'medium'
+        for level, last_day in URGENCY_LEVELS:
+            if days <= last_day:
+                return level
         return 'low'
     
+    @staticmethod
+    def urgency_date_range(level, today=None):
+        """
+        Return the (first, last) expiry dates covered by an urgency level.
+        Either end is None when the bucket is open-ended.
+        """
+        today = today or datetime.now().date()
+        first_day = None
+        for name, last_day in URGENCY_LEVELS:
+            if name == level:
+                first = today + timedelta(days=first_day) if first_day is not None else None
+                return first, today + timedelta(days=last_day)
+            first_day = last_day + 1
+        if level == 'low':
+            return today + timedelta(days=first_day), None
+        raise ValueError(f'Unknown urgency level: {level}')
+    
+    @classmethod
+    def urgency_filter(cls, level, today=None):
+        """SQL predicate matching an urgency level as an expiry_date range"""
+        first, last = cls.urgency_date_range(level, today)
+        clauses = []
+        if first is not None:
+            clauses.append(cls.expiry_date >= first)
+        if last is not None:
+            clauses.append(cls.expiry_date <= last)
+        return db.and_(*clauses)
+    
+    @classmethod
+    def urgency_case(cls, today=None):
+        """SQL expression computing urgency_level in the database"""
+        today = today or datetime.now().date()
+        return db.case(
+            *[(cls.expiry_date <= today + timedelta(days=last_day), level)
+              for level, last_day in URGENCY_LEVELS],
+            else_='low'
+        )
+    
+    @classmethod
+    def facet_counts(cls, query, urgency=None, category=None, today=None):
+        """
+        Count donations per urgency level and per category in one grouped query.
+        Each facet honours the other facet's selection but not its own, so the
+        counts show what picking a different value would return.
+        """
+        urgency_column = cls.urgency_case(today).label('urgency')
+        rows = query.with_entities(
+            cls.category, urgency_column, db.func.count(cls.id)
+        ).order_by(None).group_by(cls.category, urgency_column).all()
+        
+        urgency_counts = dict.fromkeys(URGENCY_ORDER, 0)
+        category_counts = {}
+        for row_category, row_urgency, total in rows:
+            row_category = row_category or 'other'
+            if not category or row_category == category:
+                urgency_counts[row_urgency] += total
+            if not urgency or row_urgency == urgency:
+                category_counts[row_category] = category_counts.get(row_category, 0) + total
+        
+        return {
+            'urgency': urgency_counts,
+            'category': dict(sorted(category_counts.items(), key=lambda item: -item[1]))
+        }
+    
     def mark_as_expired(self):
         """Mark donation as expired"""
         if self.is_expired and self.status == 'available':
             self.status = 'expired'
-            db.session.commit()
\ No newline at end of file
+            db.session.commit()
+
+
+class ArchivedDonation(db.Model):
+    """
+    Completed or expired donation moved out of the live table by the
+    archival job (see archive.py); history views read both tables
+    """
+    
+    __tablename__ = 'donation_archive'
+    __table_args__ = (
+        db.Index('ix_donation_archive_company_created', 'company_id', 'created_at'),
+        db.Index('ix_donation_archive_volunteer', 'volunteer_id'),
+    )
+    
+    # Same columns as Donation, ids included
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    item_name = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.Text)
+    category = db.Column(db.String(50))
+    expiry_date = db.Column(db.Date, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20))
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    created_at = db.Column(db.DateTime)
+    claimed_at = db.Column(db.DateTime)
+    completed_at = db.Column(db.DateTime)
+    company_id = db.Column(db.Integer, nullable=False)
+    volunteer_id = db.Column(db.Integer)
+    photo = db.Column(db.String(80))
+    
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ArchivedDonation {self.item_name} - {self.status}>'
+
+
+class ShardRegion(db.Model):
+    """Geohash prefix whose donations live on a given shard"""
+    
+    __tablename__ = 'shard_region'
+    
+    prefix = db.Column(db.String(12), primary_key=True)
+    shard = db.Column(db.String(50), nullable=False)
+    
+    def __repr__(self):
+        return f'<ShardRegion {self.prefix} -> {self.shard}>'
+
+
+class ShardSequence(db.Model):
+    """Next free id of a sharded table, handed out to workers in blocks"""
+    
+    __tablename__ = 'shard_sequence'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+
+
+class DonationEvent(db.Model):
+    """
+    Append-only outbox of donation state changes, written in the same
+    transaction as the change it records (see outbox.py)
+    """
+    
+    __tablename__ = 'donation_event'
+    # AUTOINCREMENT: sequence numbers are never reused after compaction
+    __table_args__ = {'sqlite_autoincrement': True}
+    
+    seq = db.Column(db.Integer, primary_key=True)
+    donation_id = db.Column(db.Integer, nullable=False, index=True)
+    event_type = db.Column(db.String(20), nullable=False)  # 'created', 'deleted', 'updated', 'moved' or the new status
+    actor_id = db.Column(db.Integer)
+    payload = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<DonationEvent {self.seq} {self.event_type} #{self.donation_id}>'
+
+
+class EventCheckpoint(db.Model):
+    """Last outbox sequence number a consumer has processed, per shard"""
+    
+    __tablename__ = 'event_checkpoint'
+    
+    consumer = db.Column(db.String(50), primary_key=True)
+    shard = db.Column(db.String(50), primary_key=True)
+    seq = db.Column(db.Integer, nullable=False, default=0)
+
+
+class IdempotencyKey(db.Model):
+    """
+    First response to a write sent with an Idempotency-Key, replayed to
+    retries with the same key (see idempotency.py)
+    """
+    
+    __tablename__ = 'idempotency_key'
+    # The primary key is the only lookup: no separate rowid b-tree needed
+    __table_args__ = {'sqlite_with_rowid': False}
+    
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.LargeBinary(16), nullable=False)  # hash of the request it answers
+    status_code = db.Column(db.Integer)  # None while the first request is running
+    mimetype = db.Column(db.String(100))
+    location = db.Column(db.String(500))
+    body = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<IdempotencyKey {self.user_id} {self.key}>'
+
+
+class Job(db.Model):
+    """
+    Durable queue of background jobs, run after the transaction that
+    enqueued them commits (see jobs.py). Finished jobs are deleted; jobs
+    out of attempts stay as status 'dead' until retried.
+    """
+    
+    __tablename__ = 'job'
+    __table_args__ = (
+        db.Index('ix_job_queue_status_run_at', 'queue', 'status', 'run_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    queue = db.Column(db.String(50), nullable=False, default='default')
+    payload = db.Column(db.JSON)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # 'queued', 'running' or 'dead'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # not before, for backoff
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100))  # worker running it
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    
+    def __repr__(self):
+        return f'<Job {self.id} {self.name} {self.status}>'
+
+
+class Notification(db.Model):
+    """
+    Pending notification of a donation change for one user, waiting to be
+    sent in that user's next digest email (see notifications.py)
+    """
+    
+    __tablename__ = 'notification'
+    __table_args__ = (
+        # Events delivered twice by the outbox notify once
+        db.UniqueConstraint('user_id', 'donation_id', 'kind', name='uq_notification_user_donation_kind'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    donation_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # 'new_donation', 'claimed' or 'completed'
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<Notification {self.kind} #{self.donation_id} for {self.user_id}>'
@@ -0,0 +1,445 @@
+"""
+Email notification digests for Food Rescue App
+Donation events are read from the outbox and turned into pending
+notifications per recipient: new donations for volunteers within
+NOTIFY_RADIUS_KM, claims and completions for the donating company. Once a
+recipient's oldest notification has waited NOTIFY_DIGEST_MINUTES they all go
+out as one digest, so a busy hour means one email rather than dozens.
+
+Digests are sent over SMTP connections kept open between messages, with the
+envelope and DATA command pipelined when the server supports PIPELINING.
+A digest is claimed before it is sent: a crash mid-send loses it rather
+than sending it twice.
+"""
+import atexit
+import re
+import smtplib
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.policy import SMTP as SMTP_POLICY
+from email.utils import parseaddr
+from math import degrees, floor
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+
+from jobs import enqueue, job
+from models import db, Donation, Job, Notification, User
+from outbox import EventConsumer
+from ranking import bounding_box, haversine_km, EARTH_RADIUS_KM
+
+CONSUMER = 'notifications'
+
+# Outbox event type -> notification kind for the donating company
+COMPANY_EVENTS = {'claimed': 'claimed', 'completed': 'completed'}
+
+
+def notifications_enabled():
+    return bool(current_app.config.get('MAIL_SERVER'))
+
+
+def notify_later():
+    """Collect notifications for this transaction's changes once it commits (call before commit)"""
+    if notifications_enabled():
+        enqueue('notifications.collect')
+
+
+class VolunteerGrid:
+    """Located volunteers bucketed into cells of radius_km, to find those near a point"""
+
+    def __init__(self, rows, radius_km):
+        self.radius_km = radius_km
+        self.cell = degrees(radius_km / EARTH_RADIUS_KM)
+        self.rows = rows
+        self.cells = defaultdict(list)
+        for row in rows:
+            self.cells[floor(row.latitude / self.cell), floor(row.longitude / self.cell)].append(row)
+
+    def near(self, lat, lng):
+        """Ids of volunteers within radius_km of (lat, lng)"""
+        box = bounding_box(lat, lng, self.radius_km)
+        if box is None:
+            candidates = self.rows
+        else:
+            min_lat, max_lat, min_lng, max_lng = box
+            candidates = [
+                row
+                for i in range(floor(min_lat / self.cell), floor(max_lat / self.cell) + 1)
+                for j in range(floor(min_lng / self.cell), floor(max_lng / self.cell) + 1)
+                for row in self.cells.get((i, j), ())
+            ]
+        return [row.id for row in candidates
+                if haversine_km(lat, lng, row.latitude, row.longitude) <= self.radius_km]
+
+
+def notifications_for(events):
+    """Notification rows for a batch of outbox events"""
+    def located(item):
+        return item.payload.get('latitude') is not None and item.payload.get('longitude') is not None
+
+    grid = None
+    if any(item.event_type == 'created' and located(item) for item in events):
+        volunteers = db.session.execute(
+            sa.select(User.id, User.latitude, User.longitude)
+            .where(User.role == 'volunteer', User.latitude.is_not(None), User.longitude.is_not(None))
+        ).all()
+        grid = VolunteerGrid(volunteers, current_app.config['NOTIFY_RADIUS_KM'])
+
+    rows = []
+    for item in events:
+        if item.event_type == 'created' and grid is not None and located(item):
+            rows.extend(
+                {'user_id': user_id, 'donation_id': item.donation_id, 'kind': 'new_donation',
+                 'created_at': item.created_at}
+                for user_id in grid.near(item.payload['latitude'], item.payload['longitude'])
+            )
+        elif item.event_type in COMPANY_EVENTS and item.payload.get('company_id'):
+            rows.append({'user_id': item.payload['company_id'], 'donation_id': item.donation_id,
+                         'kind': COMPANY_EVENTS[item.event_type], 'created_at': item.created_at})
+    return rows
+
+
+def collect_notifications():
+    """Turn new outbox events into pending notifications; returns how many were added"""
+    added = 0
+
+    def handle(events):
+        nonlocal added
+        rows = notifications_for(events)
+        if rows:
+            added += db.session.execute(
+                Notification.__table__.insert().prefix_with('OR IGNORE'), rows
+            ).rowcount
+            db.session.commit()
+
+    EventConsumer(CONSUMER).run(handle)
+    return added
+
+
+def due_recipients(now, limit):
+    cutoff = now - timedelta(minutes=current_app.config['NOTIFY_DIGEST_MINUTES'])
+    return db.session.execute(
+        sa.select(Notification.user_id).group_by(Notification.user_id)
+        .having(sa.func.min(Notification.created_at) <= cutoff).limit(limit)
+    ).scalars().all()
+
+
+def next_due_in(now):
+    """Seconds until the next recipient's digest is due, or None if nothing is pending"""
+    oldest = db.session.execute(sa.select(sa.func.min(Notification.created_at))).scalar()
+    if oldest is None:
+        return None
+    due = oldest + timedelta(minutes=current_app.config['NOTIFY_DIGEST_MINUTES'])
+    return max((due - now).total_seconds(), 0)
+
+
+def claim_notifications(user_ids):
+    """Delete and return the pending notifications of user_ids, so no other sender takes them"""
+    table = Notification.__table__
+    rows = db.session.execute(
+        table.delete().where(table.c.user_id.in_(user_ids))
+        .returning(table.c.user_id, table.c.donation_id, table.c.kind, table.c.created_at)
+    ).all()
+    db.session.commit()
+    return rows
+
+
+def release_notifications(rows):
+    """Put claimed notifications back after a failed send"""
+    db.session.execute(Notification.__table__.insert().prefix_with('OR IGNORE'), [row._asdict() for row in rows])
+    db.session.commit()
+
+
+def digest_line(donation, company_names=None):
+    line = f'- {donation.item_name} x{donation.quantity}'
+    if company_names is not None:
+        line += f' from {company_names.get(donation.company_id) or "a company"}'
+    return f'{line}, expires {donation.expiry_date.isoformat()}'
+
+
+def build_digests(rows):
+    """{user id: EmailMessage} for claimed notification rows; users with nothing left to say are skipped"""
+    by_user = defaultdict(list)
+    for row in rows:
+        by_user[row.user_id].append(row)
+    donation_ids = list({row.donation_id for row in rows})
+    donations = {d.id: d for d in db.session.query(
+        Donation.id, Donation.item_name, Donation.quantity, Donation.expiry_date,
+        Donation.status, Donation.company_id
+    ).filter(Donation.id.in_(donation_ids))}
+    users = User.query.filter(User.id.in_(by_user)).options(
+        db.load_only(User.email, User.name, User.role)
+    ).all()
+    company_names = User.display_names({d.company_id for d in donations.values()})
+
+    sender = current_app.config['MAIL_DEFAULT_SENDER']
+    digests = {}
+    for user in users:
+        sections = defaultdict(list)
+        for row in sorted(by_user[user.id], key=lambda row: row.created_at):
+            donation = donations.get(row.donation_id)
+            # New donations already claimed by someone else are not worth an email
+            if donation is None or row.kind == 'new_donation' and donation.status != 'available':
+                continue
+            sections[row.kind].append(
+                digest_line(donation, company_names if row.kind == 'new_donation' else None)
+            )
+        if not sections:
+            continue
+
+        lines = [f'Hello {user.name},', '']
+        if sections['new_donation']:
+            count = len(sections['new_donation'])
+            subject = f"{count} new donation{'s' if count != 1 else ''} near you"
+            lines += ['New donations near you:', *sections['new_donation'], '',
+                      'Log in to Food Rescue to claim them before they expire.']
+        else:
+            count = len(sections['claimed']) + len(sections['completed'])
+            subject = f"Updates on {count} of your donation{'s' if count != 1 else ''}"
+            for kind, title in (('claimed', 'Claimed by a volunteer:'), ('completed', 'Picked up:')):
+                if sections[kind]:
+                    lines += [title, *sections[kind], '']
+
+        message = EmailMessage()
+        message['From'] = sender
+        message['To'] = user.email
+        message['Subject'] = subject
+        message.set_content('\n'.join(lines).rstrip() + '\n')
+        digests[user.id] = message
+    return digests
+
+
+class SMTPPool:
+    """
+    Up to MAIL_POOL_SIZE open SMTP connections shared by the threads of a
+    process. Connections are reused until idle for MAIL_POOL_IDLE_SECONDS,
+    so TLS and login happen once per connection rather than per message.
+    """
+
+    def __init__(self, app):
+        config = app.config
+        self.host = config.get('MAIL_SERVER')
+        self.port = config.get('MAIL_PORT', 587)
+        self.use_tls = config.get('MAIL_USE_TLS', False)
+        self.username = config.get('MAIL_USERNAME')
+        self.password = config.get('MAIL_PASSWORD')
+        self.timeout = config.get('MAIL_TIMEOUT', 10)
+        self.idle_seconds = config.get('MAIL_POOL_IDLE_SECONDS', 60)
+        self.sender = parseaddr(config.get('MAIL_DEFAULT_SENDER', ''))[1]
+        self.pipelining = True
+        self._slots = threading.BoundedSemaphore(config.get('MAIL_POOL_SIZE', 2))
+        self._idle = []  # (connection, last used)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        connection.ehlo()
+        if self.use_tls:
+            connection.starttls()
+            connection.ehlo()
+        if self.username:
+            connection.login(self.username, self.password)
+        return connection
+
+    def _checkout(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                if now - last_used < self.idle_seconds:
+                    return connection
+                self._quit(connection)
+        return self._connect()
+
+    def _checkin(self, connection):
+        with self._lock:
+            self._idle.append((connection, time.monotonic()))
+
+    @staticmethod
+    def _quit(connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._quit(connection)
+
+    def _send(self, connection, message):
+        recipient = parseaddr(message['To'])[1]
+        data = message.as_bytes(policy=SMTP_POLICY)
+        if not (self.pipelining and connection.has_extn('pipelining')):
+            connection.sendmail(self.sender, [recipient], data)
+            return
+        # One round trip for MAIL, RCPT and DATA, one for the message (RFC 2920)
+        connection.send(f'MAIL FROM:<{self.sender}>\r\nRCPT TO:<{recipient}>\r\nDATA\r\n')
+        (mail_code, mail_reply), (rcpt_code, rcpt_reply), (data_code, data_reply) = (
+            connection.getreply() for _ in range(3)
+        )
+        if data_code != 354:
+            connection.rset()
+            if mail_code != 250:
+                raise smtplib.SMTPSenderRefused(mail_code, mail_reply, self.sender)
+            if rcpt_code not in (250, 251):
+                raise smtplib.SMTPRecipientsRefused({recipient: (rcpt_code, rcpt_reply)})
+            raise smtplib.SMTPDataError(data_code, data_reply)
+        data = re.sub(br'(?m)^\.', b'..', data)
+        if not data.endswith(b'\r\n'):
+            data += b'\r\n'
+        connection.send(data + b'.\r\n')
+        code, reply = connection.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, reply)
+
+    def send_many(self, messages):
+        """
+        Send messages over one pooled connection, reconnecting once if the
+        server dropped it. Returns {index: error} of messages not sent; a
+        4xx error or lost connection means they can be retried.
+        """
+        failed = {}
+        with self._slots:
+            connection = None
+            try:
+                for index, message in enumerate(messages):
+                    for attempt in range(2):
+                        try:
+                            if connection is None:
+                                connection = self._checkout()
+                            self._send(connection, message)
+                            break
+                        except (smtplib.SMTPServerDisconnected, OSError) as e:
+                            if connection is not None:
+                                connection.close()
+                            connection = None
+                            if attempt:
+                                # The server is unreachable: the rest would fail the same way
+                                failed.update((rest, e) for rest in range(index, len(messages)))
+                                return failed
+                        except smtplib.SMTPException as e:
+                            failed[index] = e
+                            break
+            finally:
+                if connection is not None:
+                    self._checkin(connection)
+        return failed
+
+
+def smtp_pool():
+    """The app's SMTP pool, created on first use"""
+    app = current_app._get_current_object()
+    pool = app.extensions.get('smtp_pool')
+    if pool is None:
+        with _pool_lock:
+            pool = app.extensions.get('smtp_pool')
+            if pool is None:
+                pool = app.extensions['smtp_pool'] = SMTPPool(app)
+                atexit.register(pool.close)
+    return pool
+
+
+_pool_lock = threading.Lock()
+
+
+def retryable(error):
+    """Temporary failures: a 4xx reply or a lost connection"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return True
+
+
+def send_due_digests(now=None):
+    """
+    Send every digest that is due, NOTIFY_BATCH_SIZE recipients at a time.
+    Returns (digests sent, digests failed, seconds spent sending).
+    """
+    now = now or datetime.utcnow()
+    batch_size = current_app.config['NOTIFY_BATCH_SIZE']
+    pool = smtp_pool()
+    sent = failed = 0
+    sending = 0.0
+    while True:
+        user_ids = due_recipients(now, batch_size)
+        if not user_ids:
+            break
+        rows = claim_notifications(user_ids)
+        digests = build_digests(rows)
+        user_order = list(digests)
+        start = time.perf_counter()
+        errors = pool.send_many([digests[user_id] for user_id in user_order])
+        sending += time.perf_counter() - start
+
+        retry = set()
+        for index, error in errors.items():
+            current_app.logger.error(f"Digest to user {user_order[index]} error: {str(error)}")
+            if retryable(error):
+                retry.add(user_order[index])
+        if retry:
+            release_notifications([row for row in rows if row.user_id in retry])
+        sent += len(digests) - len(errors)
+        failed += len(errors)
+        if retry:
+            # Released digests are due again at once: leave them for the next run
+            break
+    return sent, failed, sending
+
+
+def schedule_send():
+    """Queue a send job for when the next digest is due, unless one is queued already"""
+    delay = next_due_in(datetime.utcnow())
+    if delay is None or Job.query.filter_by(name='notifications.send', status='queued').first() is not None:
+        return
+    # Digests released after a failed send are due at once: pause before retrying them
+    enqueue('notifications.send', delay=max(delay, 30))
+
+
+@job('notifications.collect')
+def collect_job():
+    if notifications_enabled() and collect_notifications():
+        schedule_send()
+
+
+@job('notifications.send', max_attempts=10)
+def send_job():
+    if notifications_enabled():
+        send_due_digests()
+        schedule_send()
+
+
+@click.group('notify')
+def notify_command():
+    """Collect and send notification digests"""
+
+
+@notify_command.command('run')
+@with_appcontext
+def notify_run():
+    """Collect new notifications and send the digests that are due"""
+    if not notifications_enabled():
+        raise click.ClickException('Set MAIL_SERVER to send notifications.')
+    click.echo(f'{collect_notifications()} notifications collected.')
+    sent, failed, elapsed = send_due_digests()
+    rate = f', {sent / elapsed:.0f} messages/s' if sent and elapsed else ''
+    click.echo(f'{sent} digests sent, {failed} failed{rate}.')
+
+
+@notify_command.command('status')
+@with_appcontext
+def notify_status():
+    """Show pending notifications and when the next digest is due"""
+    pending, recipients = db.session.execute(
+        sa.select(sa.func.count(), sa.func.count(sa.distinct(Notification.user_id)))
+    ).one()
+    due_in = next_due_in(datetime.utcnow())
+    due = f', next digest due in {due_in / 60:.1f} min' if due_in is not None else ''
+    click.echo(f'{pending} notifications pending for {recipients} recipients{due}.')
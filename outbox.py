@@ -0,0 +1,270 @@
+"""
+Transactional event outbox for Food Rescue App
+Every write to a donation appends a donation_event row in the same
+transaction, on the same database (shard) as the donation itself, so an
+event exists if and only if its change was committed. Consumers read the
+outbox from a named checkpoint in batches instead of re-querying donations.
+
+- ORM writes (add, claim, complete, delete, mark_as_expired) are recorded
+  by a flush listener
+- set-based UPDATE/DELETE statements call record_bulk_events()
+- `flask shards move` appends a 'moved' event on the new shard, with the
+  donation's current state; nothing is recorded on the old one
+- sequence numbers increase per shard; order is guaranteed within a shard
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import chain
+
+import click
+import flask
+import sqlalchemy as sa
+from flask import current_app, has_request_context
+from flask.cli import with_appcontext
+from sqlalchemy import event
+
+from models import db, Donation, DonationEvent, EventCheckpoint
+from routing import PRIMARY_SHARD, RoutingSession
+from sharding import current_shards, shard_ids
+
+# Donation fields copied into each event, enough to update a cache or map
+# marker without reading the donation back
+PAYLOAD_FIELDS = ('status', 'company_id', 'volunteer_id', 'category', 'quantity',
+                  'latitude', 'longitude', 'expiry_date')
+
+EVENT_COLUMNS = (
+    DonationEvent.seq, DonationEvent.donation_id, DonationEvent.event_type,
+    DonationEvent.actor_id, DonationEvent.payload, DonationEvent.created_at
+)
+
+Event = namedtuple('Event', 'shard seq donation_id event_type actor_id payload created_at')
+
+
+def current_actor_id():
+    """Id of the logged-in user, read from the session cookie without a query"""
+    if not has_request_context():
+        return None
+    user_id = flask.session.get('_user_id')
+    return int(user_id) if user_id else None
+
+
+def event_payload(donation):
+    # Read loaded values only: loading attributes mid-flush would query
+    values = sa.inspect(donation).dict
+    payload = {field: values.get(field) for field in PAYLOAD_FIELDS}
+    if payload['expiry_date'] is not None:
+        payload['expiry_date'] = payload['expiry_date'].isoformat()
+    return payload
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def record_donation_events(session, flush_context):
+    """Append an event for every donation inserted, changed or deleted by this flush"""
+    changes = [(instance, 'created') for instance in session.new if isinstance(instance, Donation)]
+    for instance in session.dirty:
+        if isinstance(instance, Donation) and session.is_modified(instance, include_collections=False):
+            status = sa.inspect(instance).attrs.status.history
+            changes.append((instance, status.added[0] if status.added else 'updated'))
+    changes.extend((instance, 'deleted') for instance in session.deleted if isinstance(instance, Donation))
+    if not changes:
+        return
+
+    shards = current_shards()
+    actor_id = current_actor_id()
+    now = datetime.utcnow()
+    rows = {}
+    for instance, event_type in changes:
+        shard = shards.shard_for_instance(instance) if shards is not None else PRIMARY_SHARD
+        rows.setdefault(shard, []).append({
+            'donation_id': instance.id,
+            'event_type': event_type,
+            'actor_id': actor_id,
+            'payload': event_payload(instance),
+            'created_at': now,
+        })
+    for shard, shard_rows in rows.items():
+        # The connection the flush used for this shard, so the event shares its transaction
+        connection = session.connection(
+            bind_arguments={'mapper': sa.inspect(DonationEvent), 'shard_id': shard}
+        )
+        connection.execute(DonationEvent.__table__.insert(), shard_rows)
+
+
+def bulk_events(event_type, *criteria, actor_id=None):
+    """INSERT ... SELECT of an event for every donation matching criteria"""
+    payload = sa.func.json_object(*chain.from_iterable(
+        (sa.literal(field), getattr(Donation, field)) for field in PAYLOAD_FIELDS
+    ))
+    return sa.insert(DonationEvent).from_select(
+        ['donation_id', 'event_type', 'actor_id', 'payload', 'created_at'],
+        sa.select(
+            Donation.id,
+            sa.literal(event_type),
+            sa.literal(actor_id, sa.Integer),
+            payload,
+            sa.literal(datetime.utcnow(), sa.DateTime)
+        ).where(*criteria)
+    )
+
+
+def record_bulk_events(event_type, *criteria, actor_id=None):
+    """
+    Append an event for every donation matching criteria, for set-based
+    statements that bypass the flush. Call it in the same transaction:
+    after an UPDATE, before a DELETE.
+    """
+    statement = bulk_events(event_type, *criteria, actor_id=actor_id)
+    for shard in shard_ids():
+        db.session.execute(statement, bind_arguments={'shard_id': shard})
+
+
+def event_engines():
+    """{shard: engine} of every database holding an outbox"""
+    return dict(current_app.extensions['shards'].engines)
+
+
+def read_checkpoints(consumer=None):
+    """{(consumer, shard): last processed seq}, for one consumer or all"""
+    query = sa.select(EventCheckpoint.consumer, EventCheckpoint.shard, EventCheckpoint.seq)
+    if consumer is not None:
+        query = query.where(EventCheckpoint.consumer == consumer)
+    with db.engine.connect() as conn:
+        return {(name, shard): seq for name, shard, seq in conn.execute(query)}
+
+
+class EventConsumer:
+    """
+    Reads the outbox from a named checkpoint in batches.
+    Delivery is at least once: poll() returns the same events again until
+    ack() stores them, so handlers should be idempotent. A new consumer
+    starts from the oldest event still retained.
+    """
+
+    def __init__(self, name, batch_size=None):
+        self.name = name
+        self.batch_size = batch_size or current_app.config.get('EVENT_BATCH_SIZE', 500)
+        self.engines = event_engines()
+        self.checkpoints = {
+            shard: seq for (_, shard), seq in read_checkpoints(name).items() if shard in self.engines
+        }
+        self._start = 0
+
+    def poll(self, limit=None):
+        """Next events after the checkpoint, in sequence order per shard"""
+        limit = limit or self.batch_size
+        shards = list(self.engines)
+        # Start from a different shard each time so a busy one cannot starve the rest
+        shards = shards[self._start:] + shards[:self._start]
+        self._start = (self._start + 1) % len(shards)
+
+        events = []
+        for shard in shards:
+            if len(events) >= limit:
+                break
+            with self.engines[shard].connect() as conn:
+                rows = conn.execute(
+                    sa.select(*EVENT_COLUMNS)
+                    .where(DonationEvent.seq > self.checkpoints.get(shard, 0))
+                    .order_by(DonationEvent.seq).limit(limit - len(events))
+                )
+                events.extend(Event(shard, *row) for row in rows)
+        return events
+
+    def ack(self, events):
+        """Store the checkpoint past the given events"""
+        latest = {}
+        for item in events:
+            latest[item.shard] = max(latest.get(item.shard, 0), item.seq)
+        if not latest:
+            return
+
+        table = EventCheckpoint.__table__
+        with db.engine.begin() as conn:
+            for shard, seq in latest.items():
+                conn.execute(table.insert().prefix_with('OR IGNORE')
+                             .values(consumer=self.name, shard=shard, seq=0))
+                # Never move backwards if another worker of this consumer got further
+                conn.execute(table.update()
+                             .where(table.c.consumer == self.name, table.c.shard == shard)
+                             .values(seq=sa.func.max(table.c.seq, seq)))
+                self.checkpoints[shard] = max(self.checkpoints.get(shard, 0), seq)
+
+    def run(self, handler, max_batches=None):
+        """
+        Pass batches to handler(events) until caught up, acking each one
+        after the handler returns. Returns the number of events handled.
+        """
+        handled = batches = 0
+        while max_batches is None or batches < max_batches:
+            events = self.poll()
+            if not events:
+                break
+            handler(events)
+            self.ack(events)
+            handled += len(events)
+            batches += 1
+        return handled
+
+
+def compact_events(retention_days=None):
+    """
+    Compact events older than the retention period:
+    - events every consumer has processed are deleted
+    - of the rest, only the latest event per donation is kept, so a
+      consumer that falls behind still sees each donation's final state
+    Consumers count once they have acked a batch.
+    Returns {shard: events deleted}.
+    """
+    if retention_days is None:
+        retention_days = current_app.config.get('EVENT_RETENTION_DAYS', 7)
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    checkpoints = read_checkpoints()
+    consumers = {name for name, _ in checkpoints}
+    table = DonationEvent.__table__
+    newer = table.alias('newer')
+
+    deleted = {}
+    for shard, engine in event_engines().items():
+        consumed = [seq for (_, name), seq in checkpoints.items() if name == shard]
+        with engine.begin() as conn:
+            total = 0
+            old = table.c.created_at < cutoff
+            # A consumer with no checkpoint on this shard has processed nothing there
+            if len(consumed) == len(consumers):
+                processed = table.c.seq <= min(consumed) if consumed else sa.true()
+                total += conn.execute(table.delete().where(old, processed)).rowcount
+            total += conn.execute(table.delete().where(old, sa.exists().where(
+                newer.c.donation_id == table.c.donation_id, newer.c.seq > table.c.seq
+            ))).rowcount
+        deleted[shard] = total
+    return deleted
+
+
+@click.group('events')
+def events_command():
+    """Inspect and compact the donation event outbox"""
+
+
+@events_command.command('status')
+@with_appcontext
+def events_status():
+    """Show the latest event per shard and how far each consumer has got"""
+    heads = {}
+    for shard, engine in event_engines().items():
+        with engine.connect() as conn:
+            heads[shard], total = conn.execute(
+                sa.select(sa.func.max(DonationEvent.seq), sa.func.count())
+            ).one()
+        click.echo(f'{shard:<20} {total:>10} events, latest {heads[shard] or 0}')
+    for (consumer, shard), seq in sorted(read_checkpoints().items()):
+        lag = (heads.get(shard) or 0) - seq
+        click.echo(f'  {consumer:<18} {shard:<20} at {seq} ({lag} behind)')
+
+
+@events_command.command('compact')
+@click.option('--retention-days', type=int, help='Defaults to EVENT_RETENTION_DAYS')
+@with_appcontext
+def events_compact(retention_days):
+    """Delete processed events and superseded events past the retention period"""
+    for shard, total in compact_events(retention_days).items():
+        click.echo(f'{shard:<20} {total:>10} events deleted')
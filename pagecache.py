@@ -0,0 +1,154 @@
+"""
+Full-page cache for Food Rescue App
+Pages anonymous visitors see (home, about) are the same for all of them
+until the data behind them changes. Views decorated with cached_page keep
+their rendered response in a bounded in-memory LRU per process, keyed by
+path and a data version: a counter bumped whenever a database file the
+views read has a commit, from any connection or process. It is read with
+SQLite's PRAGMA data_version on a connection kept for the purpose, so a
+hit costs one pragma per file instead of the view's queries and render,
+and writes pay nothing. Responses carry an ETag so browsers and proxies
+can revalidate with If-None-Match.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from flask import current_app, request, session
+from flask_login import current_user
+
+from models import db
+
+CachedPage = namedtuple('CachedPage', 'version body mimetype etag')
+
+
+class DataVersion:
+    """Counter bumped on every commit to the watched SQLite files, by any connection"""
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.version = 0
+        self._seen = None
+        self._connections = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def current(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections inherited across fork belong to the parent
+                self._connections, self._pid = {}, os.getpid()
+            seen = [self._state(path) for path in self.paths]
+            if seen != self._seen:
+                self._seen = seen
+                self.version += 1
+            return self.version
+
+    def _state(self, path):
+        # data_version only counts commits made by other connections, so
+        # this one never writes. A replaced file (a new replica) needs a new one.
+        try:
+            inode = os.stat(path).st_ino
+        except FileNotFoundError:
+            return None
+        connection, opened_inode = self._connections.get(path, (None, None))
+        if connection is None or opened_inode != inode:
+            connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+            self._connections[path] = (connection, inode)
+        return inode, connection.execute('PRAGMA data_version').fetchone()[0]
+
+
+class PageCache:
+    """Bounded LRU of rendered pages by path, each stored with the data version it was rendered at"""
+
+    def __init__(self, size, versions):
+        self.size = size
+        self.versions = versions
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, version):
+        with self._lock:
+            page = self._pages.get(path)
+            if page is None or page.version != version:
+                return None
+            self._pages.move_to_end(path)
+            return page
+
+    def put(self, path, version, body, mimetype):
+        page = CachedPage(version, body, mimetype, hashlib.blake2b(body, digest_size=16).hexdigest())
+        with self._lock:
+            self._pages[path] = page
+            self._pages.move_to_end(path)
+            while len(self._pages) > self.size:
+                self._pages.popitem(last=False)
+        return page
+
+
+def watched_paths():
+    """Database files cached views read from, or None if one is not an SQLite file"""
+    engines = list(current_app.extensions['shards'].engines.values())
+    if not engines:
+        engines = [db.engine]
+    paths = []
+    for engine in engines:
+        if engine.dialect.name != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+            return None
+        paths.append(os.path.abspath(engine.url.database))
+    routing = current_app.extensions.get('read_routing')
+    if routing is not None and routing.mode == 'snapshot':
+        paths.append(os.path.abspath(routing.replica_path))
+    return paths
+
+
+def page_cache():
+    """The app's page cache, or None when it is turned off or cannot see writes"""
+    app = current_app._get_current_object()
+    if not app.config.get('PAGE_CACHE_SIZE'):
+        return None
+    if 'page_cache' not in app.extensions:
+        paths = watched_paths()
+        cache = PageCache(app.config['PAGE_CACHE_SIZE'], DataVersion(paths)) if paths else None
+        app.extensions.setdefault('page_cache', cache)
+    return app.extensions['page_cache']
+
+
+def cached_page(view):
+    """
+    Serve a GET view's response to anonymous visitors from the page cache.
+    Visitors with flashed messages, and signed-in users, get a fresh render.
+    """
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        cache = page_cache()
+        if cache is None or current_user.is_authenticated or '_flashes' in session:
+            response = current_app.make_response(view(*args, **kwargs))
+            response.vary.add('Cookie')
+            if current_user.is_authenticated:
+                response.cache_control.private = True
+            return response
+
+        # Read the version first: a write racing the render is seen next time
+        version = cache.versions.current()
+        page = cache.get(request.path, version)
+        if page is None:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or session.modified:
+                response.vary.add('Cookie')
+                return response
+            page = cache.put(request.path, version, response.get_data(), response.mimetype)
+
+        response = current_app.response_class(page.body, mimetype=page.mimetype)
+        response.set_etag(page.etag)
+        response.vary.add('Cookie')
+        response.cache_control.public = True
+        max_age = current_app.config.get('PAGE_CACHE_MAX_AGE', 0)
+        if max_age:
+            response.cache_control.max_age = max_age
+        else:
+            response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    return decorated_view
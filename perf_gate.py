@@ -0,0 +1,278 @@
+"""
+Performance Regression Gate - Compare key routes against perf_baseline.json
+Seeds a throwaway database, runs fixed request scenarios and fails when one
+issues more SQL statements, fetches more rows or runs slower than the
+committed baseline allows.
+Usage: python perf_gate.py            # check, exit status 1 on regressions
+       python perf_gate.py --update   # record a new baseline after a deliberate change
+Never touches database/foodapp.db.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Point the app at a scratch database, with every optional layer in its default state
+_tmpdir = tempfile.mkdtemp(prefix='foodapp-gate-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'gate.db')
+os.environ['RATE_LIMIT_STORAGE'] = 'off'
+os.environ['DATABASE_READ_ROUTING'] = 'off'
+os.environ['DONATION_SHARDS'] = ''
+os.environ['AVAILABLE_READ_MODEL'] = 'true'
+os.environ['PROFILE_ENDPOINTS'] = ''
+os.environ['PROFILE_SAMPLE_RATE'] = '0'
+os.environ['PROFILE_DIR'] = os.path.join(_tmpdir, 'profiles')
+os.environ['JOB_WORKERS'] = '0'
+# Buffered last_login writes are flushed at exit, not inside another scenario's counts
+os.environ['USER_WRITE_BEHIND_SECONDS'] = '3600'
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+import seed
+from app import create_app
+from models import db, User, Donation
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perf_baseline.json')
+
+# Seeded data: the same rows relative to today on every run
+SEED_ARGS = ['--companies', '20', '--volunteers', '200', '--donations', '20000', '--seed', '42']
+
+# A median may grow by TIME_TOLERANCE and NOISE_SPREADS times the baseline's
+# spread (scaled up on a slower machine) plus TIME_FLOOR_MS before it fails.
+# A slow median is measured again with RETRY_FACTOR times the rounds first.
+TIME_TOLERANCE = 1.5
+NOISE_SPREADS = 3
+TIME_FLOOR_MS = 1.0
+RETRY_FACTOR = 3
+
+# Rows may vary a little as 'today' moves through the seeded expiry dates
+ROWS_TOLERANCE = 1.1
+ROWS_FLOOR = 5
+
+
+class Counters:
+    """SQL statements executed and rows fetched since the last reset"""
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+
+    def reset(self):
+        self.statements = self.rows = 0
+
+    def count_row(self, cursor, row):
+        self.rows += 1
+        return row
+
+    def install(self):
+        @event.listens_for(Engine, 'before_cursor_execute')
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            self.statements += 1
+
+        # SQLAlchemy leaves sqlite3's row factory unused: count rows there
+        @event.listens_for(Pool, 'checkout')
+        def count_rows(dbapi_connection, connection_record, connection_proxy):
+            dbapi_connection.row_factory = self.count_row
+
+
+counters = Counters()
+
+
+def calibrate():
+    """Milliseconds for a fixed pure-Python workload; time limits scale with it"""
+    timings = []
+    for _ in range(5):
+        start = time.perf_counter()
+        sorted(str(i * 7919 % 10007) for i in range(200000))
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+class Gate:
+    """The seeded app, its fixtures and the scenarios run against it"""
+
+    def __init__(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            seed.seed(seed.parse_args(SEED_ARGS + ['--reset']))
+        self.app = create_app()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        # Measure rendering the pages, not serving them from the page cache
+        self.app.config['PAGE_CACHE_SIZE'] = 0
+        with self.app.app_context():
+            self.company_id = User.query.filter_by(email=f'company1@{seed.SEED_EMAIL_DOMAIN}').one().id
+            self.volunteer_id = User.query.filter_by(email=f'volunteer1@{seed.SEED_EMAIL_DOMAIN}').one().id
+            self.available_ids = [row.id for row in db.session.query(Donation.id)
+                                  .filter_by(status='available').order_by(Donation.id)]
+        self.company = self.logged_in_client(self.company_id)
+        self.volunteer = self.logged_in_client(self.volunteer_id)
+        self.claims = 0
+
+    def logged_in_client(self, user_id):
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(user_id)
+            sess['_fresh'] = True
+        return client
+
+    def home(self):
+        return self.app.test_client().get('/'), 200
+
+    def company_dashboard(self):
+        return self.company.get('/dashboard/company'), 200
+
+    def volunteer_dashboard(self):
+        return self.volunteer.get('/dashboard/volunteer'), 200
+
+    def login(self):
+        return self.app.test_client().post('/login', data={
+            'email': f'volunteer1@{seed.SEED_EMAIL_DOMAIN}', 'password': seed.SEED_PASSWORD
+        }), 302
+
+    def add(self):
+        return self.company.post('/donation/add', data={
+            'item_name': 'Gate bread',
+            'description': 'Perf gate donation',
+            'category': 'bakery',
+            'expiry_date': (datetime.now().date() + timedelta(days=3)).isoformat(),
+            'quantity': 5,
+        }), 302
+
+    def claim(self):
+        # A different available donation each round
+        donation_id = self.available_ids[self.claims]
+        self.claims += 1
+        return self.volunteer.post(f'/donation/{donation_id}/claim'), 200
+
+
+# Scenario -> (Gate method, timed rounds). Reads run before writes so every
+# run sees the same data. Login rounds are few: password hashing dominates.
+SCENARIOS = {
+    'home': (Gate.home, 30),
+    'company_dashboard': (Gate.company_dashboard, 20),
+    'volunteer_dashboard': (Gate.volunteer_dashboard, 20),
+    'login': (Gate.login, 3),
+    'add': (Gate.add, 30),
+    'claim': (Gate.claim, 30),
+}
+
+
+def measure(gate, name, rounds):
+    """
+    Run a scenario once untimed, then rounds times. Returns {statements,
+    rows (most seen in a round), median_ms, spread_ms}.
+    """
+    method, _ = SCENARIOS[name]
+    response, expected = method(gate)
+    if response.status_code != expected:
+        raise RuntimeError(f'{name}: status {response.status_code}, expected {expected}')
+
+    timings, statements, rows = [], 0, 0
+    for _ in range(rounds):
+        counters.reset()
+        start = time.perf_counter()
+        method(gate)
+        timings.append(time.perf_counter() - start)
+        statements = max(statements, counters.statements)
+        rows = max(rows, counters.rows)
+    median = statistics.median(timings)
+    # Median absolute deviation, scaled to match a standard deviation
+    spread = statistics.median(abs(t - median) for t in timings) * 1.4826
+    return {'statements': statements, 'rows': rows,
+            'median_ms': round(median * 1000, 3), 'spread_ms': round(spread * 1000, 3)}
+
+
+def time_limit(baseline, speed):
+    return ((baseline['median_ms'] + NOISE_SPREADS * baseline['spread_ms']) * TIME_TOLERANCE * speed
+            + TIME_FLOOR_MS)
+
+
+def regressions(name, baseline, result, speed):
+    """Readable reasons a scenario result is worse than its baseline"""
+    problems = []
+    if result['statements'] > baseline['statements']:
+        problems.append(f"{name}: {result['statements']} SQL statements, baseline {baseline['statements']} "
+                        f"(+{result['statements'] - baseline['statements']})")
+    rows_limit = baseline['rows'] * ROWS_TOLERANCE + ROWS_FLOOR
+    if result['rows'] > rows_limit:
+        problems.append(f"{name}: {result['rows']} rows fetched, baseline {baseline['rows']} "
+                        f"(limit {rows_limit:.0f})")
+    limit = time_limit(baseline, speed)
+    if result['median_ms'] > limit:
+        problems.append(f"{name}: median {result['median_ms']:.1f} ms, baseline {baseline['median_ms']:.1f} ms "
+                        f"(limit {limit:.1f} ms, {result['median_ms'] / baseline['median_ms']:.1f}x)")
+    return problems
+
+
+def run(args):
+    counters.install()
+    gate = Gate()
+    calibration = calibrate()
+    results = {name: measure(gate, name, rounds * args.rounds) for name, (_, rounds) in SCENARIOS.items()}
+
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump({'calibration_ms': round(calibration, 3), 'seed': SEED_ARGS, 'scenarios': results},
+                      f, indent=2)
+            f.write('\n')
+        print(f"Baseline written to {args.baseline}")
+        for name, result in results.items():
+            print(f"  {name:<20} {result['statements']:4} statements {result['rows']:7} rows "
+                  f"{result['median_ms']:9.1f} ms")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('seed') != SEED_ARGS:
+        sys.exit(f"{args.baseline} was recorded with other seed data; run with --update")
+    # Only ever loosen limits: calibration is itself noisy
+    speed = max(1.0, calibration / baseline['calibration_ms'])
+    print(f"Machine speed factor {speed:.2f} (time limits scale with it)")
+    print(f"  {'scenario':<20} {'statements':>14} {'rows':>17} {'median ms':>24}")
+
+    failures = []
+    for name, result in results.items():
+        expected = baseline['scenarios'].get(name)
+        if expected is None:
+            print(f"  {name:<20} not in the baseline; run with --update")
+            continue
+        problems = regressions(name, expected, result, speed)
+        if any('median' in problem for problem in problems):
+            # Confirm a slow run before failing on it: noise rarely repeats
+            _, rounds = SCENARIOS[name]
+            retry = measure(gate, name, rounds * args.rounds * RETRY_FACTOR)
+            result['median_ms'] = min(result['median_ms'], retry['median_ms'])
+            problems = regressions(name, expected, result, speed)
+        print(f"  {name:<20} {expected['statements']:>5} -> {result['statements']:<5} "
+              f"{expected['rows']:>7} -> {result['rows']:<7} "
+              f"{expected['median_ms']:>8.1f} -> {result['median_ms']:<8.1f} "
+              f"{'FAIL' if problems else 'ok'}")
+        failures.extend(problems)
+
+    if failures:
+        print(f"\n{len(failures)} regression(s):")
+        for problem in failures:
+            print(f"  {problem}")
+        print("If a change is deliberate, record it with: python perf_gate.py --update")
+        return 1
+    print("No regressions.")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Food Rescue App performance regression gate')
+    parser.add_argument('--update', action='store_true', help='record the results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--rounds', type=int, default=1, help='multiply every scenario\'s rounds')
+    return run(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
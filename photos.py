@@ -0,0 +1,220 @@
+"""
+Donation photos for Food Rescue App
+Uploads are streamed to a temporary file under UPLOAD_FOLDER and hashed as
+they arrive, then linked into place under their SHA-256, so the same photo
+uploaded twice is stored once and never buffered in memory. Thumbnails are
+made by a photos.thumbnail job in a pool of worker processes, off the
+request path. A file's name is its content hash, so both sizes are served
+as immutable, with range requests.
+
+    UPLOAD_FOLDER/photos/ab/ab12...ef.jpg    original
+    UPLOAD_FOLDER/thumbs/ab/ab12...ef.jpg    thumbnail, always JPEG
+"""
+import atexit
+import hashlib
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import Request, current_app, send_file, url_for
+
+from jobs import enqueue, job
+
+PHOTO_DIRS = {'original': 'photos', 'thumb': 'thumbs'}
+NAME_PATTERN = re.compile(r'^[0-9a-f]{64}\.(jpg|png|gif|webp)$')
+MIMETYPES = {'jpg': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif', 'webp': 'image/webp'}
+
+# Shown while a thumbnail is still being made; browsers ask again next time
+PLACEHOLDER_SVG = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="480" height="360" viewBox="0 0 4 3">'
+    '<rect width="4" height="3" fill="#e9ecef"/></svg>'
+)
+
+
+def image_type(head):
+    """File extension for the first bytes of a JPEG, PNG, GIF or WebP image, else None"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def sniff_image_type(stream):
+    """image_type() of a readable stream, leaving it at the start"""
+    stream.seek(0)
+    head = stream.read(16)
+    stream.seek(0)
+    return image_type(head)
+
+
+class HashingFile:
+    """Temporary upload file that hashes what is written to it, so storing it needs no second pass"""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def close(self):
+        # Stored uploads are linked elsewhere first: the temporary name always goes
+        self._file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """Request whose uploaded files are written straight to HashingFiles on disk"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingFile(upload_dir('tmp'))
+
+
+def upload_dir(*parts):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], *parts)
+
+
+def photo_path(kind, name):
+    return upload_dir(PHOTO_DIRS[kind], name[:2], name)
+
+
+def thumbnail_name(name):
+    return name.rsplit('.', 1)[0] + '.jpg'
+
+
+def thumbnail_url(name):
+    return url_for('main.photo', kind='thumb', name=thumbnail_name(name)) if name else None
+
+
+def store_photo(upload):
+    """
+    Store an uploaded image (a FileStorage) under its content hash and
+    return its name. Raises ValueError if it is not a supported image.
+    """
+    stream = upload.stream
+    if not isinstance(stream, HashingFile):
+        # Not parsed by UploadRequest: copy it through one
+        copy = HashingFile(upload_dir('tmp'))
+        shutil.copyfileobj(stream, copy)
+        upload.stream = stream = copy
+    stream.flush()
+    kind = sniff_image_type(stream)
+    if kind is None:
+        raise ValueError('Photos must be JPEG, PNG, GIF or WebP images')
+
+    name = f'{stream.hexdigest()}.{kind}'
+    path = photo_path('original', name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(stream.path, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # No hard links here (another filesystem): copy, then rename into place
+            partial = f'{stream.path}.copy'
+            shutil.copyfile(stream.path, partial)
+            os.replace(partial, path)
+    return name
+
+
+def make_thumbnail(source, target, max_px, quality):
+    """Write a JPEG of source no larger than max_px on either side; runs in the pool's processes"""
+    # Only the worker processes need Pillow
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as image:
+        # Lets the JPEG decoder skip detail the thumbnail will not show
+        image.draft('RGB', (max_px, max_px))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_px, max_px))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        partial = f'{target}.{os.getpid()}.tmp'
+        image.save(partial, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(partial, target)
+    return os.path.getsize(target)
+
+
+_pool_lock = threading.Lock()
+
+
+def thumbnail_pool():
+    """This process's pool of thumbnail processes, started on first use"""
+    app = current_app._get_current_object()
+    pool, pid = app.extensions.get('thumbnail_pool', (None, None))
+    if pool is None or pid != os.getpid():
+        with _pool_lock:
+            pool, pid = app.extensions.get('thumbnail_pool', (None, None))
+            if pool is None or pid != os.getpid():
+                # Spawned, not forked: this process runs threads
+                pool = ProcessPoolExecutor(max_workers=app.config['PHOTO_THUMBNAIL_PROCESSES'],
+                                           mp_context=multiprocessing.get_context('spawn'))
+                app.extensions['thumbnail_pool'] = (pool, os.getpid())
+                atexit.register(pool.shutdown, cancel_futures=True)
+    return pool
+
+
+def request_thumbnail(name):
+    """Queue the thumbnail of a stored photo, to be made once the transaction commits"""
+    enqueue('photos.thumbnail', photo=name)
+
+
+@job('photos.thumbnail')
+def thumbnail_job(photo):
+    target = photo_path('thumb', thumbnail_name(photo))
+    if os.path.exists(target):
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    config = current_app.config
+    future = thumbnail_pool().submit(make_thumbnail, photo_path('original', photo), target,
+                                     config['PHOTO_THUMBNAIL_PX'], config['PHOTO_THUMBNAIL_QUALITY'])
+    future.result(timeout=config['PHOTO_THUMBNAIL_TIMEOUT'])
+
+
+def serve_photo(kind, name):
+    """Response for a stored photo or thumbnail, or None if there is no such file"""
+    if not NAME_PATTERN.match(name) or kind == 'thumb' and not name.endswith('.jpg'):
+        return None
+    path = photo_path(kind, name)
+    if not os.path.exists(path):
+        if kind != 'thumb' or not any(
+                os.path.exists(photo_path('original', f'{name[:-4]}.{ext}')) for ext in MIMETYPES):
+            return None
+        response = current_app.response_class(PLACEHOLDER_SVG, mimetype='image/svg+xml')
+        response.cache_control.no_store = True
+        return response
+
+    # The name is the content hash: it is the ETag, and the file never changes
+    response = send_file(path, mimetype=MIMETYPES[name.rsplit('.', 1)[1]], conditional=True,
+                         etag=name.split('.')[0], max_age=current_app.config['PHOTO_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.accept_ranges = 'bytes'
+    return response
+
+
+def init_photos(app):
+    """Stream this app's uploads to disk (see UploadRequest)"""
+    app.request_class = UploadRequest
@@ -0,0 +1,433 @@
+"""
+Request profiling for Food Rescue App
+Profiles the endpoints in PROFILE_ENDPOINTS plus a PROFILE_SAMPLE_RATE
+fraction of all other requests, aggregated per endpoint:
+- 'sampling': the request thread's stack every PROFILE_INTERVAL seconds,
+  written as collapsed stacks for flamegraph.pl, inferno or speedscope
+- 'cprofile': deterministic cProfile data, written as pstats files
+Both record how many SQL statements each endpoint runs and how long they take.
+
+`flask profile on|off` switches profiling at runtime by writing a file every
+worker rereads every PROFILE_REFRESH_SECONDS. Each worker writes its totals
+under PROFILE_DIR/workers/; `flask profile report` merges them. When nothing
+is profiled, a request costs one set lookup.
+"""
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import random
+import shutil
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+
+import click
+from flask import current_app, g, request
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_MODES = ('sampling', 'cprofile')
+
+# Runtime settings written by `flask profile on|off`
+TOGGLE_FILE = 'profiling.json'
+
+# Distinct statements timed per endpoint; later ones are counted together
+MAX_STATEMENTS = 500
+OTHER_STATEMENTS = '(other statements)'
+
+# SQL timings of the request running on this thread, None when not profiled
+_local = threading.local()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _statement_started(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, 'sql', None) is not None:
+        _local.statement_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _statement_finished(conn, cursor, statement, parameters, context, executemany):
+    sql = getattr(_local, 'sql', None)
+    if sql is not None:
+        elapsed = time.perf_counter() - _local.statement_started
+        timing = sql.get(statement)
+        if timing is None:
+            sql[statement] = [1, elapsed]
+        else:
+            timing[0] += 1
+            timing[1] += elapsed
+
+
+def frame_label(code, _labels={}):
+    """'function (package/module.py:line)', as flamegraph tools expect"""
+    label = _labels.get(code)
+    if label is None:
+        path = '/'.join(code.co_filename.replace(os.sep, '/').split('/')[-2:])
+        label = _labels[code] = f'{code.co_name} ({path}:{code.co_firstlineno})'
+    return label
+
+
+class StackSampler:
+    """
+    One background thread sampling the stacks of the threads being
+    profiled; it exits when there are none left.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, ident):
+        with self._lock:
+            self._watched[ident] = Counter()
+            # is_alive() is False in a forked child, which must start its own
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+                self._thread.start()
+
+    def unwatch(self, ident):
+        """Stop sampling a thread; returns Counter({stack: samples})"""
+        with self._lock:
+            return self._watched.pop(ident, Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                if not self._watched:
+                    self._thread = None
+                    return
+                for ident, samples in self._watched.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    # Code objects, outermost first; labelled only when written out
+                    codes = []
+                    while frame is not None:
+                        codes.append(frame.f_code)
+                        frame = frame.f_back
+                    codes.reverse()
+                    samples[tuple(codes)] += 1
+            del frames
+
+
+def _new_totals():
+    return {'requests': 0, 'seconds': 0.0, 'statements': 0, 'sql_seconds': 0.0, 'sql': {}}
+
+
+def _add_sql(totals, statement, count, seconds):
+    sql = totals['sql']
+    if statement not in sql and len(sql) >= MAX_STATEMENTS:
+        statement = OTHER_STATEMENTS
+    timing = sql.setdefault(statement, [0, 0.0])
+    timing[0] += count
+    timing[1] += seconds
+
+
+def _write_atomic(path, write, mode='w'):
+    partial = f'{path}.{os.getpid()}.tmp'
+    with open(partial, mode) as f:
+        write(f)
+    os.replace(partial, path)
+
+
+def write_collapsed(path, stacks):
+    """Write Counter({'a;b;c': samples}) in the collapsed stack format"""
+    _write_atomic(path, lambda f: f.writelines(
+        f'{stack} {samples}\n' for stack, samples in sorted(stacks.items())
+    ))
+
+
+def read_collapsed(path):
+    stacks = Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, samples = line.rstrip('\n').rpartition(' ')
+            if stack:
+                stacks[stack] += int(samples)
+    return stacks
+
+
+class RequestProfiler:
+    """Per-app profiling settings and this worker's totals per endpoint"""
+
+    def __init__(self, app):
+        self.dir = app.config.get('PROFILE_DIR') or os.path.join(app.instance_path, 'profiles')
+        self.toggle_path = os.path.join(self.dir, TOGGLE_FILE)
+        self.worker_dir = os.path.join(self.dir, 'workers', f'{socket.gethostname()}-{os.getpid()}')
+        self.defaults = {
+            'endpoints': list(app.config.get('PROFILE_ENDPOINTS', [])),
+            'sample_rate': app.config.get('PROFILE_SAMPLE_RATE', 0.0),
+            'mode': app.config.get('PROFILE_MODE', 'sampling'),
+            'session': None,
+        }
+        self.refresh_seconds = app.config.get('PROFILE_REFRESH_SECONDS', 5)
+        self.sampler = StackSampler(app.config.get('PROFILE_INTERVAL', 0.005))
+        self._lock = threading.Lock()
+        self._toggle_mtime = None
+        self._next_refresh = 0.0
+        self.session = None
+        self._reset()
+        self._apply(self.defaults)
+
+    def _reset(self):
+        self.totals = {}
+        self.stacks = {}
+        self.stats = {}
+        self._dirty = False
+
+    def _apply(self, settings):
+        mode = settings.get('mode', 'sampling')
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown PROFILE_MODE: {mode}')
+        self.mode = mode
+        self.endpoints = frozenset(settings.get('endpoints', ()))
+        self.sample_rate = float(settings.get('sample_rate') or 0.0)
+        # `flask profile on` starts a new session: drop totals from the last one
+        if settings.get('session') != self.session:
+            self.session = settings.get('session')
+            self._reset()
+
+    def refresh(self, now=None):
+        """Reread the toggle file if it changed, and write out new totals"""
+        self._next_refresh = (now or time.monotonic()) + self.refresh_seconds
+        try:
+            mtime = os.stat(self.toggle_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self._lock:
+            if mtime != self._toggle_mtime:
+                self._toggle_mtime = mtime
+                settings = self.defaults
+                if mtime is not None:
+                    try:
+                        with open(self.toggle_path) as f:
+                            settings = json.load(f)
+                    except (OSError, ValueError) as e:
+                        current_app.logger.error(f"Profiling toggle error: {str(e)}")
+                self._apply(settings)
+        self.flush()
+
+    def wants(self, endpoint):
+        """Whether to profile a request to endpoint"""
+        now = time.monotonic()
+        if now >= self._next_refresh:
+            self.refresh(now)
+        if endpoint in self.endpoints:
+            return True
+        return self.sample_rate > 0 and endpoint is not None and random.random() < self.sample_rate
+
+    def start(self):
+        """Start profiling the current request on this thread"""
+        _local.sql = {}
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+        else:
+            profile = None
+            self.sampler.watch(threading.get_ident())
+        g._profile = (profile, time.perf_counter())
+
+    def finish(self, endpoint, profile, started):
+        """Stop profiling the current request and add it to the endpoint's totals"""
+        elapsed = time.perf_counter() - started
+        sql, _local.sql = _local.sql, None
+        if profile is not None:
+            profile.disable()
+        else:
+            stacks = self.sampler.unwatch(threading.get_ident())
+
+        with self._lock:
+            totals = self.totals.setdefault(endpoint, _new_totals())
+            totals['requests'] += 1
+            totals['seconds'] += elapsed
+            for statement, (count, seconds) in sql.items():
+                totals['statements'] += count
+                totals['sql_seconds'] += seconds
+                _add_sql(totals, statement, count, seconds)
+            if profile is not None:
+                if endpoint in self.stats:
+                    self.stats[endpoint].add(profile)
+                else:
+                    self.stats[endpoint] = pstats.Stats(profile)
+            else:
+                self.stacks.setdefault(endpoint, Counter()).update(stacks)
+            self._dirty = True
+
+    def flush(self):
+        """Write this worker's totals under PROFILE_DIR/workers/"""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            os.makedirs(self.worker_dir, exist_ok=True)
+            for endpoint, stacks in self.stacks.items():
+                collapsed = Counter()
+                for codes, samples in stacks.items():
+                    collapsed[';'.join(map(frame_label, codes))] += samples
+                write_collapsed(os.path.join(self.worker_dir, f'{endpoint}.collapsed'), collapsed)
+            for endpoint, stats in self.stats.items():
+                stats.dump_stats(os.path.join(self.worker_dir, f'{endpoint}.prof'))
+            summary = {'session': self.session, 'endpoints': self.totals}
+            _write_atomic(os.path.join(self.worker_dir, 'summary.json'), lambda f: json.dump(summary, f))
+
+
+def init_profiling(app):
+    """Set up the profiler and its request hooks for an app"""
+    profiler = RequestProfiler(app)
+    app.extensions['profiler'] = profiler
+    atexit.register(profiler.flush)
+
+    @app.before_request
+    def start_profile():
+        if profiler.wants(request.endpoint):
+            profiler.start()
+
+    @app.teardown_request
+    def finish_profile(exc):
+        state = g.pop('_profile', None)
+        if state is not None:
+            profiler.finish(request.endpoint, *state)
+
+    return profiler
+
+
+def read_settings(profiler):
+    """(settings, source) in force: the toggle file's, or the config's"""
+    try:
+        with open(profiler.toggle_path) as f:
+            return json.load(f), profiler.toggle_path
+    except (OSError, ValueError):
+        return profiler.defaults, 'config'
+
+
+def write_settings(profiler, settings):
+    os.makedirs(profiler.dir, exist_ok=True)
+    _write_atomic(profiler.toggle_path, lambda f: json.dump(settings, f))
+
+
+def merge_profiles(profiler=None):
+    """
+    Merge every worker's files of the current session into PROFILE_DIR:
+    <endpoint>.collapsed and <endpoint>.prof.
+    Returns {endpoint: totals} with 'samples' and the merged file paths.
+    """
+    profiler = profiler or current_app.extensions['profiler']
+    settings, _ = read_settings(profiler)
+    workers = os.path.join(profiler.dir, 'workers')
+    merged, stacks, stats = {}, {}, {}
+    for worker in sorted(os.listdir(workers)) if os.path.isdir(workers) else ():
+        path = os.path.join(workers, worker)
+        try:
+            with open(os.path.join(path, 'summary.json')) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if summary.get('session') != settings.get('session'):
+            continue
+        for endpoint, worker_totals in summary['endpoints'].items():
+            totals = merged.setdefault(endpoint, _new_totals())
+            for key in ('requests', 'seconds', 'statements', 'sql_seconds'):
+                totals[key] += worker_totals[key]
+            for statement, (count, seconds) in worker_totals['sql'].items():
+                _add_sql(totals, statement, count, seconds)
+            collapsed = os.path.join(path, f'{endpoint}.collapsed')
+            if os.path.exists(collapsed):
+                stacks.setdefault(endpoint, Counter()).update(read_collapsed(collapsed))
+            prof = os.path.join(path, f'{endpoint}.prof')
+            if os.path.exists(prof):
+                if endpoint in stats:
+                    stats[endpoint].add(prof)
+                else:
+                    stats[endpoint] = pstats.Stats(prof)
+
+    for endpoint, totals in merged.items():
+        totals['samples'] = sum(stacks.get(endpoint, {}).values())
+        totals['files'] = []
+        if endpoint in stacks:
+            path = os.path.join(profiler.dir, f'{endpoint}.collapsed')
+            write_collapsed(path, stacks[endpoint])
+            totals['files'].append(path)
+        if endpoint in stats:
+            path = os.path.join(profiler.dir, f'{endpoint}.prof')
+            stats[endpoint].dump_stats(path)
+            totals['files'].append(path)
+    return merged
+
+
+@click.group('profile')
+def profile_command():
+    """Switch request profiling on or off and merge its results"""
+
+
+@profile_command.command('on')
+@click.argument('endpoints', nargs=-1)
+@click.option('--sample-rate', default=0.0, show_default=True,
+              help='Fraction of requests to any other endpoint to profile too')
+@click.option('--mode', type=click.Choice(PROFILE_MODES), default='sampling', show_default=True)
+@with_appcontext
+def profile_on(endpoints, sample_rate, mode):
+    """Profile ENDPOINTS (e.g. main.dashboard_volunteer), starting a new session"""
+    if not endpoints and not sample_rate:
+        raise click.UsageError('Name at least one endpoint or set --sample-rate.')
+    known = set(current_app.view_functions)
+    unknown = [endpoint for endpoint in endpoints if endpoint not in known]
+    if unknown:
+        raise click.BadParameter(f"Unknown endpoint(s): {', '.join(unknown)}", param_hint='ENDPOINTS')
+    profiler = current_app.extensions['profiler']
+    # Results of earlier sessions would never be merged again
+    shutil.rmtree(os.path.join(profiler.dir, 'workers'), ignore_errors=True)
+    write_settings(profiler, {
+        'endpoints': list(endpoints), 'sample_rate': sample_rate, 'mode': mode, 'session': time.time()
+    })
+    click.echo(f'Profiling on; workers pick it up within {profiler.refresh_seconds} seconds.')
+
+
+@profile_command.command('off')
+@with_appcontext
+def profile_off():
+    """Stop profiling, keeping the session's results for `flask profile report`"""
+    profiler = current_app.extensions['profiler']
+    settings, _ = read_settings(profiler)
+    write_settings(profiler, dict(settings, endpoints=[], sample_rate=0.0))
+    click.echo('Profiling off.')
+
+
+@profile_command.command('status')
+@with_appcontext
+def profile_status():
+    """Show what is being profiled"""
+    profiler = current_app.extensions['profiler']
+    settings, source = read_settings(profiler)
+    endpoints = ', '.join(settings.get('endpoints') or []) or 'none'
+    click.echo(f"Mode {settings.get('mode')}, endpoints: {endpoints}, "
+               f"sample rate {settings.get('sample_rate') or 0:g} (from {source})")
+
+
+@profile_command.command('report')
+@click.option('--top', default=5, show_default=True, help='Slowest SQL statements shown per endpoint')
+@with_appcontext
+def profile_report(top):
+    """Merge worker results and summarize them per endpoint"""
+    merged = merge_profiles()
+    if not merged:
+        click.echo('No profiled requests yet.')
+    for endpoint, totals in sorted(merged.items(), key=lambda item: -item[1]['seconds']):
+        requests = totals['requests']
+        click.echo(f"{endpoint:<32} {requests:>6} requests  {totals['seconds'] * 1000 / requests:8.1f} ms avg  "
+                   f"SQL {totals['statements'] / requests:5.1f} statements "
+                   f"{totals['sql_seconds'] * 1000 / requests:8.1f} ms avg")
+        for path in totals['files']:
+            click.echo(f'  {path}')
+        statements = sorted(totals['sql'].items(), key=lambda item: -item[1][1])[:top]
+        for statement, (count, seconds) in statements:
+            click.echo(f"  {seconds * 1000 / requests:8.2f} ms  x{count / requests:<5.1f} "
+                       f"{' '.join(statement.split())[:100]}")
@@ -0,0 +1,86 @@
+"""
+Priority feed ranking for Food Rescue App
+Scores available donations by a weighted blend of closeness, urgency and
+quantity (FEED_WEIGHTS), so an item expiring today 3 km away ranks above a
+fresh one 2 km away. Only the best FEED_SIZE are kept, picked with a bounded
+heap from the donations inside a box FEED_RADIUS_KM around the volunteer
+(from all of them when too few are that close).
+"""
+from math import asin, cos, degrees, radians, sin, sqrt
+
+EARTH_RADIUS_KM = 6371
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance in kilometres, or None if a coordinate is missing"""
+    if None in (lat1, lng1, lat2, lng2):
+        return None
+    lng1, lat1, lng2, lat2 = map(radians, (lng1, lat1, lng2, lat2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2
+    return 2 * asin(sqrt(a)) * EARTH_RADIUS_KM
+
+
+def bounding_box(lat, lng, radius_km):
+    """
+    (min_lat, max_lat, min_lng, max_lng) holding every point within
+    radius_km, or None when the box would cross a pole or the antimeridian.
+    """
+    lat_delta = degrees(radius_km / EARTH_RADIUS_KM)
+    if abs(lat) + lat_delta >= 90:
+        return None
+    lng_delta = lat_delta / cos(radians(abs(lat) + lat_delta))
+    if abs(lng) + lng_delta >= 180:
+        return None
+    return lat - lat_delta, lat + lat_delta, lng - lng_delta, lng + lng_delta
+
+
+class FeedRanker:
+    """
+    Priority score of a donation, higher first. Each part is between 0 and 1:
+    - distance: 1 at the volunteer, 1/2 at distance_scale_km, 1/3 at twice
+                that... (0 without a location)
+    - urgency:  1 on the expiry day, 1/2 the day before, 1/3 two days before...
+                and 0 once it has passed, so unswept expired donations sink
+    - quantity: halves below quantity_scale portions
+    """
+
+    def __init__(self, weights, distance_scale_km, quantity_scale, today):
+        self.distance_weight = weights.get('distance', 0.0)
+        self.urgency_weight = weights.get('urgency', 0.0)
+        self.quantity_weight = weights.get('quantity', 0.0)
+        self.distance_scale_km = distance_scale_km
+        self.quantity_scale = quantity_scale
+        self.today = today.toordinal()
+
+    @classmethod
+    def from_config(cls, config, today):
+        return cls(config['FEED_WEIGHTS'], config['FEED_DISTANCE_SCALE_KM'],
+                   config['FEED_QUANTITY_SCALE'], today)
+
+    def scorer(self, lat=None, lng=None):
+        """
+        score(lat, lng, expiry_ordinal, quantity) of donations seen from
+        (lat, lng), with everything that does not depend on the donation
+        worked out once
+        """
+        today, scale, quantity_scale = self.today, self.distance_scale_km, self.quantity_scale
+        urgency_weight, quantity_weight = self.urgency_weight, self.quantity_weight
+        distance_weight = self.distance_weight * scale
+        located = lat is not None and lng is not None
+        lat1 = radians(lat) if located else 0.0
+        lng1 = radians(lng) if located else 0.0
+        cos_lat1 = cos(lat1)
+
+        def score(lat2, lng2, expiry_ordinal, quantity):
+            days = expiry_ordinal - today
+            total = urgency_weight / (1 + days) if days >= 0 else 0.0
+            # NaN marks a missing location in the read model's arrays
+            if located and lat2 is not None and lng2 is not None and lat2 == lat2:
+                lat2 = radians(lat2)
+                a = sin((lat2 - lat1) / 2) ** 2 + cos_lat1 * cos(lat2) * sin((radians(lng2) - lng1) / 2) ** 2
+                total += distance_weight / (scale + 2 * asin(sqrt(a)) * EARTH_RADIUS_KM)
+            if quantity:
+                total += quantity_weight * quantity / (quantity + quantity_scale)
+            return total
+
+        return score
@@ -0,0 +1,157 @@
+"""
+Rate limiting for Food Rescue App
+Token buckets per client and endpoint, checked before the view runs and
+without touching the database. Buckets live in a fixed-size table of slots:
+- 'memory': a bytearray private to the worker process
+- 'shared': an anonymous shared mmap created by the app factory, so workers
+  forked from a preloaded app (gunicorn --preload) share one budget
+"""
+import hashlib
+import math
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+
+from flask import jsonify, request, session
+from werkzeug.exceptions import TooManyRequests
+
+STORAGE_BACKENDS = ('off', 'memory', 'shared')
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+# Reads are never limited
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Slot layout: key hash, tokens left, time of last update
+SLOT = struct.Struct('=Qdd')
+
+
+def parse_limit(limit):
+    """Turn '10/minute' into (capacity, tokens refilled per second)"""
+    count, _, period = limit.partition('/')
+    period = period.strip().rstrip('s')
+    if period not in PERIODS:
+        raise ValueError(f'Unknown rate limit period in {limit!r}')
+    capacity = int(count)
+    return capacity, capacity / PERIODS[period]
+
+
+class TokenBuckets:
+    """
+    Direct-mapped table of token buckets.
+    A client whose slot is taken over by another key simply starts again
+    with a full bucket, which errs on the side of letting requests through.
+    """
+
+    def __init__(self, slots, shared=False):
+        self.slots = slots
+        if shared:
+            # Anonymous mappings are MAP_SHARED, so forked children see the same pages
+            self._buffer = mmap.mmap(-1, slots * SLOT.size)
+            self._lock = multiprocessing.Lock()
+        else:
+            self._buffer = bytearray(slots * SLOT.size)
+            self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now=None):
+        """Take one token; returns 0 if allowed, else seconds until a token is available"""
+        return self.take_all([(key, capacity, rate)], now)
+
+    def take_all(self, buckets, now=None):
+        """
+        Take one token from each of buckets, (key, capacity, rate) tuples, or
+        from none of them if one is empty; returns 0 if allowed, else the
+        seconds until every bucket has a token
+        """
+        now = time.monotonic() if now is None else now
+        slots = []
+        for key, capacity, rate in buckets:
+            key_hash = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+            slots.append((key_hash, key_hash % self.slots * SLOT.size, capacity, rate))
+
+        wait = 0
+        with self._lock:
+            # Two buckets can share a slot (or be the same bucket): go by what is taken so far
+            taken = {}
+            for key_hash, offset, capacity, rate in slots:
+                stored, tokens, updated = taken.get(offset) or SLOT.unpack_from(self._buffer, offset)
+                if stored != key_hash:
+                    tokens = capacity
+                else:
+                    tokens = min(capacity, tokens + (now - updated) * rate)
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = max(wait, (1 - tokens) / rate)
+                taken[offset] = (key_hash, tokens, now)
+            if not wait:
+                for offset, slot in taken.items():
+                    SLOT.pack_into(self._buffer, offset, *slot)
+        return wait
+
+
+class RateLimiter:
+    """Per-app rate limit rules and bucket storage"""
+
+    def __init__(self, app):
+        self.storage = app.config.get('RATE_LIMIT_STORAGE', 'memory')
+        if self.storage not in STORAGE_BACKENDS:
+            raise ValueError(f'Unknown RATE_LIMIT_STORAGE: {self.storage}')
+
+        self.rules = {}
+        if self.storage != 'off':
+            for endpoint, limits in app.config.get('RATE_LIMITS', {}).items():
+                self.rules[endpoint] = [(scope, *parse_limit(limit)) for scope, limit in limits]
+        self.buckets = TokenBuckets(
+            app.config.get('RATE_LIMIT_SLOTS', 65536),
+            shared=self.storage == 'shared'
+        ) if self.rules else None
+
+    def check(self, endpoint, rules):
+        """
+        Take a token from every bucket of the request, or from none when one
+        of them is empty; returns the longest wait, or 0
+        """
+        buckets = []
+        for scope, capacity, rate in rules:
+            # Flask-Login keeps the user id in the signed session cookie,
+            # so identifying the user needs no database query
+            user_id = session.get('_user_id') if scope == 'user' else None
+            client = f'user:{user_id}' if user_id else f'ip:{request.remote_addr}'
+            buckets.append((f'{endpoint}|{client}', capacity, rate))
+        return self.buckets.take_all(buckets)
+
+
+def too_many_requests(retry_after):
+    """429 response with Retry-After, as JSON for the dashboard's fetch calls"""
+    retry_after = max(1, math.ceil(retry_after))
+    if request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html':
+        return TooManyRequests(retry_after=retry_after).get_response()
+    response = jsonify({'error': f'Too many requests. Try again in {retry_after} seconds.'})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+
+def init_rate_limits(app):
+    """Set up the buckets and the before_request check for an app"""
+    limiter = RateLimiter(app)
+    app.extensions['rate_limiter'] = limiter
+
+    @app.before_request
+    def check_rate_limits():
+        rules = limiter.rules.get(request.endpoint)
+        if rules is None or request.method in SAFE_METHODS:
+            return None
+        retry_after = limiter.check(request.endpoint, rules)
+        if retry_after:
+            return too_many_requests(retry_after)
+        return None
+
+    return limiter
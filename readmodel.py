@@ -0,0 +1,342 @@
+"""
+In-memory read model for Food Rescue App
+Keeps the available donations of every shard in compact parallel arrays so
+the "available near me" lists are filtered and sorted without SQL or ORM
+objects. A trigger-maintained change log gives every donation write a
+version; the model applies only the changes since the version it last saw.
+"""
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from math import cos, radians, sin
+
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from sqlalchemy import text
+
+from models import db, Donation, URGENCY_LEVELS, URGENCY_ORDER
+from ranking import bounding_box
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS donation_change (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        donation_id INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS donation_change_insert
+    AFTER INSERT ON donation BEGIN
+        INSERT INTO donation_change(donation_id) VALUES (new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS donation_change_update
+    AFTER UPDATE OF status, latitude, longitude, expiry_date, category, quantity, created_at
+    ON donation BEGIN
+        INSERT INTO donation_change(donation_id) VALUES (new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS donation_change_delete
+    AFTER DELETE ON donation BEGIN
+        INSERT INTO donation_change(donation_id) VALUES (old.id);
+    END
+    """,
+]
+
+# Latest version handed out (survives pruning) and oldest version still logged
+HEAD_QUERY = text(
+    "SELECT (SELECT seq FROM sqlite_sequence WHERE name = 'donation_change'), "
+    "(SELECT MIN(version) FROM donation_change)"
+)
+
+# Prune the log down to CHANGE_LOG_KEEP versions once it grows past twice that;
+# a process that falls further behind simply rebuilds its model
+CHANGE_LOG_KEEP = 100000
+
+CHANGE_LOG = sa.table('donation_change', sa.column('version'), sa.column('donation_id'))
+
+MODEL_COLUMNS = (
+    Donation.id, Donation.latitude, Donation.longitude, Donation.expiry_date,
+    Donation.category, Donation.quantity, Donation.created_at
+)
+
+
+def init_change_log(engine=None):
+    """
+    Create the change log table and its triggers if missing.
+    Returns False on non-SQLite databases, where the read model is unavailable.
+    """
+    engine = engine or db.engine
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.begin() as conn:
+        for statement in SCHEMA:
+            conn.execute(text(statement))
+    return True
+
+
+def forget_changes(conn, ids):
+    """Delete what the log holds for donations ids, in conn's transaction (rows moved off a shard)"""
+    if sa.inspect(conn).has_table('donation_change'):
+        conn.execute(CHANGE_LOG.delete().where(CHANGE_LOG.c.donation_id.in_(ids)))
+
+
+def clear_change_log(engine=None):
+    """Empty the log after bulk loads; every read model rebuilds on its next query"""
+    with (engine or db.engine).begin() as conn:
+        conn.execute(text('DELETE FROM donation_change'))
+
+
+class AvailableDonations:
+    """
+    Available donations as parallel arrays sorted by id: about 42 bytes per
+    donation instead of a hydrated ORM object per row.
+    """
+
+    def __init__(self, engines):
+        self.engines = engines
+        self.ids = array('q')
+        self.lats = array('d')
+        self.lngs = array('d')
+        self.expiry = array('i')      # date ordinal
+        self.categories = array('B')  # index into category_names
+        self.quantities = array('i')
+        self.created = array('d')     # timestamp
+        self.shards = array('B')      # index into engines
+        self.category_names = [None]
+        self._category_codes = {None: 0}
+        self.versions = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def memory_bytes(self):
+        """Bytes held by the arrays"""
+        return sum(column.itemsize * len(column) for column in self._columns())
+
+    def _columns(self):
+        return (self.ids, self.lats, self.lngs, self.expiry, self.categories,
+                self.quantities, self.created, self.shards)
+
+    def sync(self):
+        """Catch up with every shard's change log; rebuilds if the log was pruned past us"""
+        with self._lock:
+            heads = []
+            for shard_index, engine in enumerate(self.engines):
+                with engine.connect() as conn:
+                    head, oldest = conn.execute(HEAD_QUERY).one()
+                heads.append((head or 0, oldest))
+
+            seen = [self.versions.get(i) for i in range(len(self.engines))]
+            if any(version is None or version < head and (oldest is None or version < oldest - 1)
+                   for version, (head, oldest) in zip(seen, heads)):
+                self._rebuild([head for head, _ in heads])
+                return
+
+            for shard_index, (version, (head, oldest)) in enumerate(zip(seen, heads)):
+                if version < head:
+                    self._apply_changes(shard_index, version, head)
+                if oldest is not None and head - oldest > 2 * CHANGE_LOG_KEEP:
+                    with self.engines[shard_index].begin() as conn:
+                        conn.execute(text('DELETE FROM donation_change WHERE version <= :v'),
+                                     {'v': head - CHANGE_LOG_KEEP})
+
+    def _rebuild(self, heads):
+        # Heads were read before the scan: changes racing it are re-applied next sync
+        for column in self._columns():
+            del column[:]
+        rows = []
+        for shard_index, engine in enumerate(self.engines):
+            self.versions[shard_index] = heads[shard_index]
+            with engine.connect() as conn:
+                rows.extend((row, shard_index) for row in conn.execute(
+                    sa.select(*MODEL_COLUMNS).where(Donation.status == 'available')
+                ))
+        rows.sort(key=lambda item: item[0].id)
+        for row, shard_index in rows:
+            self._append(row, shard_index)
+
+    def _apply_changes(self, shard_index, since, head):
+        # One statement however many rows changed; deleted rows come back as NULLs
+        with self.engines[shard_index].connect() as conn:
+            rows = conn.execute(
+                sa.select(CHANGE_LOG.c.donation_id, *MODEL_COLUMNS, Donation.status).distinct()
+                .select_from(CHANGE_LOG.outerjoin(Donation, Donation.id == CHANGE_LOG.c.donation_id))
+                .where(CHANGE_LOG.c.version > since, CHANGE_LOG.c.version <= head)
+            ).all()
+
+        for row in rows:
+            if row.status == 'available':
+                self._upsert(row, shard_index)
+            else:
+                self._remove(row.donation_id, shard_index)
+        self.versions[shard_index] = head
+
+    def _values(self, row, shard_index):
+        code = self._category_codes.get(row.category)
+        if code is None:
+            code = self._category_codes[row.category] = len(self.category_names)
+            self.category_names.append(row.category)
+        return (
+            row.id,
+            row.latitude if row.latitude is not None else float('nan'),
+            row.longitude if row.longitude is not None else float('nan'),
+            row.expiry_date.toordinal(),
+            code,
+            row.quantity,
+            row.created_at.timestamp() if row.created_at else 0.0,
+            shard_index,
+        )
+
+    def _append(self, row, shard_index):
+        for column, value in zip(self._columns(), self._values(row, shard_index)):
+            column.append(value)
+
+    def _upsert(self, row, shard_index):
+        position = bisect_left(self.ids, row.id)
+        values = self._values(row, shard_index)
+        if position < len(self.ids) and self.ids[position] == row.id:
+            for column, value in zip(self._columns(), values):
+                column[position] = value
+        else:
+            for column, value in zip(self._columns(), values):
+                column.insert(position, value)
+
+    def _remove(self, donation_id, shard_index):
+        position = bisect_left(self.ids, donation_id)
+        # A row moved between shards is removed from one and added to the
+        # other; only the shard that holds the current copy may remove it
+        if (position < len(self.ids) and self.ids[position] == donation_id
+                and self.shards[position] == shard_index):
+            for column in self._columns():
+                del column[position]
+
+    def _matching(self, urgency, category, today, box=None):
+        """Positions passing the urgency and category filters, and inside box if given"""
+        first = last = None
+        if urgency:
+            first, last = Donation.urgency_date_range(urgency, today)
+        first = first.toordinal() if first else None
+        last = last.toordinal() if last else None
+        code = self._category_codes.get(category, -1) if category else None
+
+        expiry, categories = self.expiry, self.categories
+        positions = [
+            i for i in range(len(self.ids))
+            if (code is None or categories[i] == code)
+            and (first is None or expiry[i] >= first)
+            and (last is None or expiry[i] <= last)
+        ]
+        if box is not None:
+            # NaN (no location) compares false, so those drop out too
+            min_lat, max_lat, min_lng, max_lng = box
+            lats, lngs = self.lats, self.lngs
+            positions = [i for i in positions
+                         if min_lat <= lats[i] <= max_lat and min_lng <= lngs[i] <= max_lng]
+        return positions
+
+    def query(self, lat=None, lng=None, urgency=None, category=None, order='distance',
+              today=None, limit=None, offset=0):
+        """
+        Return ids of available donations passing the filters, ordered:
+        - 'distance': nearest first from (lat, lng), donations without a
+          location last; newest first when no location is given
+        - 'expiry':   soonest expiry first, then by id
+        """
+        with self._lock:
+            positions = self._matching(urgency, category, today or datetime.now().date())
+            if order == 'expiry':
+                expiry, ids = self.expiry, self.ids
+                positions.sort(key=lambda i: (expiry[i], ids[i]))
+            else:
+                created = self.created
+                positions.sort(key=lambda i: created[i], reverse=True)
+                if lat is not None and lng is not None:
+                    # Haversine term as in calculate_distance: same order as the
+                    # distances shown on the cards, without the asin/sqrt
+                    lats, lngs = self.lats, self.lngs
+                    lat1, lng1, cos_lat1 = radians(lat), radians(lng), cos(radians(lat))
+
+                    def distance(i):
+                        lat2, lng2 = radians(lats[i]), radians(lngs[i])
+                        d = sin((lat2 - lat1) / 2) ** 2 + cos_lat1 * cos(lat2) * sin((lng2 - lng1) / 2) ** 2
+                        return d if d == d else float('inf')  # NaN: no location
+
+                    positions.sort(key=distance)
+            end = None if limit is None else offset + limit
+            return [self.ids[i] for i in positions[offset:end]]
+
+    def ranked(self, ranker, lat=None, lng=None, limit=60, radius_km=None,
+               urgency=None, category=None, today=None):
+        """
+        Ids of the limit donations passing the filters with the highest
+        ranker score, best first. With a location and radius_km only the
+        donations within radius_km compete, unless fewer than limit are.
+        """
+        located = lat is not None and lng is not None
+        box = bounding_box(lat, lng, radius_km) if located and radius_km else None
+        with self._lock:
+            today = today or datetime.now().date()
+            positions = self._matching(urgency, category, today, box)
+            if box is not None and len(positions) < limit:
+                positions = self._matching(urgency, category, today)
+            lats, lngs, expiry, quantities = self.lats, self.lngs, self.expiry, self.quantities
+            score = ranker.scorer(lat, lng)
+            best = heapq.nlargest(limit, positions, key=lambda i: score(lats[i], lngs[i], expiry[i], quantities[i]))
+            return [self.ids[i] for i in best]
+
+    def facet_counts(self, urgency=None, category=None, today=None):
+        """Same counts as Donation.facet_counts over the available donations"""
+        today = today or datetime.now().date()
+        bounds = [(today.toordinal() + last_day, level) for level, last_day in URGENCY_LEVELS]
+
+        with self._lock:
+            # Count per (category code, level) first, then fold in the same
+            # order as the SQL GROUP BY so ties between facets sort alike
+            groups = {}
+            for expiry, code in zip(self.expiry, self.categories):
+                level = 'low'
+                for last, name in bounds:
+                    if expiry <= last:
+                        level = name
+                        break
+                groups[code, level] = groups.get((code, level), 0) + 1
+            names = list(self.category_names)
+
+        urgency_counts = dict.fromkeys(URGENCY_ORDER, 0)
+        category_counts = {}
+        for (code, level), total in sorted(groups.items(), key=lambda item: (
+                names[item[0][0]] is not None, names[item[0][0]] or '', item[0][1])):
+            name = names[code] or 'other'
+            if not category or name == category:
+                urgency_counts[level] += total
+            if not urgency or level == urgency:
+                category_counts[name] = category_counts.get(name, 0) + total
+        return {
+            'urgency': urgency_counts,
+            'category': dict(sorted(category_counts.items(), key=lambda item: -item[1]))
+        }
+
+
+def current_read_model():
+    """
+    The app's read model, synced with the latest writes, or None when it is
+    turned off or the change log is missing (run `flask init-db`).
+    """
+    if not has_app_context() or not current_app.config.get('AVAILABLE_READ_MODEL'):
+        return None
+    model = current_app.extensions.get('available_donations')
+    if model is None:
+        shards = current_app.extensions['shards']
+        engines = [shards.engines[name] for name in shards.shard_ids] if shards.enabled else [db.engine]
+        for engine in engines:
+            if engine.dialect.name != 'sqlite' or not sa.inspect(engine).has_table('donation_change'):
+                return None
+        model = current_app.extensions.setdefault('available_donations', AvailableDonations(engines))
+    model.sync()
+    return model
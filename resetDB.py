@@ -6,7 +6,10 @@ WARNING: This will delete all existing data!
 import os
 import sys
 import time
-from app import app, db
+from app import create_app, init_db
+from models import db
+
+app = create_app()
 
 def reset_database():
     """Remove old database and create new one with updated schema"""
@@ -57,7 +60,7 @@ def reset_database():
         
         # Create all tables with new schema
         print("Creating new database with updated schema...")
-        db.create_all()
+        init_db()
         
         print("✅ Database reset complete!")
         print(f"New database created at: {db_path}")
@@ -0,0 +1,226 @@
+"""
+Read/write connection routing for Food Rescue App
+Read-only views query a separate read engine so dashboard traffic does not
+compete with writes on the primary SQLite connection pool.
+
+Modes (Config.DATABASE_READ_ROUTING):
+- 'off':      everything uses the primary engine
+- 'readonly': reads use a read-only connection pool on the same file (WAL)
+- 'snapshot': reads use a replica file refreshed from the primary with the
+              SQLite backup API, a local stand-in for a real read replica
+"""
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+import sqlalchemy as sa
+from flask import current_app, g, has_app_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+ROUTING_MODES = ('off', 'readonly', 'snapshot')
+
+# Session key holding the time until which reads stay on the primary
+PRIMARY_UNTIL_KEY = '_primary_until'
+
+# Shard id of the main database (see sharding.py)
+PRIMARY_SHARD = 'primary'
+
+
+class RoutingSession(Session):
+    """
+    Session that sends reads from read-only views to the read engine and
+    statements aimed at a donation shard to that shard's engine.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, shard_id=None, **kwargs):
+        if shard_id is not None and shard_id != PRIMARY_SHARD:
+            return current_app.extensions['shards'].engines[shard_id]
+        if (bind is None and not self._flushing and has_app_context()
+                and g.get('use_read_engine')
+                and not isinstance(clause, sa.sql.dml.UpdateBase)):
+            engine = current_app.extensions['read_routing'].read_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    @property
+    def connection_callable(self):
+        # Flushes pick a connection per instance only when donations are sharded
+        shards = current_app.extensions.get('shards') if has_app_context() else None
+        if shards is None or not shards.enabled:
+            return None
+        return lambda mapper=None, instance=None, **kwargs: self.connection(
+            bind_arguments={'mapper': mapper, 'shard_id': shards.shard_for_instance(instance)}
+        )
+
+
+class ReadRouting:
+    """Per-app read engine state"""
+
+    def __init__(self, app, primary_engine):
+        self.mode = app.config.get('DATABASE_READ_ROUTING', 'off')
+        if self.mode not in ROUTING_MODES:
+            raise ValueError(f'Unknown DATABASE_READ_ROUTING mode: {self.mode}')
+
+        self.primary_path = primary_engine.url.database
+        if primary_engine.dialect.name != 'sqlite' or self.primary_path in (None, '', ':memory:'):
+            # Nothing to route to for in-memory or non-SQLite databases
+            self.mode = 'off'
+
+        self.replica_path = app.config.get('READ_REPLICA_PATH') or self.primary_path + '.replica'
+        self.refresh_interval = app.config.get('READ_REPLICA_REFRESH_SECONDS', 5)
+        self.pool_size = app.config.get('READ_POOL_SIZE', 10)
+        self._engine = None
+        self._replica_inode = None
+        self._refresher = None
+        self._lock = threading.Lock()
+
+        if self.mode != 'off':
+            # WAL lets readers and the writer use the file at the same time
+            event.listen(primary_engine, 'connect', _enable_wal)
+
+    def read_engine(self):
+        """Return the engine reads should use, or None to use the primary"""
+        if self.mode == 'off':
+            return None
+        if self.mode == 'snapshot':
+            self._check_replica()
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    self._engine = self._create_engine()
+        return self._engine
+
+    def _create_engine(self):
+        path = self.primary_path if self.mode == 'readonly' else self.replica_path
+        if self.mode == 'snapshot':
+            self._replica_inode = os.stat(path).st_ino
+        return sa.create_engine(
+            'sqlite://',
+            creator=lambda: _connect_read_only(path),
+            poolclass=sa.pool.QueuePool,
+            pool_size=self.pool_size,
+            max_overflow=self.pool_size
+        )
+
+    def _check_replica(self):
+        """Refresh a stale replica and drop pooled connections to a replaced file"""
+        try:
+            stat = os.stat(self.replica_path)
+        except FileNotFoundError:
+            stat = None
+
+        if stat is None:
+            # No replica yet: build the first one before serving reads from it
+            with self._lock:
+                while not os.path.exists(self.replica_path):
+                    if not try_refresh_snapshot(self.primary_path, self.replica_path):
+                        # Another worker is building it
+                        time.sleep(0.05)
+            return
+
+        if time.time() - stat.st_mtime > self.refresh_interval:
+            # Serve the slightly stale replica while a copy is taken off the request path
+            if self._refresher is None or not self._refresher.is_alive():
+                self._refresher = threading.Thread(
+                    target=try_refresh_snapshot,
+                    args=(self.primary_path, self.replica_path),
+                    daemon=True
+                )
+                self._refresher.start()
+
+        if self._engine is not None and stat is not None and stat.st_ino != self._replica_inode:
+            with self._lock:
+                if self._engine is not None and stat.st_ino != self._replica_inode:
+                    # Connections still see the old file; reopen on the new one
+                    self._engine.dispose()
+                    self._engine = None
+
+    def dispose(self):
+        if self._engine is not None:
+            self._engine.dispose(close=False)
+            self._engine = None
+
+
+def _connect_read_only(path):
+    # query_only rejects writes without the quirks of opening WAL files with mode=ro
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute('PRAGMA query_only = ON')
+    return connection
+
+
+def _enable_wal(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+
+def refresh_snapshot(primary_path, replica_path):
+    """
+    Copy the primary into the replica file with the SQLite backup API.
+    Writes to a temporary file and renames it, so readers never see a
+    half-written replica.
+    """
+    tmp_path = f'{replica_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    source = sqlite3.connect(primary_path)
+    target = sqlite3.connect(tmp_path)
+    try:
+        source.backup(target)
+        # A rollback-journal replica can be opened read-only without -shm files
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target.close()
+        source.close()
+    os.replace(tmp_path, replica_path)
+
+
+def try_refresh_snapshot(primary_path, replica_path):
+    """Refresh the replica unless another worker is already doing it"""
+    lock_path = replica_path + '.lock'
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        # Break locks left behind by a crashed worker
+        try:
+            if time.time() - os.stat(lock_path).st_mtime > 60:
+                os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+        return False
+    try:
+        refresh_snapshot(primary_path, replica_path)
+        return True
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+def init_read_routing(app, db):
+    """Set up the read engine and the read-your-own-writes hook for an app"""
+    with app.app_context():
+        routing = ReadRouting(app, db.engine)
+    app.extensions['read_routing'] = routing
+
+    @app.after_request
+    def remember_write(response):
+        # After a successful write, keep this client's reads on the primary
+        # long enough for the replica to catch up
+        if (routing.mode == 'snapshot' and request.method not in ('GET', 'HEAD', 'OPTIONS')
+                and response.status_code < 400):
+            session[PRIMARY_UNTIL_KEY] = time.time() + routing.refresh_interval * 2
+        return response
+
+    return routing
+
+
+def read_only(view):
+    """Route a view's queries to the read engine unless the client just wrote"""
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        if session.get(PRIMARY_UNTIL_KEY, 0) < time.time():
+            g.use_read_engine = True
+        return view(*args, **kwargs)
+    return decorated_view
@@ -0,0 +1,245 @@
+"""
+Full-text search for Food Rescue App
+SQLite FTS5 index over donation item_name, description and category
+"""
+import re
+from math import cos, radians
+
+import sqlalchemy as sa
+from sqlalchemy import text
+
+from models import db, Donation
+from sharding import shard_ids
+
+# Only available donations are indexed: volunteers never search history, so
+# the index (and every MATCH) stays the size of the live set no matter how
+# many completed donations pile up. The table keeps its own copy of the text
+# so rows can be removed by rowid when they stop being available.
+SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS donation_fts USING fts5(
+        item_name, description, category,
+        tokenize='porter unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS donation_fts_insert
+    AFTER INSERT ON donation WHEN new.status = 'available' BEGIN
+        INSERT INTO donation_fts(rowid, item_name, description, category)
+        VALUES (new.id, new.item_name, new.description, new.category);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS donation_fts_delete
+    AFTER DELETE ON donation WHEN old.status = 'available' BEGIN
+        DELETE FROM donation_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS donation_fts_update
+    AFTER UPDATE OF item_name, description, category, status ON donation BEGIN
+        DELETE FROM donation_fts WHERE rowid = old.id AND old.status = 'available';
+        INSERT INTO donation_fts(rowid, item_name, description, category)
+        SELECT new.id, new.item_name, new.description, new.category
+        WHERE new.status = 'available';
+    END
+    """,
+]
+
+REBUILD = [
+    "DELETE FROM donation_fts",
+    """
+    INSERT INTO donation_fts(rowid, item_name, description, category)
+    SELECT id, item_name, description, category FROM donation
+    WHERE status = 'available'
+    """,
+]
+
+# bm25 column weights: item_name, description, category
+RANK_WEIGHTS = (10.0, 2.0, 5.0)
+
+# Squared kilometres per squared degree of latitude
+KM2_PER_DEG2 = 111.32 ** 2
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def init_search_index(engine=None):
+    """
+    Create the FTS5 table and its sync triggers if missing.
+    Rebuilds the index when it is created on a database that already has rows.
+    Returns False on non-SQLite databases, where search is unavailable.
+    """
+    engine = engine or db.engine
+    if engine.dialect.name != 'sqlite':
+        return False
+
+    with engine.begin() as conn:
+        exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'donation_fts'"
+        )).first()
+        for statement in SCHEMA:
+            conn.execute(text(statement))
+        if not exists:
+            for statement in REBUILD:
+                conn.execute(text(statement))
+    return True
+
+
+def rebuild_search_index(engine=None):
+    """Rebuild the whole index from the available donations"""
+    with (engine or db.engine).begin() as conn:
+        for statement in REBUILD:
+            conn.execute(text(statement))
+
+
+def build_match_query(query_text):
+    """
+    Turn free text into a safe FTS5 MATCH expression.
+    Every word must match as a prefix in item_name, description or category.
+    Returns None when the text has no searchable words.
+    """
+    tokens = TOKEN_RE.findall(query_text or '')
+    if not tokens:
+        return None
+    return ' AND '.join(f'"{token}"*' for token in tokens[:10])
+
+
+def match_filter(query_text):
+    """
+    ORM predicate on Donation matching every available donation the search
+    finds, for counting or filtering the whole match set in SQL
+    """
+    match = build_match_query(query_text)
+    if match is None:
+        return sa.false()
+    matches = sa.select(sa.literal_column('rowid')).select_from(sa.table('donation_fts')).where(
+        text('donation_fts MATCH :match').bindparams(match=match)
+    )
+    return Donation.id.in_(matches)
+
+
+def _filters(category, lat, lng, radius_km, urgency=None, today=None):
+    """Build the extra WHERE clauses and parameters shared by search and facets"""
+    clauses = []
+    params = {}
+
+    if category:
+        clauses.append('d.category = :category')
+        params['category'] = category
+
+    if urgency:
+        first, last = Donation.urgency_date_range(urgency, today)
+        if first is not None:
+            clauses.append('d.expiry_date >= :first_expiry')
+            params['first_expiry'] = first.isoformat()
+        if last is not None:
+            clauses.append('d.expiry_date <= :last_expiry')
+            params['last_expiry'] = last.isoformat()
+
+    if lat is not None and lng is not None and radius_km:
+        # Bounding box first, which the latitude/longitude ranges can narrow cheaply
+        dlat = radius_km / 111.32
+        dlng = radius_km / (111.32 * max(cos(radians(lat)), 0.01))
+        clauses.append('d.latitude BETWEEN :min_lat AND :max_lat')
+        clauses.append('d.longitude BETWEEN :min_lng AND :max_lng')
+        # Then the circle itself, so pages are cut from in-radius rows only
+        # (equirectangular, like the distance score: no SQL math functions)
+        clauses.append(
+            '((d.latitude - :radius_lat) * (d.latitude - :radius_lat) + '
+            '(d.longitude - :radius_lng) * (d.longitude - :radius_lng) * :radius_cos2) '
+            '* :km2 <= :radius_km2'
+        )
+        params.update(
+            min_lat=lat - dlat, max_lat=lat + dlat,
+            min_lng=lng - dlng, max_lng=lng + dlng,
+            radius_lat=lat, radius_lng=lng, radius_cos2=cos(radians(lat)) ** 2,
+            km2=KM2_PER_DEG2, radius_km2=radius_km ** 2
+        )
+
+    return ''.join(f' AND {clause}' for clause in clauses), params
+
+
+def search_donations(query_text, category=None,
+                     lat=None, lng=None, radius_km=None,
+                     distance_scale_km=5.0, limit=12, offset=0,
+                     urgency=None, today=None):
+    """
+    Ranked full-text search over available donations, filtered by category,
+    urgency and radius before the page is cut.
+    The bm25 text score is damped by distance when a location is given, so a
+    close match outranks an equally good match across town.
+    Returns a list of (donation_id, score) tuples, best first.
+    """
+    match = build_match_query(query_text)
+    if match is None:
+        return []
+
+    shards = shard_ids()
+    where, params = _filters(category, lat, lng, radius_km, urgency, today)
+    if len(shards) == 1:
+        params.update(match=match, limit=limit, offset=offset)
+    else:
+        # Each shard returns its best rows up to the end of the page
+        params.update(match=match, limit=limit + offset, offset=0)
+
+    rank = 'bm25(donation_fts, {})'.format(', '.join(str(w) for w in RANK_WEIGHTS))
+    if lat is not None and lng is not None:
+        # bm25 is negative (lower is better); dividing by a growing factor pushes
+        # far results towards zero. Uses an equirectangular approximation so the
+        # expression needs no SQL math functions.
+        score = (
+            f'{rank} / (1.0 + ('
+            '(d.latitude - :lat) * (d.latitude - :lat) + '
+            '(d.longitude - :lng) * (d.longitude - :lng) * :cos2'
+            ') * :km2 / :scale2)'
+        )
+        params.update(
+            lat=lat, lng=lng,
+            cos2=cos(radians(lat)) ** 2,
+            km2=KM2_PER_DEG2,
+            scale2=distance_scale_km ** 2
+        )
+        # Donations without coordinates keep their plain text score
+        score = f'COALESCE({score}, {rank})'
+    else:
+        score = rank
+
+    statement = text(
+        f'SELECT d.id, {score} AS score '
+        'FROM donation_fts JOIN donation d ON d.id = donation_fts.rowid '
+        f'WHERE donation_fts MATCH :match{where} '
+        'ORDER BY score LIMIT :limit OFFSET :offset'
+    )
+    hits = []
+    for shard_id in shards:
+        rows = db.session.execute(statement, params, bind_arguments={'shard_id': shard_id})
+        hits.extend((row.id, row.score) for row in rows)
+    if len(shards) == 1:
+        return hits
+    hits.sort(key=lambda hit: hit[1])
+    return hits[offset:offset + limit]
+
+
+def search_facets(query_text, category=None,
+                  lat=None, lng=None, radius_km=None):
+    """Return {category: count} for all available donations matching the search"""
+    match = build_match_query(query_text)
+    if match is None:
+        return {}
+
+    where, params = _filters(category, lat, lng, radius_km)
+    params['match'] = match
+
+    statement = text(
+        'SELECT d.category, COUNT(*) AS total '
+        'FROM donation_fts JOIN donation d ON d.id = donation_fts.rowid '
+        f'WHERE donation_fts MATCH :match{where} '
+        'GROUP BY d.category'
+    )
+    counts = {}
+    for shard_id in shard_ids():
+        for row in db.session.execute(statement, params, bind_arguments={'shard_id': shard_id}):
+            category = row.category or 'other'
+            counts[category] = counts.get(category, 0) + row.total
+    return dict(sorted(counts.items(), key=lambda item: -item[1]))
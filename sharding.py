@@ -0,0 +1,499 @@
+"""
+Geographic sharding for Food Rescue App
+Donations are partitioned by the geohash of their location into separate
+database files; users stay on the primary database as the global directory.
+ORM queries on donations are sent to every shard and merged, so route
+handlers never need to know where a row lives.
+
+- DONATION_SHARDS maps shard names to database URLs ('primary' is the main
+  database and holds every region not assigned elsewhere)
+- the shard_region table maps geohash prefixes to shards; the longest
+  matching prefix wins
+- donation ids come from a global sequence so they stay unique across shards
+  and survive moving a region to another shard
+"""
+import threading
+import time
+
+import click
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from sqlalchemy.sql import operators
+
+from models import ArchivedDonation, Donation, DonationEvent, ShardRegion, ShardSequence
+from readmodel import forget_changes
+from routing import PRIMARY_SHARD, RoutingSession, _enable_wal
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Ids reserved from the global sequence per round trip to the primary
+ID_BLOCK_SIZE = 1000
+
+# Aggregates that can be combined from per-shard partial results
+MERGE_AGGREGATES = {
+    'count': sum,
+    'sum': sum,
+    'min': min,
+    'max': max,
+}
+
+
+def geohash(lat, lng, precision=6):
+    """Encode a point as a geohash string of the given length"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = value = 0
+    even = True
+    while len(chars) < precision:
+        bounds, coordinate = (lng_range, lng) if even else (lat_range, lat)
+        mid = (bounds[0] + bounds[1]) / 2
+        if coordinate >= mid:
+            value = value * 2 + 1
+            bounds[0] = mid
+        else:
+            value *= 2
+            bounds[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_BASE32[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+def geohash_bounds(prefix):
+    """Return (min_lat, min_lng, max_lat, max_lng) of a geohash cell"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for char in prefix:
+        index = GEOHASH_BASE32.index(char)
+        for shift in range(4, -1, -1):
+            bounds = lng_range if even else lat_range
+            mid = (bounds[0] + bounds[1]) / 2
+            if index >> shift & 1:
+                bounds[0] = mid
+            else:
+                bounds[1] = mid
+            even = not even
+    return lat_range[0], lng_range[0], lat_range[1], lng_range[1]
+
+
+def valid_prefix(prefix):
+    return bool(prefix) and len(prefix) <= 12 and all(c in GEOHASH_BASE32 for c in prefix)
+
+
+class ShardMap:
+    """Per-app shard engines, region map and donation id allocator"""
+
+    def __init__(self, app, primary_engine):
+        urls = app.config.get('DONATION_SHARDS') or {}
+        if PRIMARY_SHARD in urls:
+            raise ValueError(f"'{PRIMARY_SHARD}' is the main database and cannot be a shard name")
+
+        self.enabled = bool(urls)
+        self.primary_engine = primary_engine
+        self.engines = {PRIMARY_SHARD: primary_engine}
+        for name, url in urls.items():
+            self.engines[name] = sa.create_engine(url)
+        self.shard_ids = list(self.engines)
+        self.initial_regions = dict(app.config.get('DONATION_SHARD_REGIONS') or {})
+        self.refresh_interval = app.config.get('SHARD_REGION_REFRESH_SECONDS', 5)
+
+        self._regions = {}
+        self._regions_loaded_at = None
+        self._next_id = self._end_id = 0
+        self._lock = threading.Lock()
+
+        if self.enabled:
+            for engine in self.engines.values():
+                # Writers on one shard must not block readers of the same file
+                if engine.dialect.name == 'sqlite' and not event.contains(engine, 'connect', _enable_wal):
+                    event.listen(engine, 'connect', _enable_wal)
+
+    def regions(self):
+        """Current {geohash prefix: shard}, reloaded every few seconds"""
+        now = time.monotonic()
+        if self._regions_loaded_at is None or now - self._regions_loaded_at > self.refresh_interval:
+            with self.primary_engine.connect() as conn:
+                rows = conn.execute(sa.select(ShardRegion.prefix, ShardRegion.shard)).all()
+            self._regions = {prefix: shard for prefix, shard in rows if shard in self.engines}
+            self._regions_loaded_at = now
+        return self._regions
+
+    def shard_for_point(self, lat, lng):
+        """Shard owning a location; donations without one stay on the primary"""
+        regions = self.regions()
+        if lat is None or lng is None or not regions:
+            return PRIMARY_SHARD
+        code = geohash(lat, lng, max(len(prefix) for prefix in regions))
+        for length in range(len(code), 0, -1):
+            shard = regions.get(code[:length])
+            if shard is not None:
+                return shard
+        return PRIMARY_SHARD
+
+    def shard_for_instance(self, instance):
+        """Shard an instance is written to: where it was loaded from, else where it belongs"""
+        if not isinstance(instance, Donation):
+            return PRIMARY_SHARD
+        shard = getattr(instance, '_shard_id', None)
+        if shard is None:
+            shard = instance._shard_id = self.shard_for_point(instance.latitude, instance.longitude)
+        return shard
+
+    def next_donation_id(self):
+        with self._lock:
+            if self._next_id >= self._end_id:
+                self._next_id = self._reserve_ids()
+                self._end_id = self._next_id + ID_BLOCK_SIZE
+            self._next_id += 1
+            return self._next_id - 1
+
+    def _reserve_ids(self):
+        """
+        Reserve a block of donation ids from the sequence on the primary.
+        Never goes below the highest existing id, archived ones included, so
+        rows inserted while sharding was off (or by bulk loaders) cannot collide.
+        """
+        highest = 0
+        for engine in self.engines.values():
+            with engine.connect() as conn:
+                for model in (Donation, ArchivedDonation):
+                    highest = max(highest, conn.execute(sa.select(sa.func.max(model.id))).scalar() or 0)
+
+        table = ShardSequence.__table__
+        with self.primary_engine.begin() as conn:
+            # Write before reading so concurrent workers serialize on the lock
+            conn.execute(table.insert().prefix_with('OR IGNORE').values(name='donation', next_id=1))
+            end = conn.execute(
+                table.update()
+                .where(table.c.name == 'donation')
+                .values(next_id=sa.func.max(table.c.next_id, highest + 1) + ID_BLOCK_SIZE)
+                .returning(table.c.next_id)
+            ).scalar_one()
+        return end - ID_BLOCK_SIZE
+
+    def init_schema(self):
+        """Create the donation, outbox and archive tables on every shard and seed the region map"""
+        if not self.enabled:
+            return []
+        shard_engines = [engine for name, engine in self.engines.items() if name != PRIMARY_SHARD]
+        for engine in shard_engines:
+            for table in (Donation.__table__, DonationEvent.__table__, ArchivedDonation.__table__):
+                table.create(engine, checkfirst=True)
+                for index in table.indexes:
+                    index.create(engine, checkfirst=True)
+
+        with self.primary_engine.begin() as conn:
+            for prefix, shard in self.initial_regions.items():
+                conn.execute(ShardRegion.__table__.insert().prefix_with('OR IGNORE')
+                             .values(prefix=prefix, shard=shard))
+        self._regions_loaded_at = None
+        return shard_engines
+
+    def assign(self, prefix, shard):
+        """Point a geohash prefix at a shard"""
+        with self.primary_engine.begin() as conn:
+            conn.execute(ShardRegion.__table__.delete().where(ShardRegion.prefix == prefix))
+            conn.execute(ShardRegion.__table__.insert().values(prefix=prefix, shard=shard))
+        self._regions_loaded_at = None
+
+    def rebalance(self, prefix=None, batch_size=1000):
+        """
+        Move donations to the shard the region map assigns them to.
+        Limited to one geohash cell when a prefix is given. Each batch is
+        copied to its new shard before it is deleted from the old one, so
+        rows are never missing; fan-out reads drop the brief duplicates.
+        Writes to the old shard wait while a batch moves, so none is lost.
+        Safe to re-run after an interruption.
+        Returns {(source, target): rows moved}.
+        """
+        table = Donation.__table__
+        where = []
+        if prefix:
+            min_lat, min_lng, max_lat, max_lng = geohash_bounds(prefix)
+            where = [table.c.latitude >= min_lat, table.c.latitude < max_lat,
+                     table.c.longitude >= min_lng, table.c.longitude < max_lng]
+
+        moved = {}
+        for source in self.shard_ids:
+            last_id = 0
+            while True:
+                with self.engines[source].connect() as conn:
+                    rows = conn.execute(
+                        sa.select(table.c.id, table.c.latitude, table.c.longitude)
+                        .where(table.c.id > last_id, *where)
+                        .order_by(table.c.id).limit(batch_size)
+                    ).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+
+                targets = {}
+                for row in rows:
+                    target = self.shard_for_point(row.latitude, row.longitude)
+                    if target != source:
+                        targets.setdefault(target, []).append(row.id)
+                for target, ids in targets.items():
+                    self._move_rows(source, target, ids)
+                    moved[(source, target)] = moved.get((source, target), 0) + len(ids)
+        return moved
+
+    def _move_rows(self, source, target, ids):
+        from outbox import bulk_events  # outbox builds on this module
+
+        table = Donation.__table__
+        with self.engines[source].connect() as source_conn:
+            # Hold the source's write lock from the read to the delete: a claim
+            # or edit committed in between would be deleted with the row. Writers
+            # there wait for the batch, then find the row gone.
+            if source_conn.dialect.name == 'sqlite':
+                source_conn.exec_driver_sql('BEGIN IMMEDIATE')
+            rows = [dict(row._mapping) for row in source_conn.execute(
+                table.select().where(table.c.id.in_(ids)).with_for_update()
+            )]
+            if not rows:
+                return
+            ids = [row['id'] for row in rows]
+            with self.engines[target].begin() as conn:
+                # Clears leftovers of an interrupted move; goes through the search triggers
+                conn.execute(table.delete().where(table.c.id.in_(ids)))
+                conn.execute(table.insert(), rows)
+                # The insert logs the rows' current state in the target's change log;
+                # outbox consumers get a 'moved' event carrying it
+                conn.execute(bulk_events('moved', Donation.id.in_(ids)))
+            source_conn.execute(table.delete().where(table.c.id.in_(ids)))
+            # Drop the rows' change log history here, the delete included: a
+            # sync client must not see them removed once it has seen the copy
+            forget_changes(source_conn, ids)
+            source_conn.commit()
+
+    def counts(self):
+        """{shard: donation count}"""
+        result = {}
+        for name, engine in self.engines.items():
+            with engine.connect() as conn:
+                result[name] = conn.execute(sa.select(sa.func.count()).select_from(Donation.__table__)).scalar()
+        return result
+
+    def dispose(self):
+        for name, engine in self.engines.items():
+            if name != PRIMARY_SHARD:
+                engine.dispose(close=False)
+
+
+def init_sharding(app, db):
+    """Create the shard engines for an app"""
+    with app.app_context():
+        shards = ShardMap(app, db.engine)
+    app.extensions['shards'] = shards
+    app.cli.add_command(shards_command)
+    return shards
+
+
+def current_shards():
+    """The app's ShardMap when sharding is on, otherwise None"""
+    if not has_app_context():
+        return None
+    shards = current_app.extensions.get('shards')
+    return shards if shards is not None and shards.enabled else None
+
+
+def shard_ids():
+    """Shards a query over every donation has to visit"""
+    shards = current_shards()
+    return shards.shard_ids if shards is not None else [PRIMARY_SHARD]
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def assign_donation_ids(session, flush_context, instances):
+    """Give new donations ids from the global sequence before they are inserted"""
+    shards = current_shards()
+    if shards is None:
+        return
+    for instance in session.new:
+        if isinstance(instance, Donation) and instance.id is None:
+            instance.id = shards.next_donation_id()
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def execute_on_shards(orm_context):
+    """
+    Run ORM statements on donations against every shard and merge the results:
+    - rows are concatenated, then re-sorted and re-sliced for ORDER BY/LIMIT
+    - count/sum/min/max results are combined per GROUP BY key
+    - UPDATE/DELETE report the total row count
+    Statements on other tables, and statements given an explicit shard_id
+    bind argument, run normally.
+    """
+    shards = current_shards()
+    if (shards is None or 'shard_id' in orm_context.bind_arguments
+            or orm_context.bind_mapper is not Donation.__mapper__):
+        return None
+
+    if not orm_context.is_select:
+        results = [orm_context.invoke_statement(bind_arguments={'shard_id': shard_id})
+                   for shard_id in shards.shard_ids]
+        if orm_context.is_update or orm_context.is_delete:
+            # rowcount is a lazily computed attribute; report the total instead
+            results[0].rowcount = sum(result.rowcount for result in results)
+        return results[0]
+
+    statement = orm_context.statement
+    limit, offset = statement._limit, statement._offset
+    if offset:
+        # Every shard could hold rows of the requested page
+        statement = statement.offset(None)
+        if limit is not None:
+            statement = statement.limit(limit + offset)
+
+    frozen = None
+    rows = []
+    for shard_id in shards.shard_ids:
+        frozen = orm_context.invoke_statement(
+            statement=statement, bind_arguments={'shard_id': shard_id}
+        ).freeze()
+        data = frozen.data if not frozen._source_supports_scalars else [(item,) for item in frozen.data]
+        for row in data:
+            for item in row:
+                if isinstance(item, Donation):
+                    item._shard_id = shard_id
+        rows.extend(data)
+
+    aggregates = [_aggregate(column) for column in statement.selected_columns]
+    if any(aggregates):
+        rows = _merge_groups(rows, aggregates)
+    else:
+        rows = _sort_rows(_drop_duplicates(rows, _id_position(statement)), statement._order_by_clauses)
+        if offset or limit is not None:
+            rows = rows[offset or 0:(offset or 0) + limit if limit is not None else None]
+    return frozen.with_new_rows(rows)()
+
+
+def _aggregate(column):
+    """The merge function for an aggregate column, or None for a plain column"""
+    element = getattr(column, 'element', column)
+    if isinstance(element, sa.sql.functions.FunctionElement):
+        return MERGE_AGGREGATES.get(element.name.lower())
+    return None
+
+
+def _merge_groups(rows, aggregates):
+    """Combine per-shard aggregate rows that share the same GROUP BY values"""
+    groups = {}
+    for row in rows:
+        key = tuple(value for value, merge in zip(row, aggregates) if merge is None)
+        merged = groups.get(key)
+        if merged is None:
+            groups[key] = list(row)
+            continue
+        for i, merge in enumerate(aggregates):
+            if merge is not None:
+                values = [value for value in (merged[i], row[i]) if value is not None]
+                merged[i] = merge(values) if values else None
+    return [tuple(row) for row in groups.values()]
+
+
+def _id_position(statement):
+    """Position of the donation id among a select's columns, or None"""
+    for position, description in enumerate(statement.column_descriptions):
+        expr = description.get('expr')
+        expr = getattr(expr, 'element', expr) if isinstance(expr, sa.sql.elements.Label) else expr
+        if expr is Donation.id or isinstance(expr, sa.sql.ColumnElement) and expr.compare(Donation.__table__.c.id):
+            return position
+    return None
+
+
+def _drop_duplicates(rows, id_position=None):
+    # A row being moved between shards can briefly exist on both; with global
+    # ids the identity map hands back the same instance for both copies, and
+    # selects of plain columns are told apart by the id column if they have one
+    seen = set()
+    unique = []
+    for row in rows:
+        key = tuple(id(item) for item in row if isinstance(item, Donation))
+        if not key and id_position is not None and row[id_position] is not None:
+            key = ('id', row[id_position])
+        if key:
+            if key in seen:
+                continue
+            seen.add(key)
+        unique.append(row)
+    return unique
+
+
+def _sort_rows(rows, order_by):
+    """Re-apply ORDER BY on plain columns with SQLite's NULL ordering"""
+    for clause in reversed(order_by):
+        modifier = getattr(clause, 'modifier', None)
+        if modifier in (operators.asc_op, operators.desc_op):
+            clause = clause.element
+        key = getattr(clause, 'key', None)
+        if key is None:
+            continue
+        rows = sorted(rows, key=lambda row: _sort_key(row, key), reverse=modifier is operators.desc_op)
+    return rows
+
+
+def _sort_key(row, key):
+    mapping = getattr(row, '_mapping', None)
+    if mapping is not None and key in mapping:
+        value = mapping[key]
+    else:
+        value = getattr(row[0], key, None)
+    return (value is not None, value)
+
+
+@click.group('shards')
+def shards_command():
+    """Inspect and rebalance donation shards"""
+
+
+@shards_command.command('status')
+@with_appcontext
+def shards_status():
+    """Show donation counts per shard and the region map"""
+    shards = current_app.extensions['shards']
+    for name, total in shards.counts().items():
+        click.echo(f'{name:<20} {total:>10} donations')
+    for prefix, shard in sorted(shards.regions().items()):
+        click.echo(f'  {prefix:<10} -> {shard}')
+
+
+@shards_command.command('move')
+@click.argument('prefix')
+@click.argument('shard')
+@click.option('--batch-size', default=1000, show_default=True)
+@with_appcontext
+def shards_move(prefix, shard, batch_size):
+    """Assign the geohash PREFIX to SHARD and move its donations there"""
+    shards = current_shards()
+    if shards is None:
+        raise click.ClickException('Sharding is off: set DONATION_SHARDS first.')
+    if not valid_prefix(prefix):
+        raise click.ClickException(f'Invalid geohash prefix: {prefix}')
+    if shard not in shards.engines:
+        raise click.ClickException(f"Unknown shard '{shard}'. Choose from: {', '.join(shards.shard_ids)}")
+
+    shards.assign(prefix, shard)
+    for (source, target), total in shards.rebalance(prefix, batch_size).items():
+        click.echo(f'Moved {total} donations from {source} to {target}')
+    click.echo(f'Region {prefix} now lives on {shard}.')
+
+
+@shards_command.command('rebalance')
+@click.option('--batch-size', default=1000, show_default=True)
+@with_appcontext
+def shards_rebalance(batch_size):
+    """Move every donation to the shard the region map assigns it to"""
+    shards = current_shards()
+    if shards is None:
+        raise click.ClickException('Sharding is off: set DONATION_SHARDS first.')
+    moved = shards.rebalance(batch_size=batch_size)
+    for (source, target), total in moved.items():
+        click.echo(f'Moved {total} donations from {source} to {target}')
+    click.echo(f'Rebalanced {sum(moved.values())} donations.')
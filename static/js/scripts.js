@@ -23,3 +23,85 @@ function initTooltips() {
 }
 
 document.addEventListener('DOMContentLoaded', initTooltips);
+
+// Claim or complete one donation. The Idempotency-Key stays the same for this
+// donation and action until the page reloads, so a retry or a double click is
+// applied once; network failures are retried with it.
+const PAGE_KEY = window.crypto && crypto.randomUUID ? crypto.randomUUID() : Date.now() + '-' + Math.random().toString(36).slice(2);
+
+function postDonationAction(donationId, action, retries = 2) {
+    return fetch(`/donation/${donationId}/${action}`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Idempotency-Key': `${action}-${donationId}-${PAGE_KEY}`
+        }
+    })
+    .catch(error => {
+        if (retries <= 0) {
+            throw error;
+        }
+        return new Promise(resolve => setTimeout(resolve, 1000))
+            .then(() => postDonationAction(donationId, action, retries - 1));
+    });
+}
+
+// Apply one action ('claim', 'complete' or 'delete') to several donations in a single request
+function batchDonations(action, donationIds) {
+    return fetch('/donations/batch', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ action: action, ids: donationIds })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.error) {
+            alert('Error: ' + data.error);
+            return data;
+        }
+        const failed = data.results.filter(result => !result.success);
+        if (failed.length) {
+            alert(failed.map(result => `#${result.id}: ${result.error}`).join('\n'));
+        }
+        location.reload();
+        return data;
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        alert('An error occurred');
+    });
+}
+
+// Collect the donation ids of all checked boxes matching a selector
+function selectedDonationIds(selector) {
+    return Array.from(document.querySelectorAll(selector + ':checked')).map(box => parseInt(box.value));
+}
+
+// Save the location from a typed address, for browsers that cannot share their position
+function saveAddress(inputId) {
+    const address = document.getElementById(inputId).value.trim();
+    if (!address) {
+        return;
+    }
+    fetch('/user/location', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ address: address })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            location.reload();
+        } else {
+            alert('Error: ' + data.error);
+        }
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        alert('Failed to save location');
+    });
+}
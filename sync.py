@@ -0,0 +1,179 @@
+"""
+Delta sync for Food Rescue App
+A client keeps the volunteer view's two lists (available donations and its
+own claims) and polls GET /donations/sync?since=<version> with the version
+of its last response. It gets back only the donations added or changed
+since then, with the ids to drop from each list. Changes are read from the
+change log that readmodel.py's triggers keep on every shard: a donation's
+version is the latest change logged for it.
+A client that is up to date costs one head lookup per shard however many
+donations there are.
+"""
+import base64
+import json
+
+import sqlalchemy as sa
+
+from models import db, ArchivedDonation, Donation, User
+from photos import thumbnail_url
+from readmodel import CHANGE_LOG, HEAD_QUERY
+from sharding import shard_ids
+
+SYNC_COLUMNS = (
+    Donation.id, Donation.item_name, Donation.description, Donation.category,
+    Donation.expiry_date, Donation.quantity, Donation.status, Donation.latitude,
+    Donation.longitude, Donation.company_id, Donation.volunteer_id, Donation.photo
+)
+
+
+def encode_version(heads):
+    """Opaque version token for {shard: change log version}"""
+    data = json.dumps(heads, separators=(',', ':'), sort_keys=True).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_version(token):
+    """{shard: change log version} from a token, or None if it is malformed"""
+    try:
+        heads = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(heads, dict) or not all(
+            isinstance(version, int) and version >= 0 for version in heads.values()):
+        return None
+    return heads
+
+
+def change_heads():
+    """
+    {shard: (latest version, oldest version still logged)}, or None when
+    the database has no change log
+    """
+    heads = {}
+    for shard in shard_ids():
+        try:
+            head, oldest = db.session.execute(HEAD_QUERY, bind_arguments={'shard_id': shard}).one()
+        except sa.exc.OperationalError:
+            db.session.rollback()
+            return None
+        heads[shard] = (head or 0, oldest)
+    return heads
+
+
+def available_item(row, names):
+    # No urgency: it changes with the date, not with a write, so clients derive it from expiry_date
+    return {
+        'id': row.id,
+        'item_name': row.item_name,
+        'description': row.description,
+        'category': row.category,
+        'quantity': row.quantity,
+        'expiry_date': row.expiry_date.isoformat(),
+        'latitude': row.latitude,
+        'longitude': row.longitude,
+        'company_name': names.get(row.company_id),
+        'thumbnail': thumbnail_url(row.photo),
+    }
+
+
+def claim_item(row, names):
+    return {
+        'id': row.id,
+        'item_name': row.item_name,
+        'quantity': row.quantity,
+        'expiry_date': row.expiry_date.isoformat(),
+        'status': row.status,
+        'company_name': names.get(row.company_id),
+        'thumbnail': thumbnail_url(row.photo),
+    }
+
+
+def sync_payload(version, full, available, claims, removed_available=(), removed_claims=()):
+    names = User.display_names({row.company_id for row in (*available, *claims)})
+    return {
+        'version': version,
+        'full': full,
+        'available': [available_item(row, names) for row in available],
+        'claims': [claim_item(row, names) for row in claims],
+        'removed_available': sorted(removed_available),
+        'removed_claims': sorted(removed_claims),
+    }
+
+
+def full_sync(volunteer_id, heads):
+    """Every available donation and every claim of the volunteer, archived ones included"""
+    # Read the version first: changes racing the snapshot are sent again next time
+    version = encode_version({shard: head for shard, (head, _) in heads.items()}) if heads else None
+    available = db.session.execute(
+        sa.select(*SYNC_COLUMNS).filter_by(status='available').order_by(Donation.id)
+    ).all()
+    live = db.session.execute(sa.select(*SYNC_COLUMNS).filter_by(volunteer_id=volunteer_id)).all()
+    archived = archived_claims(volunteer_id)
+    claims = sorted([*live, *archived], key=lambda row: row.id)
+    return sync_payload(version, True, available, claims)
+
+
+def archived_claims(volunteer_id, ids=None, shards=None):
+    """The volunteer's archived claims, limited to ids on the given shards if given"""
+    columns = [getattr(ArchivedDonation, column.key) for column in SYNC_COLUMNS]
+    statement = sa.select(*columns).filter_by(volunteer_id=volunteer_id)
+    if ids is not None:
+        statement = statement.where(ArchivedDonation.id.in_(ids))
+    rows = []
+    for shard in shards or shard_ids():
+        rows.extend(db.session.execute(statement, bind_arguments={'shard_id': shard}))
+    return rows
+
+
+def delta_sync(volunteer_id, since):
+    """
+    The sync response for a client at version token since: only what
+    changed, or everything when the token is unknown, from another shard
+    layout or older than the pruned change log.
+    Returns None for a malformed token.
+    """
+    seen = decode_version(since)
+    if seen is None:
+        return None
+    heads = change_heads()
+    if (heads is None or set(seen) != set(heads) or any(
+            seen[shard] > head or seen[shard] < head and oldest is not None and seen[shard] < oldest - 1
+            for shard, (head, oldest) in heads.items())):
+        return full_sync(volunteer_id, heads)
+    if all(seen[shard] == head for shard, (head, _) in heads.items()):
+        return sync_payload(since, False, [], [])
+
+    available, claims, changed, deleted_on = {}, {}, set(), set()
+    for shard, (head, _) in heads.items():
+        if seen[shard] == head:
+            continue
+        rows = db.session.execute(
+            sa.select(CHANGE_LOG.c.donation_id, *SYNC_COLUMNS).distinct()
+            .select_from(CHANGE_LOG.outerjoin(Donation, Donation.id == CHANGE_LOG.c.donation_id))
+            .where(CHANGE_LOG.c.version > seen[shard], CHANGE_LOG.c.version <= head),
+            bind_arguments={'shard_id': shard}
+        )
+        for row in rows:
+            changed.add(row.donation_id)
+            if row.id is None:
+                deleted_on.add(shard)
+            elif row.status == 'available':
+                available[row.id] = row
+            elif row.volunteer_id == volunteer_id:
+                claims[row.id] = row
+
+    # Deleted rows may have been archived (the claim stays in the volunteer's
+    # history) or moved to another shard (and show up there)
+    gone = changed - available.keys() - claims.keys()
+    if gone and deleted_on:
+        for row in archived_claims(volunteer_id, list(gone), deleted_on):
+            claims[row.id] = row
+    # A changed donation is dropped from each list it no longer belongs to:
+    # one the volunteer just claimed leaves available as it joins claims
+    return sync_payload(
+        encode_version({shard: head for shard, (head, _) in heads.items()}), False,
+        sorted(available.values(), key=lambda row: row.id),
+        sorted(claims.values(), key=lambda row: row.id),
+        changed - available.keys(),
+        changed - claims.keys()
+    )
@@ -0,0 +1,23 @@
+import pytest
+
+from app import create_app, init_db
+from models import db
+
+
+@pytest.fixture
+def app():
+    """The testing app on a fresh in-memory database"""
+    app = create_app('testing')
+    with app.app_context():
+        init_db()
+    yield app
+    with app.app_context():
+        db.drop_all()
+
+
+@pytest.fixture
+def app_context(app):
+    """The testing app with its app context pushed, for tests that use the models directly"""
+    with app.app_context():
+        yield app
+        db.session.remove()
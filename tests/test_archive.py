@@ -0,0 +1,83 @@
+"""Archival keeps donation ids unique across the live and archive tables"""
+from datetime import date, datetime, timedelta
+
+import pytest
+import sqlalchemy as sa
+
+from app import init_db
+from archive import archive_donations, donation_history
+from models import db, ArchivedDonation, Donation, User
+
+
+@pytest.fixture
+def company(app_context):
+    user = User(role='company', name='Test', company_name='Test Foods', email='company@example.com',
+                password_hash='!')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def add_donations(company, count, status='available', days_ago=60):
+    donations = [
+        Donation(item_name=f'Item {i}', category='bakery', quantity=1, status=status,
+                 expiry_date=date.today() + timedelta(days=3), company_id=company.id,
+                 created_at=datetime.utcnow() - timedelta(days=days_ago))
+        for i in range(count)
+    ]
+    db.session.add_all(donations)
+    db.session.commit()
+    return [donation.id for donation in donations]
+
+
+def history_ids(company):
+    return [row.id for row in donation_history([Donation.id, Donation.created_at], company_id=company.id)]
+
+
+def test_newest_finished_donation_is_archived(company):
+    ids = add_donations(company, 3, status='completed')
+
+    assert archive_donations(older_than_days=30) == {'primary': 3}
+    assert Donation.query.count() == 0
+    assert sorted(history_ids(company)) == ids
+
+
+def test_ids_are_not_reused_after_deleting_the_top_row(company):
+    archived = add_donations(company, 5, status='completed')
+    top, = add_donations(company, 1)
+    archive_donations(older_than_days=30)
+
+    db.session.delete(db.session.get(Donation, top))
+    db.session.commit()
+    new, = add_donations(company, 1)
+
+    assert new > top
+    ids = history_ids(company)
+    assert sorted(ids) == archived + [new]
+
+    # The new donation archives without a primary key conflict
+    Donation.query.filter_by(id=new).update({'status': 'completed'})
+    db.session.commit()
+    assert archive_donations(older_than_days=30) == {'primary': 1}
+    assert db.session.get(ArchivedDonation, new) is not None
+
+
+def test_upgrade_starts_ids_above_archived_ones(company):
+    archived = add_donations(company, 4, status='completed')
+    archive_donations(older_than_days=30)
+
+    # A donation table from before ids were AUTOINCREMENT
+    metadata = sa.MetaData()
+    User.__table__.to_metadata(metadata)
+    legacy = Donation.__table__.to_metadata(metadata)
+    legacy.dialect_options['sqlite']['autoincrement'] = False
+    with db.engine.begin() as conn:
+        conn.execute(sa.text('DROP TABLE donation'))
+        legacy.create(conn)
+        conn.execute(sa.text("DELETE FROM sqlite_sequence WHERE name = 'donation'"))
+
+    init_db()
+    new, = add_donations(company, 1)
+
+    assert new > max(archived)
+    assert sorted(history_ids(company)) == archived + [new]
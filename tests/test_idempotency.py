@@ -0,0 +1,53 @@
+"""Reserving idempotency keys, fresh and expired"""
+from datetime import datetime, timedelta
+
+from idempotency import reserve_key
+from models import db, IdempotencyKey
+
+USER_ID = 1
+KEY = 'retry-me'
+
+
+def stored(fingerprint, status_code=200, body=b'old', age=timedelta()):
+    db.session.add(IdempotencyKey(
+        user_id=USER_ID, key=KEY, fingerprint=fingerprint, status_code=status_code,
+        mimetype='application/json', location='/old', body=body,
+        created_at=datetime.utcnow() - age
+    ))
+    db.session.commit()
+
+
+def test_fresh_key_is_reserved_then_in_progress(app_context):
+    assert reserve_key(USER_ID, KEY, b'a' * 16) == (None, None)
+    record, error = reserve_key(USER_ID, KEY, b'a' * 16)
+    assert record is None and error[1] == 409
+
+
+def test_stored_response_is_replayed(app_context):
+    stored(b'a' * 16)
+    record, error = reserve_key(USER_ID, KEY, b'a' * 16)
+    assert error is None and record.body == b'old'
+
+
+def test_expired_key_is_reserved_without_its_old_response(app_context):
+    stored(b'a' * 16, age=timedelta(hours=app_context.config['IDEMPOTENCY_TTL_HOURS'] + 1))
+
+    assert reserve_key(USER_ID, KEY, b'b' * 16) == (None, None)
+    db.session.expire_all()
+    record = db.session.get(IdempotencyKey, (USER_ID, KEY))
+    assert record.fingerprint == b'b' * 16
+    assert (record.status_code, record.mimetype, record.location, record.body) == (None, None, None, None)
+    assert record.created_at > datetime.utcnow() - timedelta(minutes=1)
+
+    # A retry of the new request waits for it instead of replaying the old response
+    record, error = reserve_key(USER_ID, KEY, b'b' * 16)
+    assert record is None and error[1] == 409
+
+
+def test_abandoned_key_is_reserved_again(app_context):
+    stored(b'a' * 16, status_code=None, body=None,
+           age=timedelta(seconds=app_context.config['IDEMPOTENCY_LOCK_SECONDS'] + 1))
+
+    assert reserve_key(USER_ID, KEY, b'a' * 16) == (None, None)
+    db.session.expire_all()
+    assert db.session.get(IdempotencyKey, (USER_ID, KEY)).location is None
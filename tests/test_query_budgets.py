@@ -0,0 +1,86 @@
+"""SQL statements per dashboard render stay within budget whatever the number of cards"""
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from models import db, Donation, User
+
+# Most SQL statements one render may issue, whatever the number of cards.
+# The volunteer dashboard needs 6, plus 1 when its read model catches up on writes.
+QUERY_BUDGETS = {
+    '/dashboard/company': 2,
+    '/dashboard/volunteer': 7,
+    '/dashboard/volunteer?q=item': 7,
+}
+
+
+def add_user(role, email):
+    user = User(role=role, name='Test', company_name='Test Foods' if role == 'company' else None,
+                email=email, password_hash='!', latitude=48.8566, longitude=2.3522)
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+
+def add_donations(company_id, count, **fields):
+    db.session.add_all(
+        Donation(item_name=f'Item {i}', category='bakery', expiry_date=date.today() + timedelta(days=5),
+                 quantity=10, company_id=company_id, latitude=48.8566, longitude=2.3522, **fields)
+        for i in range(count)
+    )
+    db.session.commit()
+
+
+def logged_in_client(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+    return client
+
+
+def count_statements(app, client, url):
+    """Render a page and return (status code, SQL statements executed)"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(url)
+    finally:
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', record)
+    return response.status_code, len(statements)
+
+
+@pytest.fixture
+def users(app):
+    with app.app_context():
+        companies = [add_user('company', f'company{i}@example.com') for i in range(3)]
+        return companies, add_user('volunteer', 'volunteer@example.com')
+
+
+@pytest.mark.parametrize('url', QUERY_BUDGETS)
+def test_dashboard_statements_stay_within_budget(app, users, url):
+    companies, volunteer_id = users
+    client = logged_in_client(app, companies[0] if url.startswith('/dashboard/company') else volunteer_id)
+    # Leave one-off work such as building the read model out of the counts
+    client.get(url)
+
+    created = 0
+    for per_company in (6, 60):
+        with app.app_context():
+            for company_id in companies:
+                add_donations(company_id, per_company - created)
+                add_donations(company_id, per_company // 6, status='claimed', volunteer_id=volunteer_id)
+        created = per_company
+
+        status, count = count_statements(app, client, url)
+        assert status == 200
+        assert count <= QUERY_BUDGETS[url], f'{url} issued {count} statements with {per_company} donations per company'
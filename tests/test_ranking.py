@@ -0,0 +1,31 @@
+"""Priority feed scores"""
+from datetime import date
+
+from config import Config
+from ranking import FeedRanker
+
+TODAY = date(2026, 1, 31)
+
+
+def score(days_to_expiry, distance_km=None):
+    ranker = FeedRanker(Config.FEED_WEIGHTS, Config.FEED_DISTANCE_SCALE_KM, Config.FEED_QUANTITY_SCALE, TODAY)
+    if distance_km is None:
+        scorer, lat = ranker.scorer(), None
+    else:
+        # 1 degree of latitude is about 111.2 km
+        scorer, lat = ranker.scorer(0.0, 0.0), distance_km / 111.195
+    return scorer(lat, 0.0, TODAY.toordinal() + days_to_expiry, 0)
+
+
+def test_urgency_peaks_on_the_expiry_day():
+    assert score(0) > score(1) > score(7) > 0
+
+
+def test_past_expiry_dates_score_no_urgency():
+    assert score(-1) == score(-30) == 0
+    assert score(-30, distance_km=1) < score(7, distance_km=1)
+
+
+def test_closeness_halves_at_the_distance_scale():
+    near, at_scale = score(-1, distance_km=0), score(-1, distance_km=Config.FEED_DISTANCE_SCALE_KM)
+    assert abs(at_scale / near - 0.5) < 1e-3
@@ -0,0 +1,92 @@
+"""Moving donations between shards"""
+import threading
+from datetime import date, timedelta
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy import event
+
+import config
+from app import create_app, init_db
+from models import db, Donation
+
+PARIS = (48.8566, 2.3522)
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    class ShardedConfig(config.TestingConfig):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path}/primary.db'
+        DONATION_SHARDS = {'paris': f'sqlite:///{tmp_path}/paris.db', 'lyon': f'sqlite:///{tmp_path}/lyon.db'}
+        DONATION_SHARD_REGIONS = {'u09': 'paris'}
+
+    monkeypatch.setitem(config.config, 'sharded', ShardedConfig)
+    app = create_app('sharded')
+    with app.app_context():
+        init_db()
+        yield app.extensions['shards']
+        db.session.remove()
+        app.extensions['shards'].dispose()
+
+
+def add_donations(count):
+    donations = [
+        Donation(item_name=f'Item {i}', category='bakery', quantity=1, company_id=1,
+                 expiry_date=date.today() + timedelta(days=3), latitude=PARIS[0], longitude=PARIS[1])
+        for i in range(count)
+    ]
+    db.session.add_all(donations)
+    db.session.commit()
+    return [donation.id for donation in donations]
+
+
+def statuses(engine):
+    with engine.connect() as conn:
+        return dict(conn.execute(sa.select(Donation.id, Donation.status)).all())
+
+
+def test_move_copies_rows_and_removes_them_from_the_source(shards):
+    ids = add_donations(3)
+    assert statuses(shards.engines['paris']) == dict.fromkeys(ids, 'available')
+
+    shards.assign('u09', 'lyon')
+    assert shards.rebalance('u09') == {('paris', 'lyon'): 3}
+    assert statuses(shards.engines['paris']) == {}
+    assert statuses(shards.engines['lyon']) == dict.fromkeys(ids, 'available')
+
+
+def test_claim_during_a_move_is_not_lost(shards):
+    ids = add_donations(2)
+    claimed = ids[0]
+    outcome = {}
+
+    def claim():
+        # A volunteer's claim, committed on the shard the donation was read from
+        with shards.engines['paris'].begin() as conn:
+            outcome['rows'] = conn.execute(
+                sa.update(Donation.__table__)
+                .where(Donation.id == claimed, Donation.status == 'available')
+                .values(status='claimed')
+            ).rowcount
+
+    claimer = threading.Thread(target=claim)
+
+    def claim_mid_move(conn, clauseelement, multiparams, params, execution_options):
+        # Between copying the rows to lyon and deleting them from paris
+        if not claimer.is_alive() and 'rows' not in outcome and getattr(clauseelement, 'is_insert', False):
+            claimer.start()
+            claimer.join(timeout=0.5)
+
+    event.listen(shards.engines['lyon'], 'before_execute', claim_mid_move)
+    try:
+        shards.assign('u09', 'lyon')
+        shards.rebalance('u09')
+    finally:
+        event.remove(shards.engines['lyon'], 'before_execute', claim_mid_move)
+    claimer.join()
+
+    # Either the claim landed before the copy and moved with the row, or it
+    # waited for the move and found the row gone: never applied, then dropped
+    moved = statuses(shards.engines['lyon'])
+    assert set(moved) == set(ids)
+    assert (moved[claimed] == 'claimed') == (outcome['rows'] == 1)
@@ -0,0 +1,167 @@
+"""
+Write-behind user updates for Food Rescue App
+A moving volunteer's browser saves its location every few seconds, and
+every login stamps last_login: neither needs a transaction (and the SQLite
+write lock) of its own. UserWrites keeps the latest pending values per
+user in memory, and a flusher thread writes them all in one transaction
+of batched UPDATEs USER_WRITE_BEHIND_SECONDS after the first one arrives,
+and again on shutdown. Users loaded in this process see pending values as
+if they were stored, so current_user is never stale; other processes see
+them after the flush. An ORM write to the same columns wins over what is
+pending. USER_WRITE_BEHIND_SECONDS = 0 writes through.
+"""
+import atexit
+import os
+import threading
+import time
+
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, User
+
+BUFFERED_COLUMNS = ('latitude', 'longitude', 'address', 'last_login')
+
+
+class UserWrites:
+    """Pending column values per user id, written in one transaction per flush"""
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['USER_WRITE_BEHIND_SECONDS']
+        self.pending = {}
+        self.flushes = 0
+        self.users_written = 0
+        self._pid = None
+        self._closed = False
+        self._wake = threading.Condition()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # The parent flushes what it had pending; the child starts empty
+        self.pending = {}
+        self._pid = None
+        self._wake = threading.Condition()
+
+    def set(self, user_id, values):
+        with self._wake:
+            self.pending.setdefault(user_id, {}).update(values)
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='user-writes', daemon=True).start()
+            self._wake.notify()
+
+    def get(self, user_id):
+        """Pending values for a user"""
+        if not self.pending:
+            return {}
+        with self._wake:
+            return dict(self.pending.get(user_id, ()))
+
+    def discard(self, user_id, keys):
+        with self._wake:
+            values = self.pending.get(user_id)
+            if values:
+                for key in keys:
+                    values.pop(key, None)
+                if not values:
+                    del self.pending[user_id]
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self.pending and not self._closed:
+                    self._wake.wait()
+                if self._closed:
+                    return
+            # Let the writes arriving meanwhile coalesce into this flush
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Write everything pending in one transaction; returns the number of users written"""
+        with self._wake:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+
+        # One executemany per set of columns; the SET clause comes from the row keys
+        groups = {}
+        for user_id, values in pending.items():
+            groups.setdefault(tuple(sorted(values)), []).append({'user_id': user_id, **values})
+        statement = User.__table__.update().where(User.__table__.c.id == sa.bindparam('user_id'))
+        try:
+            with self.app.app_context(), db.engine.begin() as conn:
+                for rows in groups.values():
+                    conn.execute(statement, rows)
+        except Exception as e:
+            # Keep them for the next flush, under anything newer that arrived meanwhile
+            with self._wake:
+                for user_id, values in pending.items():
+                    self.pending[user_id] = {**values, **self.pending.get(user_id, {})}
+            self.app.logger.error(f"User write flush error: {str(e)}")
+            return 0
+        self.flushes += 1
+        self.users_written += len(pending)
+        return len(pending)
+
+    def close(self):
+        """Stop the flusher and write what is pending"""
+        with self._wake:
+            self._closed = True
+            self._wake.notify_all()
+        self.flush()
+
+
+def current_writes():
+    return current_app.extensions.get('user_writes') if has_app_context() else None
+
+
+def write_user(user, **values):
+    """
+    Set buffered columns of user: at once for this process, in the
+    database with the next flush (or now, when write-behind is off)
+    """
+    writes = current_writes()
+    if writes is None:
+        for key, value in values.items():
+            setattr(user, key, value)
+        db.session.commit()
+        return
+    for key, value in values.items():
+        set_committed_value(user, key, value)
+    writes.set(user.id, values)
+
+
+@event.listens_for(User, 'load')
+def apply_pending(target, context):
+    writes = current_writes()
+    if writes is not None:
+        for key, value in writes.get(target.id).items():
+            set_committed_value(target, key, value)
+
+
+@event.listens_for(User, 'refresh')
+def reapply_pending(target, context, attrs):
+    apply_pending(target, context)
+
+
+@event.listens_for(User, 'before_update')
+def drop_overwritten(mapper, connection, target):
+    writes = current_writes()
+    if writes is not None:
+        state = sa.inspect(target)
+        writes.discard(target.id, [key for key in BUFFERED_COLUMNS if state.attrs[key].history.has_changes()])
+
+
+def init_user_writes(app):
+    """Set up the app's write-behind buffer, unless USER_WRITE_BEHIND_SECONDS is 0"""
+    if not app.config.get('USER_WRITE_BEHIND_SECONDS'):
+        return None
+    writes = UserWrites(app)
+    app.extensions['user_writes'] = writes
+    atexit.register(writes.close)
+    return writes
@@ -0,0 +1,16 @@
+"""
+WSGI entry point for production servers
+Preload the app once in the master and fork workers from it:
+    flask --app app init-db
+    gunicorn --preload --workers 4 wsgi:app
+"""
+import os
+
+from app import create_app
+from geocoder import current_geocoder
+
+app = create_app(os.environ.get('FLASK_CONFIG', 'production'))
+
+# Load the gazetteer before forking so workers share one copy of the index
+with app.app_context():
+    current_geocoder()